@@ -1,5 +1,6 @@
 import numpy as np
-from digicampipe.io.containers import CameraEventType
+from digicampipe.io.containers import CalibrationBlockContainer, \
+    CameraEventType, out_buffer
 
 __all__ = ['fill_dark_baseline', 'fill_baseline', 'fill_digicam_baseline',
            'compute_baseline_with_min', 'subtract_baseline',
@@ -7,15 +8,22 @@ __all__ = ['fill_dark_baseline', 'fill_baseline', 'fill_digicam_baseline',
            'compute_nsb_rate', 'compute_gain_drop', 'correct_wrong_baseline']
 
 
+def _per_event(event, value):
+    # the fields of a block have the events along their first axis
+    if isinstance(event, CalibrationBlockContainer):
+        return event.per_event(value)
+    return value
+
+
 def fill_dark_baseline(events, dark_baseline):
     for event in events:
-        event.data.dark_baseline = dark_baseline
+        event.data.dark_baseline = _per_event(event, dark_baseline)
         yield event
 
 
 def fill_baseline(events, baseline):
     for event in events:
-        event.data.baseline = baseline
+        event.data.baseline = _per_event(event, baseline)
         yield event
 
 
@@ -42,15 +50,25 @@ def compute_baseline_with_min(events):
 def subtract_baseline(events):
     for event in events:
         baseline = event.data.baseline
-        event.data.adc_samples = event.data.adc_samples.astype(baseline.dtype)
-        event.data.adc_samples -= baseline[..., np.newaxis]
+        adc_samples = event.data.adc_samples
+        out = out_buffer(event.data, 'adc_samples', adc_samples.shape,
+                         baseline.dtype)
+        # same as adc_samples.astype(baseline.dtype) - baseline
+        np.subtract(adc_samples, baseline[..., np.newaxis], out=out,
+                    dtype=baseline.dtype, casting='unsafe')
+        event.data.adc_samples = out
         yield event
 
 
 def compute_baseline_shift(events):
     for event in events:
-
-        event.data.baseline_shift = event.data.baseline - event.data.dark_baseline
+        baseline = event.data.baseline
+        dark_baseline = event.data.dark_baseline
+        out = out_buffer(event.data, 'baseline_shift',
+                         np.broadcast(baseline, dark_baseline).shape,
+                         np.result_type(baseline, dark_baseline))
+        event.data.baseline_shift = np.subtract(baseline, dark_baseline,
+                                                out=out)
         yield event
 
 
@@ -190,10 +208,10 @@ def compute_baseline_from_waveform(events, bin_left=5, bin_right=10):
     for event in events:
         adc_samples = event.data.adc_samples
 
-        adc_samples_first = adc_samples[:, 0:bin_left - 1]
-        adc_samples_last = adc_samples[:, -bin_right:]
+        adc_samples_first = adc_samples[..., 0:bin_left - 1]
+        adc_samples_last = adc_samples[..., -bin_right:]
         adc_samples = np.concatenate((adc_samples_first,
-                                      adc_samples_last), axis=1)
+                                      adc_samples_last), axis=-1)
 
         baseline = np.mean(adc_samples, axis=-1)
         std = np.std(adc_samples, axis=-1)
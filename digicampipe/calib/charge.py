@@ -1,12 +1,14 @@
+import math
 import os
+from collections import OrderedDict, namedtuple
 
 import matplotlib.pyplot as plt
+import numba
 import numpy as np
-from iminuit import Minuit
 from pkg_resources import resource_filename
-from probfit import Chi2Regression
-from scipy.ndimage.filters import convolve1d
+from scipy.sparse import csr_matrix, diags
 
+from digicampipe.io.containers import out_buffer
 from digicampipe.utils.pulse_template import NormalizedPulseTemplate
 
 TEMPLATE_FILENAME = resource_filename(
@@ -32,30 +34,104 @@ corr_factor_windows = [
     ) for i in range(len(list_wdw))
 ]
 
-def compute_charge(events, integral_width, shift):
+
+class PulseCharges(namedtuple('PulseCharges', ['pixel', 'sample',
+                                               'charge'])):
+    """
+    Charges of the pulses of an event or of a block of events, c.f.
+    integrate_pulses(). pixel and sample give the position of each pulse.
     """
 
-    :param events: a stream of events
+    def per_pixel(self, n_pixels):
+        """
+        Charges of the pulses of each pixel, as expected by
+        Histogram1D(data_shape=(n_pixels, )).fill()
+        :param n_pixels: number of pixels
+        :return: (n_pixels, n) array with n the largest number of pulses of
+        a pixel. The missing pulses are NaN.
+        """
+        order = np.argsort(self.pixel, kind='stable')
+        pixel = self.pixel[order]
+        n_pulses = np.bincount(pixel, minlength=n_pixels)
+        first = np.cumsum(n_pulses) - n_pulses
+        rank = np.arange(len(pixel)) - np.repeat(first, n_pulses)
+        charges = np.full((n_pixels, max(np.max(n_pulses), 1)), np.nan)
+        charges[pixel, rank] = self.charge[order]
+        return charges
+
+
+def integrate_pulses(adc_samples, pulse_mask, integral_width, shift=0):
+    """
+    Integrate the adc samples around the pulses, from the cumulative sum of
+    the samples. The window of a pulse at sample i is
+    [i + shift - (integral_width - 1) // 2, i + shift + integral_width // 2]
+    and the samples out of the waveform are reflected at its edges, like
+    scipy.ndimage.convolve1d(adc_samples, np.ones(integral_width)).
+    :param adc_samples: (..., n_pixels, n_samples) array, e.g. the samples of
+    an event or of a block of events
+    :param pulse_mask: boolean array of the shape of adc_samples, True at the
+    pulses
+    :param integral_width: width of the integration window
+    :param shift: shift of the window from the pulse, the shifted position
+    wraps around the waveform.
+    :return: PulseCharges, the charges being in the dtype of adc_samples
+    """
+    n_samples = adc_samples.shape[-1]
+    if integral_width > n_samples:
+        raise ValueError('integral_width ({}) is larger than the number of '
+                         'samples ({})'.format(integral_width, n_samples))
+    index = np.nonzero(pulse_mask)
+    waveforms = index[:-1]
+    if np.issubdtype(adc_samples.dtype, np.integer):
+        # sums of integers wrap around like with convolve1d()
+        cumsum = np.cumsum(adc_samples, axis=-1)
+    else:
+        cumsum = np.cumsum(adc_samples, axis=-1, dtype=np.float64)
+    cumsum = np.concatenate(
+        [np.zeros(cumsum.shape[:-1] + (1, ), dtype=cumsum.dtype), cumsum],
+        axis=-1
+    )[waveforms]
+    center = (index[-1] + shift) % n_samples
+    start = center - (integral_width - 1) // 2
+    stop = center + integral_width // 2 + 1
+    pulses = np.arange(len(center))
+    n_before = np.clip(-start, 0, n_samples)
+    n_after = np.clip(stop - n_samples, 0, n_samples)
+    charge = cumsum[pulses, np.clip(stop, 0, n_samples)]
+    charge -= cumsum[pulses, np.clip(start, 0, n_samples)]
+    # reflected samples
+    charge += cumsum[pulses, n_before]
+    charge += cumsum[pulses, n_samples] - cumsum[pulses, n_samples - n_after]
+    return PulseCharges(
+        pixel=index[-2], sample=index[-1],
+        charge=charge.astype(adc_samples.dtype),
+    )
+
+
+def compute_charge(events, integral_width, shift, compact=False):
+    """
+
+    :param events: a stream of events or of blocks of events
     :param integral_width: width of the integration window
     :param shift: shift to the pulse index
+    :param compact: If True, only the charges of the pulses are computed and
+    stored in event.data.pulse_charges, c.f. integrate_pulses(). Otherwise
+    event.data.reconstructed_charge has the shape of adc_samples, with the
+    charges at the pulses and NaN elsewhere.
     :return:
     """
 
     for count, event in enumerate(events):
         adc_samples = event.data.adc_samples
         pulse_mask = event.data.pulse_mask
-
-        convolved_signal = convolve1d(
-            adc_samples,
-            np.ones(integral_width),
-            axis=-1
-        )
-
-        charges = np.zeros(convolved_signal.shape) * np.nan
-        charges[pulse_mask] = convolved_signal[
-            np.roll(pulse_mask, shift, axis=1)
-        ]
-        event.data.reconstructed_charge = charges
+        pulse_charges = integrate_pulses(adc_samples, pulse_mask,
+                                         integral_width, shift)
+        if compact:
+            event.data.pulse_charges = pulse_charges
+        else:
+            charges = np.full(adc_samples.shape, np.nan)
+            charges[pulse_mask] = pulse_charges.charge
+            event.data.reconstructed_charge = charges
 
         yield event
 
@@ -80,14 +156,16 @@ def compute_dynamic_charge(events, integral_width, saturation_threshold=3000,
                            threshold_pulse=0.1, debug=False,  pulse_tail=False,
                            ):
     """
-    :param events: a stream of events
+    :param events: a stream of events or of blocks of events, c.f.
+    digicampipe.io.event_stream.calibration_block_stream()
     :param integral_width: width of the integration window for non-saturated
     pulses
     :param saturation_threshold: threshold corresponding to the pulse amplitude
     in unit of LSB at which the signal is considered saturated
     :param threshold_pulse: relative threshold (of pulse amplitude)
     at which the pulse area is integrated.
-    :param debug: Enter the debug mode
+    :param debug: Enter the debug mode. For blocks, the first event of each
+    block is shown.
     :param pulse_tail: Use or not the tail of the pulse for charge computation
     :return:
     """
@@ -98,9 +176,7 @@ def compute_dynamic_charge(events, integral_width, saturation_threshold=3000,
 
         if count == 0:
 
-            n_pixels, n_samples = event.data.adc_samples.shape
-            samples = np.arange(n_samples)
-            samples = np.tile(samples, n_pixels).reshape((n_pixels, n_samples))
+            n_pixels, n_samples = event.data.adc_samples.shape[-2:]
 
             if isinstance(threshold_pulse, float) or isinstance(
                     threshold_pulse, int
@@ -116,45 +192,27 @@ def compute_dynamic_charge(events, integral_width, saturation_threshold=3000,
             threshold_pulse = threshold_pulse[:, None]
 
         adc_samples = event.data.adc_samples
-        amplitude = np.max(adc_samples, axis=-1)
+        amplitude = out_buffer(event.data, 'reconstructed_amplitude',
+                               adc_samples.shape[:-1], adc_samples.dtype)
+        np.max(adc_samples, axis=-1, out=amplitude)
 
         trigger_bin = event.data.pulse_mask
 
         saturated_pulse = amplitude > saturation_threshold
-        saturated = np.any(saturated_pulse)
+        saturated = np.any(saturated_pulse, axis=-1)
         event.data.saturated = saturated
 
-        max_arg = np.argmax(trigger_bin, axis=-1)
-        start_bin = (samples <= (max_arg[:, None] - integral_width / 2))
-        end_bin = (samples > (max_arg[:, None] + integral_width / 2))
-        window = ~(start_bin + end_bin)
-
-        if saturated:
-
-            adc = adc_samples[saturated_pulse]
-            smp = samples[saturated_pulse]
-            threshold = threshold_pulse[saturated_pulse]
-            trigger_sample = max_arg[saturated_pulse]
-
-            start_point = trigger_sample - 3
-            start_bin = (smp < start_point[:, None])
-            start_bin = start_bin[:, :-1]
-
-            end_point = (adc[:, :-1] >= threshold) * \
-                        (adc[:, 1:] < threshold)
-            end_point = np.argmax(end_point, axis=-1)[:, None]
-            end_bin = (smp[..., :-1] > end_point + 1)
-            win = ~(start_bin + end_bin) * (adc[:, :-1] > 0)
-
-            if pulse_tail:
-                extended_window = (smp[..., :-1] > end_point + 1) * \
-                                  (adc[:, :-1] > 0)
-
-                win = win + extended_window
-
-            window[saturated_pulse, :-1] = win
-
-        charge = np.sum(adc_samples * window, axis=-1)
+        threshold = np.broadcast_to(threshold_pulse[:, 0], amplitude.shape)
+        charge = out_buffer(event.data, 'reconstructed_charge',
+                            amplitude.shape, _sum_dtype(adc_samples.dtype))
+        _integrate_dynamic_window(
+            adc_samples.reshape(-1, n_samples),
+            trigger_bin.reshape(-1, n_samples),
+            saturated_pulse.reshape(-1),
+            threshold.reshape(-1),
+            integral_width / 2, pulse_tail, adc_samples.dtype.type(0),
+            charge.reshape(-1),
+        )
 
         event.data.reconstructed_charge = charge
         event.data.reconstructed_amplitude = amplitude
@@ -163,7 +221,16 @@ def compute_dynamic_charge(events, integral_width, saturation_threshold=3000,
 
             pixel = 0
             time = np.arange(adc_samples.shape[-1]) * 4
-            window = window[pixel]
+            max_arg = np.argmax(trigger_bin, axis=-1)
+            window = _dynamic_charge_window(
+                adc_samples, trigger_bin, saturated_pulse, threshold_pulse,
+                integral_width, pulse_tail
+            )
+            # pixel 0 of the first event of a block
+            adc_samples = adc_samples.reshape(-1, n_samples)
+            amplitude = amplitude.reshape(-1)
+            max_arg = max_arg.reshape(-1)
+            window = window.reshape(-1, n_samples)[pixel]
 
             plt.figure()
             plt.step(time, np.cumsum(adc_samples, axis=-1)[pixel])
@@ -175,7 +242,7 @@ def compute_dynamic_charge(events, integral_width, saturation_threshold=3000,
             plt.xlabel('time [ns]')
             plt.ylabel('[LSB]')
 
-            baseline = event.data.baseline[pixel]
+            baseline = event.data.baseline.reshape(-1)[pixel]
             wvf = adc_samples[pixel] + baseline
 
             fig = plt.figure()
@@ -203,6 +270,163 @@ def compute_dynamic_charge(events, integral_width, saturation_threshold=3000,
         yield event
 
 
+def _dynamic_charge_window(adc_samples, pulse_mask, saturated_pulse,
+                           threshold_pulse, integral_width, pulse_tail):
+    """
+    Integration window of compute_dynamic_charge() as a boolean mask of the
+    shape of adc_samples. It is not used for the computation of the charge,
+    which is done by _integrate_dynamic_window(), but to show the window in
+    debug mode and to check the compiled kernel.
+    """
+    samples = np.arange(adc_samples.shape[-1])
+    max_arg = np.argmax(pulse_mask, axis=-1)
+    start_bin = (samples <= (max_arg[..., None] - integral_width / 2))
+    end_bin = (samples > (max_arg[..., None] + integral_width / 2))
+    window = ~(start_bin + end_bin)
+
+    if np.any(saturated_pulse):
+
+        adc = adc_samples[saturated_pulse]
+        smp = np.broadcast_to(samples, adc_samples.shape)[saturated_pulse]
+        threshold = np.broadcast_to(
+            threshold_pulse, saturated_pulse.shape + (1, )
+        )[saturated_pulse]
+        trigger_sample = max_arg[saturated_pulse]
+
+        start_point = trigger_sample - 3
+        start_bin = (smp < start_point[:, None])
+        start_bin = start_bin[:, :-1]
+
+        end_point = (adc[:, :-1] >= threshold) * \
+                    (adc[:, 1:] < threshold)
+        end_point = np.argmax(end_point, axis=-1)[:, None]
+        end_bin = (smp[..., :-1] > end_point + 1)
+        win = ~(start_bin + end_bin) * (adc[:, :-1] > 0)
+
+        if pulse_tail:
+            extended_window = (smp[..., :-1] > end_point + 1) * \
+                              (adc[:, :-1] > 0)
+
+            win = win + extended_window
+
+        window[saturated_pulse, :-1] = win
+
+    return window
+
+
+def _sum_dtype(dtype):
+    # dtype of np.sum(adc_samples * window, axis=-1)
+    return np.sum(np.zeros(1, dtype=dtype) * True).dtype
+
+
+@numba.njit
+def _window_value(adc, i, start, end, saturated, last, zero):
+    # adc[i] * window[i], the last sample of saturated pulses being in the
+    # window of non saturated pulses
+    n_samples = len(adc)
+    if saturated and i == n_samples - 1:
+        inside = last
+    else:
+        inside = start <= i <= end and (not saturated or adc[i] > 0)
+    if inside:
+        return adc[i]
+    return adc[i] * zero
+
+
+@numba.njit
+def _pairwise_window_sum(adc, first, n, start, end, saturated, last, zero):
+    # same order of the additions as the pairwise summation of numpy
+    if n < 8:
+        result = zero
+        for i in range(first, first + n):
+            result += _window_value(adc, i, start, end, saturated, last, zero)
+        return result
+    elif n <= 128:
+        r0 = _window_value(adc, first, start, end, saturated, last, zero)
+        r1 = _window_value(adc, first + 1, start, end, saturated, last, zero)
+        r2 = _window_value(adc, first + 2, start, end, saturated, last, zero)
+        r3 = _window_value(adc, first + 3, start, end, saturated, last, zero)
+        r4 = _window_value(adc, first + 4, start, end, saturated, last, zero)
+        r5 = _window_value(adc, first + 5, start, end, saturated, last, zero)
+        r6 = _window_value(adc, first + 6, start, end, saturated, last, zero)
+        r7 = _window_value(adc, first + 7, start, end, saturated, last, zero)
+        i = first + 8
+        stop = first + n - (n % 8)
+        while i < stop:
+            r0 += _window_value(adc, i, start, end, saturated, last, zero)
+            r1 += _window_value(adc, i + 1, start, end, saturated, last, zero)
+            r2 += _window_value(adc, i + 2, start, end, saturated, last, zero)
+            r3 += _window_value(adc, i + 3, start, end, saturated, last, zero)
+            r4 += _window_value(adc, i + 4, start, end, saturated, last, zero)
+            r5 += _window_value(adc, i + 5, start, end, saturated, last, zero)
+            r6 += _window_value(adc, i + 6, start, end, saturated, last, zero)
+            r7 += _window_value(adc, i + 7, start, end, saturated, last, zero)
+            i += 8
+        result = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+        while i < first + n:
+            result += _window_value(adc, i, start, end, saturated, last, zero)
+            i += 1
+        return result
+    n2 = n // 2
+    n2 -= n2 % 8
+    return (
+        _pairwise_window_sum(adc, first, n2, start, end, saturated, last,
+                             zero) +
+        _pairwise_window_sum(adc, first + n2, n - n2, start, end, saturated,
+                             last, zero)
+    )
+
+
+@numba.njit(parallel=True)
+def _integrate_dynamic_window(adc_samples, pulse_mask, saturated_pulse,
+                              threshold_pulse, half_width, pulse_tail, zero,
+                              charge):
+    """
+    Compute the charges of compute_dynamic_charge() pulse by pulse, without
+    building the integration window, c.f. _dynamic_charge_window(). The
+    results are the same bit for bit.
+    :param adc_samples: (n_pulses, n_samples) array
+    :param pulse_mask: (n_pulses, n_samples) boolean array, the trigger bin
+    is the first sample in the mask
+    :param saturated_pulse: (n_pulses, ) boolean array
+    :param threshold_pulse: (n_pulses, ) threshold in LSB at which the
+    integration stops for saturated pulses
+    :param half_width: half of the integration window of non saturated
+    pulses
+    :param pulse_tail: if True, the tail of saturated pulses is integrated
+    :param zero: 0 in the dtype of adc_samples
+    :param charge: (n_pulses, ) output array
+    """
+    n_pulses, n_samples = adc_samples.shape
+    for pulse in numba.prange(n_pulses):
+        adc = adc_samples[pulse]
+        max_arg = 0
+        for i in range(n_samples):
+            if pulse_mask[pulse, i]:
+                max_arg = i
+                break
+        start = int(math.floor(max_arg - half_width)) + 1
+        end = int(math.floor(max_arg + half_width))
+        last = start <= n_samples - 1 <= end
+        saturated = saturated_pulse[pulse]
+        if saturated:
+            threshold = threshold_pulse[pulse]
+            end_point = 0
+            for i in range(n_samples - 1):
+                if adc[i] >= threshold and adc[i + 1] < threshold:
+                    end_point = i
+                    break
+            if pulse_tail:
+                start = min(max_arg - 3, end_point + 2)
+                end = n_samples
+            else:
+                start = max_arg - 3
+                end = end_point + 1
+        charge[pulse] = zero + _pairwise_window_sum(
+            adc, 0, n_samples, start, end, saturated, last, zero
+        )
+
+
 def compute_number_of_pe_from_interpolator(events, charge_to_pe_function,
                                            debug=False):
 
@@ -237,63 +461,91 @@ def compute_full_waveform_charge(events):
     for count, event in enumerate(events):
         adc_samples = event.data.adc_samples
         charges = np.sum(adc_samples, axis=-1)
-        event.data.reconstructed_charge = charges.reshape(-1, 1)
+        event.data.reconstructed_charge = charges[..., np.newaxis]
 
         yield event
 
 
 def fit_template(events, pulse_width=(4, 5), rise_time=12,
-                 template=PULSE_TEMPLATE):
+                 template=PULSE_TEMPLATE, max_time_shift=8,
+                 time_resolution=0.5, refine=True):
+    """
+    Fit the template to every pulse of pulse_mask.
+
+    For each time of the pulse on a grid, the amplitude and the baseline
+    minimizing the chi2 are solved analytically, for all the pulses at
+    once. The time with the smallest chi2 is kept.
+
+    :param events: stream of events
+    :param pulse_width: number of samples before and after the pulse sample
+    used in the fit
+    :param rise_time: time between the start of the template and the pulse
+    sample, in ns
+    :param template: NormalizedPulseTemplate
+    :param max_time_shift: maximum shift of the start of the template from
+    its initial value, in ns
+    :param time_resolution: step of the grid of the times, in ns
+    :param refine: if set, the time is refined by a parabola through the
+    chi2 around the grid minimum and the amplitude and baseline are solved
+    again at that time
+    :return: stream of events with reconstructed_amplitude and
+    reconstructed_time (start of the template, in ns) set at the pulses
+    and NaN elsewhere
+    """
+    window = np.arange(-int(pulse_width[0]), int(pulse_width[1]) + 1)
+    time_shifts = np.arange(-max_time_shift,
+                            max_time_shift + time_resolution / 2,
+                            time_resolution)
+    # template at the samples of the window for each shift of t_0
+    template_grid = template(
+        4 * window[np.newaxis] + rise_time - time_shifts[:, np.newaxis]
+    )
+
     for event in events:
 
-        adc_samples = event.data.adc_samples.copy()
-        time = np.arange(adc_samples.shape[-1]) * 4
-        pulse_indices = event.data.pulse_mask
-        pulse_indices = np.argwhere(pulse_indices)
-        pulse_indices = [tuple(arr) for arr in pulse_indices]
-        amplitudes = np.zeros(adc_samples.shape) * np.nan
-        times = np.zeros(adc_samples.shape) * np.nan
-
-        plt.figure()
-
-        for pulse_index in pulse_indices:
-            left = pulse_index[-1] - int(pulse_width[0])
-            left = max(0, left)
-            right = pulse_index[-1] + int(pulse_width[1]) + 1
-            right = min(adc_samples.shape[-1] - 1, right)
-
-            y = adc_samples[pulse_index[0], left:right]
-            t = time[left:right]
-
-            where_baseline = np.arange(adc_samples.shape[-1])
-            where_baseline = (where_baseline < left) + \
-                             (where_baseline >= right)
-            where_baseline = adc_samples[pulse_index[0]][where_baseline]
-
-            baseline_0 = np.mean(where_baseline)
-            baseline_std = np.std(where_baseline)
-            limit_baseline = (baseline_0 - baseline_std,
-                              baseline_0 + baseline_std)
-
-            t_0 = time[pulse_index[-1]] - rise_time
-            limit_t = (t_0 - 2 * 4, t_0 + 2 * 4)
-
-            amplitude_0 = np.max(y)
-            limit_amplitude = (max(np.min(y), 0), amplitude_0 * 1.2)
-
-            chi2 = Chi2Regression(template, t, y)
-            m = Minuit(chi2, t_0=t_0,
-                       amplitude=amplitude_0,
-                       limit_t=limit_t,
-                       limit_amplitude=limit_amplitude,
-                       baseline=baseline_0,
-                       limit_baseline=limit_baseline,
-                       print_level=0, pedantic=False)
-            m.migrad()
-
-            adc_samples[pulse_index[0]] -= template(time, **m.values)
-            amplitudes[pulse_index] = m.values['amplitude']
-            times[pulse_index] = m.values['t']
+        adc_samples = event.data.adc_samples
+        n_samples = adc_samples.shape[-1]
+        amplitudes = out_buffer(event.data, 'reconstructed_amplitude',
+                                adc_samples.shape, float)
+        times = out_buffer(event.data, 'reconstructed_time',
+                           adc_samples.shape, float)
+        amplitudes.fill(np.nan)
+        times.fill(np.nan)
+
+        pulses = np.flatnonzero(event.data.pulse_mask)
+        waveform, sample = np.divmod(pulses, n_samples)
+        samples = sample[:, np.newaxis] + window
+        in_waveform = (samples >= 0) & (samples < n_samples)
+        y = adc_samples.reshape(-1, n_samples)[
+            waveform[:, np.newaxis], np.clip(samples, 0, n_samples - 1)]
+        y = y * in_waveform
+
+        amplitude, baseline, chi2 = _fit_template_linear(
+            y, in_waveform, template_grid.T)
+        chi2[~np.isfinite(chi2)] = np.inf
+        best = np.argmin(chi2, axis=-1)
+        pulse = np.arange(len(pulses))
+        time_shift = time_shifts[best]
+        amplitude = amplitude[pulse, best]
+
+        if refine and len(time_shifts) > 2:
+            index = np.clip(best, 1, len(time_shifts) - 2)
+            left, center, right = (chi2[pulse, index - 1], chi2[pulse, index],
+                                   chi2[pulse, index + 1])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = 0.5 * (left - right) / (left - 2 * center + right)
+            valid = np.isfinite(delta) & (np.abs(delta) <= 1)
+            time_shift = np.where(
+                valid, time_shifts[index] + delta * time_resolution,
+                time_shift)
+            template_pulse = template(
+                4 * window + rise_time - time_shift[:, np.newaxis])
+            refined, _, _ = _fit_template_linear(
+                y, in_waveform, template_pulse[..., np.newaxis])
+            amplitude = np.where(valid, refined[:, 0], amplitude)
+
+        amplitudes.flat[pulses] = amplitude
+        times.flat[pulses] = 4 * sample - rise_time + time_shift
 
         event.data.reconstructed_amplitude = amplitudes
         event.data.reconstructed_time = times
@@ -301,6 +553,33 @@ def fit_template(events, pulse_width=(4, 5), rise_time=12,
         yield event
 
 
+def _fit_template_linear(y, mask, template):
+    """
+    Least squares solution of y = amplitude * template + baseline, for
+    several templates per waveform.
+
+    :param y: samples, shape (..., n_samples)
+    :param mask: samples used in the fit, same shape as y
+    :param template: template at the samples, shape (..., n_samples,
+    n_templates) broadcastable with y
+    :return: amplitude, baseline and chi2, each of shape
+    (..., n_templates)
+    """
+    mask = mask.astype(float)
+    y = y * mask
+    n = np.sum(mask, axis=-1)[..., np.newaxis]
+    sum_y = np.sum(y, axis=-1)[..., np.newaxis]
+    sum_yy = np.sum(y * y, axis=-1)[..., np.newaxis]
+    sum_t = np.matmul(mask[..., np.newaxis, :], template)[..., 0, :]
+    sum_tt = np.matmul(mask[..., np.newaxis, :], template ** 2)[..., 0, :]
+    sum_ty = np.matmul(y[..., np.newaxis, :], template)[..., 0, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        amplitude = (n * sum_ty - sum_t * sum_y) / (n * sum_tt - sum_t ** 2)
+        baseline = (sum_y - amplitude * sum_t) / n
+    chi2 = sum_yy - amplitude * sum_ty - baseline * sum_y
+    return amplitude, baseline, chi2
+
+
 def compute_photo_electron(events, gains):
     for event in events:
         charge = event.data.reconstructed_charge
@@ -353,55 +632,133 @@ def compute_sample_photo_electron(events, gain_amplitude):
     """
     for count, event in enumerate(events):
         adc_samples = event.data.adc_samples
-        gain_drop = event.data.gain_drop[:, None]
-        sample_pe = adc_samples / (gain_amplitude[:, None] * gain_drop)
+        gain_drop = event.data.gain_drop[..., None]
+        gain = gain_amplitude[:, None] * gain_drop
+        sample_pe = out_buffer(event.data, 'sample_pe',
+                               np.broadcast(adc_samples, gain).shape,
+                               np.result_type(adc_samples, gain))
+        np.divide(adc_samples, gain, out=sample_pe)
         event.data.sample_pe = sample_pe
         yield event
 
 
+def _neighbors_matrix(geom):
+    """
+    sparse (n_pixel, n_pixel) adjacency matrix of the pixels of geom
+    """
+    neighbors = [np.asarray(pix_neighbors, dtype=int)
+                 for pix_neighbors in geom.neighbors]
+    n_pixel = len(neighbors)
+    indptr = np.cumsum([0] + [len(pix_neighbors)
+                              for pix_neighbors in neighbors])
+    indices = np.concatenate(neighbors + [np.zeros(0, dtype=int)])
+    return csr_matrix((np.ones(len(indices)), indices, indptr),
+                      shape=(n_pixel, n_pixel))
+
+
+def _average_operator(neighbors_matrix, pixels, bad_pixels):
+    """
+    sparse (len(pixels), n_pixel) matrix averaging the neighbors of pixels
+    which are not in bad_pixels. Rows of pixels without such neighbors are
+    0.
+    """
+    n_pixel = neighbors_matrix.shape[0]
+    good_pixels_mask = np.ones(n_pixel)
+    good_pixels_mask[bad_pixels] = 0
+    operator = csr_matrix(
+        neighbors_matrix[pixels].dot(diags(good_pixels_mask))
+    )
+    operator.eliminate_zeros()
+    n_good_neighbors = np.asarray(operator.sum(axis=1)).ravel()
+    n_good_neighbors[n_good_neighbors == 0] = np.inf
+    return csr_matrix(diags(1. / n_good_neighbors).dot(operator))
+
+
 def _get_average_matrix_bad_pixels(geom, bad_pixels):
     n_pixel = len(geom.neighbors)
     pixels = np.arange(n_pixel, dtype=int)
     good_pixels_mask = np.ones(n_pixel, dtype=bool)
     good_pixels_mask[bad_pixels] = False
     good_pixels = pixels[good_pixels_mask]
-    average_matrix = np.zeros([n_pixel, n_pixel])
-    for i, pix in enumerate(pixels):
-        pix_neighbors = np.array(geom.neighbors[pix])
-        # remove neighbors which are part of bad_pixels
-        bad_neighbors = np.intersect1d(pix_neighbors, bad_pixels,
-                                       assume_unique=True)
-        for bad_neighbor in bad_neighbors:
-            pix_neighbors = pix_neighbors[pix_neighbors != bad_neighbor]
-        average_matrix[i, pix_neighbors] = 1. / len(pix_neighbors)
-    return average_matrix[:, good_pixels]
-
-
-def interpolate_bad_pixels(events, geom, bad_pixels):
-    n_pixel = len(geom.neighbors)
-    pixels = np.arange(n_pixel, dtype=int)
-    good_pixels_mask = np.ones(n_pixel, dtype=bool)
-    good_pixels_mask[bad_pixels] = False
-    good_pixels = pixels[good_pixels_mask]
-    average_matrix = _get_average_matrix_bad_pixels(geom, bad_pixels)
+    average_matrix = _average_operator(_neighbors_matrix(geom), pixels,
+                                       bad_pixels)
+    return average_matrix[:, good_pixels].toarray()
+
+
+class BadPixelInterpolator:
+    """
+    Replace the values of bad pixels by the average of their neighbors
+    which are not bad.
+
+    The sparse averaging operator of a set of bad pixels is built from the
+    neighbors of the geometry. The operators of the last cache_size sets
+    of bad pixels are kept, such that recurring sets are only built once.
+    """
+
+    def __init__(self, geom, cache_size=128):
+        self.neighbors_matrix = _neighbors_matrix(geom)
+        self.cache_size = cache_size
+        self._operators = OrderedDict()
+
+    def operator(self, bad_pixels):
+        """
+        :param bad_pixels: sorted array of unique bad pixel ids
+        :return: sparse (len(bad_pixels), n_pixel) averaging matrix
+        """
+        key = bad_pixels.tobytes()
+        if key in self._operators:
+            self._operators.move_to_end(key)
+            return self._operators[key]
+        operator = _average_operator(self.neighbors_matrix, bad_pixels,
+                                     bad_pixels)
+        self._operators[key] = operator
+        if len(self._operators) > self.cache_size:
+            self._operators.popitem(last=False)
+        return operator
+
+    def __call__(self, bad_pixels, *values):
+        """
+        Interpolate in place the bad pixels of each array of values.
+        :param bad_pixels: ids of the bad pixels
+        :param values: arrays of shape (n_pixel, ), they can be Quantities
+        :return: sorted array of the unique bad pixel ids
+        """
+        bad_pixels = np.unique(np.asarray(bad_pixels, dtype=int))
+        operator = self.operator(bad_pixels)
+        # np.asarray() gives views on the values, even for Quantities
+        values = [np.asarray(value) for value in values]
+        interpolated = operator.dot(np.column_stack(values))
+        for value, interpolated_value in zip(values, interpolated.T):
+            value[bad_pixels] = interpolated_value
+        return bad_pixels
+
+
+def interpolate_bad_pixels(events, geom, bad_pixels, cache_size=128):
+    """
+    Replace the p.e., baseline shift and NSB rate of the bad pixels by the
+    average over their neighbors. The bad pixels of an event are the ones
+    of bad_pixels and the pixels with non-finite p.e. or baseline shift or
+    with non-positive baseline shift.
+    :param events: stream of events
+    :param geom: camera geometry
+    :param bad_pixels: ids of the pixels always considered as bad
+    :param cache_size: number of sets of bad pixels for which the
+    interpolation operator is kept, c.f. BadPixelInterpolator
+    :return: stream of events
+    """
+    interpolator = BadPixelInterpolator(geom, cache_size=cache_size)
+    bad_pixels_mask = np.zeros(len(geom.neighbors), dtype=bool)
+    bad_pixels_mask[bad_pixels] = True
     for event in events:
         pe = event.data.reconstructed_number_of_pe
         baseline_shift = event.data.baseline_shift
         nsb_rate = event.data.nsb_rate
-        mask = np.isfinite(pe) * np.isfinite(baseline_shift) * \
-               (baseline_shift > 0)
-
-        all_bad_pixels = np.arange(pe.shape[-1])[~mask]
-        all_bad_pixels = np.append(all_bad_pixels, bad_pixels)
-        all_bad_pixels = np.unique(all_bad_pixels)
+        with np.errstate(invalid='ignore'):
+            mask = np.isfinite(pe) & np.isfinite(baseline_shift) & \
+                   (baseline_shift > 0) & ~bad_pixels_mask
         # correct p.e. , baseline shift and NSB
-        pe[all_bad_pixels] = average_matrix[all_bad_pixels, :].dot(
-            pe[good_pixels])
+        interpolator(np.flatnonzero(~mask), pe, baseline_shift, nsb_rate)
         event.data.reconstructed_number_of_pe = pe
-        baseline_shift[all_bad_pixels] = average_matrix[all_bad_pixels, :].dot(
-            baseline_shift[good_pixels])
         event.data.baseline_shift = baseline_shift
-        nsb_rate[all_bad_pixels] = average_matrix[all_bad_pixels, :].dot(
-            nsb_rate[good_pixels])
         event.data.nsb_rate = nsb_rate
         yield event
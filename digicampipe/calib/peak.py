@@ -1,13 +1,13 @@
 import os
 
+import numba
 import numpy as np
-import peakutils
 from pkg_resources import resource_filename
+from scipy.fftpack import next_fast_len
 from scipy.ndimage.filters import convolve1d, gaussian_filter1d
-from scipy.signal import correlate
 from scipy.signal import find_peaks_cwt
-from tqdm import tqdm
 
+from digicampipe.io.containers import out_buffer
 from digicampipe.utils.pulse_template import NormalizedPulseTemplate
 
 TEMPLATE_FILENAME = resource_filename(
@@ -23,12 +23,10 @@ TEMPLATE_FILENAME = resource_filename(
 def find_pulse_1(events, threshold, min_distance):
     for count, event in enumerate(events):
 
-        pulse_mask = np.zeros(event.adc_samples.shape, dtype=np.bool)
-
-        for pixel_id, adc_sample in enumerate(event.data.adc_samples):
-            peak_index = peakutils.indexes(adc_sample, threshold, min_distance)
-            pulse_mask[pixel_id, peak_index] = True
-
+        adc_samples = event.data.adc_samples
+        pulse_mask = out_buffer(event.data, 'pulse_mask', adc_samples.shape,
+                                bool)
+        find_peaks_mask(adc_samples, threshold, min_distance, out=pulse_mask)
         event.data.pulse_mask = pulse_mask
 
         yield event
@@ -40,23 +38,111 @@ def find_pulse_wavelets(events, threshold_sigma, widths, **kwargs):
         adc_samples = event.data.adc_samples
         pulse_mask = np.zeros(adc_samples.shape, dtype=np.bool)
         threshold = threshold_sigma
+        n_samples = adc_samples.shape[-1]
+        waveforms = adc_samples.reshape(-1, n_samples)
+        masks = pulse_mask.reshape(-1, n_samples)
 
-        for pixel_id, adc_sample in tqdm(enumerate(adc_samples), desc='Pixel',
-                                         total=len(adc_samples)):
+        for waveform, mask in zip(waveforms, masks):
 
-            peak_index = find_peaks_cwt(adc_sample, widths, **kwargs)
+            peak_index = find_peaks_cwt(waveform, widths, **kwargs)
 
             if len(peak_index):
                 peak_index = peak_index[
-                    adc_sample[peak_index] > threshold
+                    waveform[peak_index] > threshold
                     ]
-                pulse_mask[pixel_id, peak_index] = True
+                mask[peak_index] = True
 
         event.data.pulse_mask = pulse_mask
 
         yield event
 
 
+def find_peaks_mask(adc_samples, threshold=0.3, min_distance=1,
+                    threshold_abs=False, out=None):
+    """
+    Find the peaks of each waveform like peakutils.indexes() does, for all
+    the waveforms at once.
+
+    A peak is a sample strictly higher than its two neighbours and above
+    the threshold. If several peaks are closer than min_distance samples,
+    only the highest one is kept.
+
+    Parameters
+    ----------
+    adc_samples : ndarray
+        waveforms with the samples along the last axis, e.g.
+        (n_pixels, n_samples) or (n_events, n_pixels, n_samples)
+    threshold : float
+        threshold of the peaks. It is normalized to the range of each
+        waveform, i.e. threshold * (max - min) + min, unless threshold_abs
+        is set.
+    min_distance : int
+        minimum distance in samples between two peaks
+    threshold_abs : bool
+        if set, threshold is in the units of adc_samples
+    out : ndarray, optional
+        C-contiguous boolean array of the shape of adc_samples where the
+        mask is written
+
+    Returns
+    -------
+    ndarray
+        boolean mask of the peaks, of the shape of adc_samples
+    """
+    adc_samples = np.asarray(adc_samples)
+    if out is None:
+        out = np.empty(adc_samples.shape, dtype=bool)
+    elif out.shape != adc_samples.shape or not out.flags.c_contiguous:
+        raise ValueError('out must be a C-contiguous array of shape {}'
+                         .format(adc_samples.shape))
+    n_samples = adc_samples.shape[-1]
+    _find_peaks(adc_samples.reshape(-1, n_samples), float(threshold),
+                bool(threshold_abs), int(min_distance),
+                out.reshape(-1, n_samples))
+    return out
+
+
+@numba.njit(parallel=True)
+def _find_peaks(samples, threshold, threshold_abs, min_distance, pulse_mask):
+    n_waveforms, n_samples = samples.shape
+
+    for i in numba.prange(n_waveforms):
+
+        y = samples[i]
+        mask = pulse_mask[i]
+        mask[:] = False
+        if threshold_abs:
+            y_threshold = threshold
+        else:
+            y_min = np.float64(y.min())
+            y_threshold = threshold * (np.float64(y.max()) - y_min) + y_min
+
+        n_peaks = 0
+        for j in range(1, n_samples - 1):
+            if y[j - 1] < y[j] and y[j] > y[j + 1] and y[j] > y_threshold:
+                mask[j] = True
+                n_peaks += 1
+
+        if n_peaks <= 1 or min_distance <= 1:
+            continue
+
+        peaks = np.nonzero(mask)[0]
+        # highest peaks first, the last one first for equal heights
+        order = np.argsort(y[peaks], kind='mergesort')
+        removed = np.ones(n_samples, dtype=np.bool_)
+        for k in peaks:
+            removed[k] = False
+        for k in order[::-1]:
+            peak = peaks[k]
+            if not removed[peak]:
+                start = max(0, peak - min_distance)
+                stop = min(n_samples, peak + min_distance + 1)
+                removed[start:stop] = True
+                removed[peak] = False
+        for j in range(n_samples):
+            mask[j] = not removed[j]
+
+
 def find_pulse_fast(events, threshold):
     w = np.array([1, 2, 3, 4, 5, 4, 3, 2, 1], dtype=np.float32)
     w /= w.sum()
@@ -68,45 +154,107 @@ def find_pulse_fast(events, threshold):
         c = convolve1d(
             input=adc_samples,
             weights=w,
-            axis=1,
+            axis=-1,
             mode='constant',
         )
-        pulse_mask[:, 1:-1] = (
-            (c[:, :-2] <= c[:, 1:-1]) &
-            (c[:, 1:-1] >= c[:, 2:]) &
-            (c[:, 1:-1] > threshold)
+        pulse_mask[..., 1:-1] = (
+            (c[..., :-2] <= c[..., 1:-1]) &
+            (c[..., 1:-1] >= c[..., 2:]) &
+            (c[..., 1:-1] > threshold)
         )
         event.data.pulse_mask = pulse_mask
 
         yield event
 
 
+class MatchedFilter:
+    """
+    Correlate waveforms with a pulse template along the sample axis.
+
+    The correlation is computed in the frequency domain for all the
+    waveforms at once. The spectrum of the template is computed once per
+    waveform length. The filtered waveforms are aligned on the maximum of
+    the template, such that a pulse gives a maximum at the sample of its
+    own maximum.
+    """
+
+    def __init__(self, pulse_template, sampling=4, min_amplitude=0.1):
+        """
+        :param pulse_template: NormalizedPulseTemplate
+        :param sampling: time between 2 samples, in the units of the template
+        :param min_amplitude: template samples below this normalized
+        amplitude are set to 0
+        """
+        time = np.arange(pulse_template.time[0], pulse_template.time[-1],
+                         sampling)
+        template = pulse_template(time, t_0=0, amplitude=1, baseline=0)
+        template[template < min_amplitude] = 0
+        non_zero = np.nonzero(template)[0]
+        template = template[non_zero[0]:non_zero[-1] + 1]
+        self.template = template / np.sum(template)
+        self.peak_index = np.argmax(self.template)
+        self._spectra = {}
+
+    def spectrum(self, n_samples):
+        """
+        :param n_samples: number of samples of the waveforms
+        :return: (length of the FFT, spectrum of the reversed template)
+        """
+        if n_samples not in self._spectra:
+            n_fft = next_fast_len(n_samples + len(self.template) - 1)
+            spectrum = np.fft.rfft(self.template[::-1], n_fft)
+            self._spectra[n_samples] = n_fft, spectrum
+        return self._spectra[n_samples]
+
+    def __call__(self, adc_samples):
+        """
+        :param adc_samples: baseline subtracted waveforms, with the samples
+        along the last axis
+        :return: the filtered waveforms, of the shape of adc_samples. The
+        samples outside of the waveforms are taken as 0.
+        """
+        n_samples = adc_samples.shape[-1]
+        n_fft, spectrum = self.spectrum(n_samples)
+        filtered = np.fft.irfft(np.fft.rfft(adc_samples, n_fft) * spectrum,
+                                n_fft)
+        start = len(self.template) - 1 - self.peak_index
+        return filtered[..., start:start + n_samples]
+
+
 def find_pulse_correlate(events, threshold,
                          pulse_template=NormalizedPulseTemplate.load(
-                             TEMPLATE_FILENAME)):
-    time = np.linspace(0, 91 * 4, num=91)
-    template = pulse_template(time, t_0=0, amplitude=1, baseline=0)
-    template[template < 0.1] = 0
-    template = np.tile(template, (1296, 1))
-    template = template / np.sum(template, axis=-1)[..., np.newaxis]
+                             TEMPLATE_FILENAME), normalize=True):
+    """
+    Find the pulses as the local maxima above threshold of the waveforms
+    filtered by MatchedFilter. The filtered waveforms are kept in
+    event.data.filtered_samples.
+    :param threshold: threshold on the filtered waveforms, in units of the
+    standard deviation of the waveforms if normalize is set, in LSB
+    otherwise
+    :param normalize: if set, each waveform is centered on its mean and
+    divided by its standard deviation before being filtered. Otherwise the
+    waveforms must be baseline subtracted.
+    """
+    matched_filter = MatchedFilter(pulse_template)
 
     for count, event in enumerate(events):
         adc_samples = event.data.adc_samples
-        pulse_mask = np.zeros(adc_samples.shape, dtype=np.bool)
-
-        mean = np.mean(adc_samples, axis=-1)
-        std = np.std(adc_samples, axis=-1)
-
-        adc_samples = (adc_samples - mean[..., np.newaxis])
-        adc_samples = adc_samples / std[..., np.newaxis]
-        c = correlate(adc_samples, template)
-
-        pulse_mask[:, 1:-1] = (
-            (c[:, :-2] <= c[:, 1:-1]) &
-            (c[:, 1:-1] >= c[:, 2:]) &
-            (c[:, 1:-1] > threshold)
+        if normalize:
+            mean = np.mean(adc_samples, axis=-1)
+            std = np.std(adc_samples, axis=-1)
+            adc_samples = adc_samples - mean[..., np.newaxis]
+            adc_samples = adc_samples / std[..., np.newaxis]
+        c = matched_filter(adc_samples)
+        pulse_mask = out_buffer(event.data, 'pulse_mask', adc_samples.shape,
+                                bool)
+        pulse_mask[..., [0, -1]] = False
+        pulse_mask[..., 1:-1] = (
+            (c[..., :-2] <= c[..., 1:-1]) &
+            (c[..., 1:-1] >= c[..., 2:]) &
+            (c[..., 1:-1] > threshold)
         )
 
+        event.data.filtered_samples = c
         event.data.pulse_mask = pulse_mask
 
         yield event
@@ -122,7 +270,9 @@ def find_pulse_with_max(events):
             bins = np.arange(n_samples)
 
         arg_max = np.argmax(adc_samples, axis=-1)
-        pulse_mask = (bins == arg_max[..., np.newaxis])
+        pulse_mask = out_buffer(event.data, 'pulse_mask', adc_samples.shape,
+                                bool)
+        np.equal(bins, arg_max[..., np.newaxis], out=pulse_mask)
         event.data.pulse_mask = pulse_mask
 
         yield event
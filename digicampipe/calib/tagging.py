@@ -1,5 +1,7 @@
 import numpy as np
 
+from digicampipe.io.containers import CalibrationBlockContainer
+
 __all__ = ['tag_burst_from_moving_average_baseline']
 
 
@@ -8,21 +10,26 @@ def tag_burst_from_moving_average_baseline(events, n_previous_events=100,
     last_mean_baselines = []
     last_time = None
     for event in events:
-        mean_baseline = np.mean(event.data.baseline)
-        time = event.data.local_time
-        # reset buffer if there is a gap > 30s
-        if last_time is not None and time - last_time > 30:
-            last_mean_baselines = []
-        if len(last_mean_baselines) != n_previous_events:
-            last_mean_baselines.append(mean_baseline)
-        else:
-            last_mean_baselines = last_mean_baselines[1:]
-            last_mean_baselines.append(mean_baseline)
-        moving_avg_baseline = np.mean(last_mean_baselines)
-        if (mean_baseline - moving_avg_baseline) > threshold_lsb:
-            event.data.burst = True
+        # one value per event for blocks of events
+        mean_baselines = np.atleast_1d(np.mean(event.data.baseline, axis=-1))
+        times = np.atleast_1d(event.data.local_time)
+        bursts = np.zeros(len(mean_baselines), dtype=bool)
+        for i, (mean_baseline, time) in enumerate(zip(mean_baselines,
+                                                      times)):
+            # reset buffer if there is a gap > 30s
+            if last_time is not None and time - last_time > 30:
+                last_mean_baselines = []
+            if len(last_mean_baselines) != n_previous_events:
+                last_mean_baselines.append(mean_baseline)
+            else:
+                last_mean_baselines = last_mean_baselines[1:]
+                last_mean_baselines.append(mean_baseline)
+            moving_avg_baseline = np.mean(last_mean_baselines)
+            bursts[i] = (mean_baseline - moving_avg_baseline) > threshold_lsb
+        if isinstance(event, CalibrationBlockContainer):
+            event.data.burst = bursts
         else:
-            event.data.burst = False
+            event.data.burst = bool(bursts[0])
         yield event
 
 
@@ -0,0 +1,176 @@
+"""
+On-disk cache of the combined per-day tables of the aux services.
+
+Reading and stacking the FITS files of an aux service for a night takes much
+longer than using the result. The combined table of a night is therefore
+saved once as a ".npy" structured array, with its header in a ".json"
+sidecar, and is memory mapped back by the next runs. An entry is keyed by the
+paths, the sizes and the modification times of the FITS files it was made
+of, such that it is not used anymore when a file is added or changed.
+
+The cache is bounded in size: when it grows over its maximum size the least
+recently used entries are removed.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['cache_key', 'load_cached_table', 'save_cached_table',
+           'evict_cached_tables']
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'digicampipe', 'aux'
+)
+DEFAULT_CACHE_SIZE = 2 * 2 ** 30
+DATA_SUFFIX = '.npy'
+META_SUFFIX = '.json'
+
+
+def cache_key(name, paths):
+    """
+    :param name: name of the aux service
+    :param paths: paths of the FITS files of the table
+    :return: name of the cache entry of the table
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update('{}\0{}\0{}\0'.format(
+            os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+        ).encode())
+    return '{}.{}'.format(name, digest.hexdigest()[:20])
+
+
+def load_cached_table(key, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Load a table from the cache.
+    :param key: name of the cache entry, c.f. cache_key()
+    :param cache_dir: directory of the cache
+    :return: (read-only memory map of the structured array, meta dictionary)
+    or None if the entry is not in the cache.
+    """
+    data_path, meta_path = _entry_paths(key, cache_dir)
+    if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+        return None
+    try:
+        data = np.load(data_path, mmap_mode='r', allow_pickle=False)
+        with open(meta_path) as file:
+            meta = json.load(file)
+    except (OSError, ValueError) as e:
+        logger.warning('could not read the cached table %s: %s', data_path,
+                       e)
+        return None
+    # the modification time of an entry is its last use for the eviction
+    try:
+        os.utime(data_path)
+    except OSError:
+        pass
+    return data, meta
+
+
+def save_cached_table(key, data, meta, cache_dir=DEFAULT_CACHE_DIR,
+                      max_size=DEFAULT_CACHE_SIZE):
+    """
+    Save a table in the cache and evict the least recently used entries if
+    the cache is too big. Errors are logged and not raised, the cache is only
+    an optimisation.
+    :param key: name of the cache entry, c.f. cache_key()
+    :param data: structured array of the table
+    :param meta: dictionary of the header of the table
+    :param cache_dir: directory of the cache
+    :param max_size: maximum size of the cache in bytes
+    :return: True if the table was saved
+    """
+    data_path, meta_path = _entry_paths(key, cache_dir)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # the sidecar is written first such that an entry is complete as
+        # soon as its data file exists
+        _write_atomic(meta_path, lambda file: file.write(
+            json.dumps(meta, default=_to_json).encode()
+        ))
+        _write_atomic(data_path, lambda file: np.save(
+            file, np.ascontiguousarray(data), allow_pickle=False
+        ))
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning('could not cache the table %s: %s', key, e)
+        return False
+    logger.info('table %s cached in %s', key, data_path)
+    evict_cached_tables(cache_dir, max_size, keep=(key, ))
+    return True
+
+
+def evict_cached_tables(cache_dir=DEFAULT_CACHE_DIR,
+                        max_size=DEFAULT_CACHE_SIZE, keep=()):
+    """
+    Remove the least recently used entries of the cache until it is smaller
+    than max_size.
+    :param cache_dir: directory of the cache
+    :param max_size: maximum size of the cache in bytes
+    :param keep: keys of the entries never to remove
+    :return: number of entries removed
+    """
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return 0
+    for name in names:
+        if not name.endswith(DATA_SUFFIX):
+            continue
+        key = name[:-len(DATA_SUFFIX)]
+        data_path, meta_path = _entry_paths(key, cache_dir)
+        try:
+            stat = os.stat(data_path)
+            size = stat.st_size
+            if os.path.exists(meta_path):
+                size += os.path.getsize(meta_path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, size, key))
+
+    total_size = sum(size for _, size, _ in entries)
+    n_removed = 0
+    for _, size, key in sorted(entries):
+        if total_size <= max_size:
+            break
+        if key in keep:
+            continue
+        for path in _entry_paths(key, cache_dir):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total_size -= size
+        n_removed += 1
+    if n_removed:
+        logger.info('%d tables evicted from %s', n_removed, cache_dir)
+    return n_removed
+
+
+def _entry_paths(key, cache_dir):
+    path = os.path.join(cache_dir, key)
+    return path + DATA_SUFFIX, path + META_SUFFIX
+
+
+def _write_atomic(path, write):
+    temporary_path = path + '.{}.tmp'.format(os.getpid())
+    try:
+        with open(temporary_path, 'wb') as file:
+            write(file)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def _to_json(value):
+    # numpy scalars from the FITS headers
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
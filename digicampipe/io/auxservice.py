@@ -1,19 +1,37 @@
 from collections import OrderedDict, namedtuple
-from datetime import timedelta
-from functools import lru_cache
+from datetime import date, timedelta
 from glob import glob
 from os import path
 from warnings import warn
 
 import numpy as np
-import pandas as pd
 from astropy import table
 
+from .auxcache import DEFAULT_CACHE_SIZE, cache_key, load_cached_table, \
+    save_cached_table
+
+EPOCH = date(1970, 1, 1)
+DAY_NS = 24 * 3600 * 10 ** 9
+# the files of a night are named after the date at which the night starts
+NIGHT_OFFSET_NS = 12 * 3600 * 10 ** 9
+
 
 class AuxService:
-    def __init__(self, name, basepath):
+    def __init__(self, name, basepath, cache_dir=None,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        '''
+        :param name: name of the aux service, e.g. "DriveSystem"
+        :param basepath: directory of the aux files
+        :param cache_dir: directory of the on-disk cache of the combined
+        tables, c.f. digicampipe.io.auxcache. If None, the default, the
+        tables are read from the FITS files every time. The default cache
+        directory is digicampipe.io.auxcache.DEFAULT_CACHE_DIR.
+        :param cache_size: maximum size of the cache in bytes
+        '''
         self.name = name
         self.basepath = basepath
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
         self.glob_expr_fits = path.join(
             basepath,
             '{name}_{{date}}*.fits'.format(
@@ -27,6 +45,7 @@ class AuxService:
             )
         )
         self.namedtuple_klass = None
+        self._tables = {}
 
     def get_paths(self, date):
         fits_files = glob(
@@ -42,47 +61,177 @@ class AuxService:
         fits_files.extend(fits_gz_files)
         return sorted(fits_files)
 
-    # maxsize needs to be > number of Services
-    # lru cache for instance methods is shit...
-    @lru_cache(maxsize=20)
     def at_date(self, date):
-        ''' fetch fits Table for named aux service at date.
+        ''' fetch the AuxTable of the named aux service at date.
         If several files: append them in order.
-        takes some time, result will maybe be cached.
+        takes some time, the result is kept for the next calls.
         '''
-        paths = self.get_paths(date)
-        if len(paths) == 0:
-            raise RuntimeError("no data found for " + self.name + " on " +
-                               str(date))
-        combined_table = combine_tables(paths)
-
-        # side effect!
-        # we've just read a new day, so we update the format of our
-        # return value
-        self.namedtuple_klass = namedtuple(
-            self.name + "Row",
-            combined_table.colnames
-        )
-        return combined_table
+        if date not in self._tables:
+            paths = self.get_paths(date)
+            if len(paths) == 0:
+                raise RuntimeError("no data found for " + self.name +
+                                   " on " + str(date))
+            aux_table = self._load(paths)
+            # we've just read a new day, so we update the format of our
+            # return value
+            self.namedtuple_klass = aux_table.namedtuple_klass
+            self._tables[date] = aux_table
+        return self._tables[date]
+
+    def _load(self, paths):
+        if self.cache_dir is None:
+            return AuxTable.from_table(combine_tables(paths), self.name)
+        key = cache_key(self.name, paths)
+        cached = load_cached_table(key, self.cache_dir)
+        if cached is not None:
+            data, meta = cached
+            return AuxTable(data, OrderedDict(meta), self.name)
+        aux_table = AuxTable.from_table(combine_tables(paths), self.name)
+        save_cached_table(key, aux_table.data, aux_table.meta,
+                          self.cache_dir, self.cache_size)
+        return aux_table
 
     def at(self, event_timestamp_in_ns):
-        datetime = pd.to_datetime(event_timestamp_in_ns, unit='ns')
-        date = (datetime - timedelta(hours=12)).date()
-        table = self.at_date(date)
-
-        event_timestamp_in_ms = event_timestamp_in_ns / 1e6
-        table_index = np.searchsorted(
-            table['timestamp'],
-            event_timestamp_in_ms
-        )
-        # this row is still a astropy.Table.Row thing
-        row = table[table_index - 1]
+        ''' get the row of the service at the time of an event as a
+        namedtuple.
+        :param event_timestamp_in_ns: event timestamp in ns since the epoch
+        '''
+        aux_table = self.at_date(night_of(event_timestamp_in_ns))
+        return aux_table.row(aux_table.row_index(event_timestamp_in_ns))
+
+    def at_many(self, event_timestamps_in_ns):
+        ''' vectorized version of at()
+        :param event_timestamps_in_ns: array of event timestamps in ns since
+        the epoch.
+        :return: namedtuple of arrays with one entry per event for each
+        column of the service.
+        '''
+        timestamps = np.asarray(event_timestamps_in_ns, dtype=np.int64)
+        days = (timestamps - NIGHT_OFFSET_NS) // DAY_NS
+        unique_days = np.unique(days)
+        if len(unique_days) == 0:
+            raise ValueError('at_many() needs at least one timestamp')
+        if len(unique_days) == 1:
+            aux_table = self.at_date(_day_to_date(unique_days[0]))
+            return aux_table.columns_at(timestamps)
+        tables = [self.at_date(_day_to_date(day)) for day in unique_days]
+        columns = {}
+        for name in tables[0].colnames:
+            column = tables[0].data[name]
+            columns[name] = np.empty(
+                (len(timestamps), ) + column.shape[1:], dtype=column.dtype
+            )
+        for day, aux_table in zip(unique_days, tables):
+            mask = days == day
+            rows = aux_table.data[aux_table.row_index(timestamps[mask])]
+            for name, column in columns.items():
+                column[mask] = rows[name]
+        return tables[0].namedtuple_klass(**columns)
+
+
+class AuxTable:
+    ''' combined table of an aux service stored as a numpy structured array
+    together with a sorted index of its timestamps (in ms), such that the
+    rows at the time of events can be found with a searchsorted.
+    '''
+
+    def __init__(self, data, meta, name):
+        '''
+        :param data: structured array with a "timestamp" column, it can be a
+        read-only memory map.
+        :param meta: dictionary of the header of the table
+        :param name: name of the aux service
+        '''
+        self.data = data
+        self.meta = meta
+        self.colnames = list(data.dtype.names)
+        self.namedtuple_klass = namedtuple(name + "Row", self.colnames)
+        # the event timestamps are compared in ms as floats
+        self.timestamp = np.asarray(data['timestamp'], dtype=np.float64)
+        if np.any(np.diff(self.timestamp) < 0):
+            order = np.argsort(self.timestamp, kind='stable')
+            self.data = data[order]
+            self.timestamp = self.timestamp[order]
+        self._rows = {}
+
+    @classmethod
+    def from_table(cls, aux_table, name):
+        '''
+        :param aux_table: astropy.table.Table with a "timestamp" column, c.f.
+        combine_tables()
+        :param name: name of the aux service
+        '''
+        if aux_table.has_masked_columns:
+            aux_table = aux_table.filled()
+        data = _decode_bytes(np.asarray(aux_table.as_array()))
+        return cls(data, aux_table.meta, name)
+
+    def __len__(self):
+        return len(self.data)
+
+    def row_index(self, event_timestamp_in_ns):
+        ''' index of the last row before the event timestamp(s). The index
+        is -1 (the last row) for events before the first row.
+        '''
+        event_timestamp_in_ms = np.divide(event_timestamp_in_ns, 1e6)
+        return np.searchsorted(self.timestamp, event_timestamp_in_ms) - 1
+
+    def row(self, index):
+        ''' row of the table as a namedtuple. The namedtuples are built once
+        and shared by all the events falling on the same row.
+        '''
+        index = int(index) % len(self.data)
+        row = self._rows.get(index)
+        if row is None:
+            values = self.data[index]
+            row = self.namedtuple_klass(**{
+                name: values[name] for name in self.colnames
+            })
+            self._rows[index] = row
+        return row
+
+    def columns_at(self, event_timestamps_in_ns):
+        ''' namedtuple of the column arrays at the event timestamps '''
+        rows = self.data[self.row_index(event_timestamps_in_ns)]
         return self.namedtuple_klass(**{
-            name: row[name]
-            for name in table.colnames
+            name: rows[name] for name in self.colnames
         })
 
 
+def night_of(event_timestamp_in_ns):
+    ''' date of the night of an event, nights start at noon UTC
+    :param event_timestamp_in_ns: event timestamp in ns since the epoch
+    :return: datetime.date
+    '''
+    day = (int(event_timestamp_in_ns) - NIGHT_OFFSET_NS) // DAY_NS
+    return _day_to_date(day)
+
+
+def _day_to_date(day):
+    return EPOCH + timedelta(days=int(day))
+
+
+def _decode_bytes(data):
+    # astropy returns the values of bytes columns as str, so do we.
+    if not any(data.dtype[name].kind == 'S' for name in data.dtype.names):
+        return data
+    descr = []
+    for name in data.dtype.names:
+        dtype = data.dtype[name]
+        if dtype.kind == 'S':
+            dtype = np.dtype(('U{}'.format(dtype.base.itemsize),
+                              dtype.shape))
+        descr.append((name, dtype))
+    decoded = np.empty(data.shape, dtype=descr)
+    for name in data.dtype.names:
+        if data.dtype[name].kind == 'S':
+            decoded[name] = np.char.decode(data[name], 'ascii',
+                                           errors='replace')
+        else:
+            decoded[name] = data[name]
+    return decoded
+
+
 def read_table(path):
     ''' basically astropy.table.Table.read(path), but
     we need a "timestamp" column to syncronize with event times.
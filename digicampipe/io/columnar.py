@@ -0,0 +1,311 @@
+"""
+Columnar storage of R0 data.
+
+Raw data from any event source can be transcoded once into an HDF5 file
+(with extension ".r0.h5") laid out for fast repeated reading:
+
+- /events/<column>: one value per event for the event id, the camera event
+  number, the event types, the local camera clock and the gps time.
+- /blocks/<index>/adc_samples: uint16 waveforms of consecutive events
+  (n_events_in_block, n_pixels, n_samples)
+- /blocks/<index>/digicam_baseline: baselines of the same events
+  (n_events_in_block, n_pixels)
+
+Without compression, the block datasets are stored contiguously and are
+read as memory maps of the file, without any copy or decoding. With
+compression (gzip or lzf), the blocks are chunked and decompressed by h5py.
+"""
+import os
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from digicampipe.instrument.camera import DigiCam
+from digicampipe.io.containers import DataContainer, R0BlockContainer
+
+__all__ = ['write_columnar', 'columnar_event_source',
+           'columnar_block_source', 'columnar_path']
+
+FORMAT_NAME = 'digicampipe-r0'
+FORMAT_VERSION = 1
+EXTENSION = '.r0.h5'
+EVENT_COLUMNS = ('event_id', 'camera_event_number', 'camera_event_type',
+                 'array_event_type', 'local_camera_clock', 'gps_time')
+BLOCK_COLUMNS = {
+    'adc_samples': np.uint16,
+    'digicam_baseline': np.float64,
+}
+CHUNK_BYTES = 2 ** 20
+
+
+def write_columnar(blocks, path, compression=None, disable_bar=False):
+    """
+    Write a stream of blocks of events into a columnar file.
+    :param blocks: iterable of R0BlockContainer, c.f.
+    digicampipe.io.event_stream.block_stream()
+    :param path: path of the output file, it should end with ".r0.h5"
+    :param compression: None, "gzip" or "lzf". Only uncompressed files can be
+    memory mapped when read.
+    :param disable_bar: If set to true, the progress bar is not shown.
+    :return: number of events written
+    """
+    if compression not in (None, 'gzip', 'lzf'):
+        raise ValueError('compression must be None, "gzip" or "lzf", got '
+                         '{}'.format(compression))
+    n_events = 0
+    with h5py.File(path, 'w') as file:
+        file.attrs['format'] = FORMAT_NAME
+        file.attrs['version'] = FORMAT_VERSION
+        events = file.create_group('events')
+        for column in EVENT_COLUMNS:
+            events.create_dataset(column, shape=(0, ), maxshape=(None, ),
+                                  chunks=(4096, ), dtype=np.int64,
+                                  compression=compression)
+        blocks_group = file.create_group('blocks')
+
+        for block_index, block in enumerate(tqdm(blocks, desc='Blocks',
+                                                 disable=disable_bar)):
+            n_events_in_block = len(block)
+            if n_events_in_block == 0:
+                continue
+            if 'tel_id' not in file.attrs:
+                file.attrs['tel_id'] = block.tel_id
+                file.attrs['n_pixels'] = block.adc_samples.shape[1]
+                file.attrs['n_samples'] = block.adc_samples.shape[2]
+            for column in EVENT_COLUMNS:
+                dataset = events[column]
+                dataset.resize((n_events + n_events_in_block, ))
+                dataset[n_events:] = block[column]
+
+            group = blocks_group.create_group('{:08d}'.format(block_index))
+            group.attrs['first_event'] = n_events
+            for column, dtype in BLOCK_COLUMNS.items():
+                data = np.asarray(block[column], dtype=dtype)
+                chunks = None
+                if compression is not None:
+                    event_bytes = data[0].nbytes
+                    chunk_events = max(1, min(n_events_in_block,
+                                              CHUNK_BYTES // event_bytes))
+                    chunks = (chunk_events, ) + data.shape[1:]
+                group.create_dataset(column, data=data, chunks=chunks,
+                                     compression=compression)
+            n_events += n_events_in_block
+
+    return n_events
+
+
+class _ColumnarFile:
+    """
+    Read access to a columnar file. The event columns are loaded in memory
+    and the blocks are memory mapped when they are stored contiguously.
+    """
+
+    def __init__(self, url, mmap=True):
+        self.url = url
+        self.file = h5py.File(url, 'r')
+        if self.file.attrs.get('format') != FORMAT_NAME:
+            self.file.close()
+            raise ValueError('{} is not a {} file'.format(url, FORMAT_NAME))
+        self.tel_id = int(self.file.attrs.get('tel_id', 1))
+        self.events = {
+            column: self.file['events'][column][:] for column in EVENT_COLUMNS
+        }
+        self.n_events = len(self.events['event_id'])
+        self.blocks = [self.file['blocks'][name]
+                       for name in sorted(self.file['blocks'])]
+        self.block_starts = np.array(
+            [block.attrs['first_event'] for block in self.blocks] +
+            [self.n_events], dtype=np.int64)
+        self._mmap = None
+        if mmap:
+            self._mmap = np.memmap(url, dtype=np.uint8, mode='r')
+
+    def read_block(self, block_index):
+        """
+        :return: dictionary of the arrays of the block, they are memory maps
+        of the file if possible.
+        """
+        return {
+            column: self._read_dataset(self.blocks[block_index][column])
+            for column in BLOCK_COLUMNS
+        }
+
+    def _read_dataset(self, dataset):
+        offset = dataset.id.get_offset()
+        if self._mmap is None or offset is None or dataset.chunks:
+            return dataset[...]
+        return np.ndarray(dataset.shape, dtype=dataset.dtype,
+                          buffer=self._mmap, offset=offset)
+
+    def seek(self, event_id):
+        """
+        Find the row of the event `event_id`. If the exact event ID does not
+        exists the closest past event is taken. If the event ID is out of the
+        range of the file it raises an IndexError
+        """
+        event_numbers = self.events['camera_event_number']
+        if self.n_events == 0 or \
+                not event_numbers[0] <= event_id <= event_numbers[-1]:
+            raise IndexError('Cannot find event ID {} in File {}'.format(
+                event_id, self.url))
+        return int(np.searchsorted(event_numbers, event_id, side='right') - 1)
+
+    def iter_blocks(self, start, stop):
+        """
+        Iterate over the stored blocks of the events [start, stop)
+        :return: generator of (first event, arrays of the block)
+        """
+        first_block = np.searchsorted(self.block_starts, start,
+                                      side='right') - 1
+        for block_index in range(max(first_block, 0), len(self.blocks)):
+            block_start = self.block_starts[block_index]
+            block_stop = self.block_starts[block_index + 1]
+            if block_start >= stop:
+                break
+            arrays = self.read_block(block_index)
+            selection = slice(max(start - block_start, 0),
+                              min(stop, block_stop) - block_start)
+            yield max(start, block_start), {
+                column: array[selection] for column, array in arrays.items()
+            }
+
+    def close(self):
+        self._mmap = None
+        self.file.close()
+
+
+def _event_range(file, max_events, event_id):
+    start = 0 if event_id is None else file.seek(event_id)
+    stop = file.n_events
+    if max_events is not None:
+        stop = min(stop, start + max_events)
+    return start, stop
+
+
+def columnar_event_source(
+        url,
+        camera=DigiCam,
+        max_events=None,
+        event_id=None,
+        disable_bar=False,
+        mmap=True,
+):
+    """A generator that streams data from a columnar R0 file, c.f.
+    write_columnar()
+    Parameters
+    ----------
+    url : str
+        path to file to open
+    camera : digicampipe.instrument.Camera(), default DigiCam
+    max_events : int, optional
+        maximum number of events to read
+    event_id: int
+        Event id to start at. If the exact event ID does not exists
+        it will return the closest past event. If the event ID is out of the
+        range of the file it will raise an IndexError
+    disable_bar: If set to true, the progress bar is not shown.
+    mmap: If set to true, uncompressed blocks are memory mapped. The arrays
+    of the events are then read-only views of the file.
+    """
+    data = DataContainer()
+    file = _ColumnarFile(url, mmap=mmap)
+    try:
+        tel_id = file.tel_id
+        data.r0.tels_with_data = [tel_id, ]
+        data.inst.num_channels[tel_id] = 1
+        data.inst.num_pixels[tel_id] = file.file.attrs.get('n_pixels', 0)
+        data.inst.num_samples[tel_id] = file.file.attrs.get('n_samples', 0)
+        data.inst.geom[tel_id] = camera.geometry
+        data.inst.cluster_matrix_7[tel_id] = camera.cluster_7_matrix
+        data.inst.cluster_matrix_19[tel_id] = camera.cluster_19_matrix
+        data.inst.patch_matrix[tel_id] = camera.patch_matrix
+        r0 = data.r0.tel[tel_id]
+        events = file.events
+        start, stop = _event_range(file, max_events, event_id)
+
+        with tqdm(total=stop - start, desc='Events',
+                  disable=disable_bar) as bar:
+            for first_event, arrays in file.iter_blocks(start, stop):
+                adc_samples = arrays['adc_samples']
+                digicam_baseline = arrays['digicam_baseline']
+                for i in range(len(adc_samples)):
+                    row = first_event + i
+                    data.r0.event_id = events['event_id'][row]
+                    r0.camera_event_number = \
+                        events['camera_event_number'][row]
+                    r0.camera_event_type = int(
+                        events['camera_event_type'][row])
+                    r0.array_event_type = events['array_event_type'][row]
+                    r0.local_camera_clock = events['local_camera_clock'][row]
+                    r0.gps_time = events['gps_time'][row]
+                    r0.adc_samples = adc_samples[i]
+                    r0.digicam_baseline = digicam_baseline[i]
+                    bar.update(1)
+                    yield data
+    finally:
+        file.close()
+
+
+def columnar_block_source(
+        url,
+        block_size=None,
+        max_events=None,
+        event_id=None,
+        disable_bar=False,
+        mmap=True,
+):
+    """A generator that streams blocks of consecutive events from a columnar
+    R0 file, c.f. write_columnar()
+    Parameters
+    ----------
+    url : str
+        path to file to open
+    block_size : int, optional
+        number of events per block. If None, the blocks are the ones stored
+        in the file. Blocks are cut at the stored block boundaries, such that
+        their arrays are never copied.
+    max_events : int, optional
+        maximum number of events to read
+    event_id: int
+        Event id to start at, c.f. columnar_event_source()
+    disable_bar: If set to true, the progress bar is not shown.
+    mmap: If set to true, uncompressed blocks are memory mapped. The arrays
+    of the blocks are then read-only views of the file.
+
+    Returns
+    -------
+    A generator of `R0BlockContainer`.
+    """
+    file = _ColumnarFile(url, mmap=mmap)
+    try:
+        start, stop = _event_range(file, max_events, event_id)
+        with tqdm(total=stop - start, desc='Events',
+                  disable=disable_bar) as bar:
+            for first_event, arrays in file.iter_blocks(start, stop):
+                n_events = len(arrays['adc_samples'])
+                step = n_events if block_size is None else block_size
+                for i in range(0, n_events, step):
+                    block = R0BlockContainer()
+                    block.tel_id = file.tel_id
+                    rows = slice(first_event + i,
+                                 first_event + min(i + step, n_events))
+                    for column in EVENT_COLUMNS:
+                        block[column] = file.events[column][rows]
+                    for column, array in arrays.items():
+                        block[column] = array[i:i + step]
+                    bar.update(len(block))
+                    yield block
+    finally:
+        file.close()
+
+
+def columnar_path(path):
+    """
+    :return: default path of the columnar file of a raw data file
+    """
+    for extension in ('.fits.fz', '.simtel.gz', '.hdf5', '.h5'):
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+            break
+    return os.path.basename(path) + EXTENSION
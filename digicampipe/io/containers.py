@@ -29,6 +29,7 @@ __all__ = ['CameraEventType',
            'InstrumentContainer',
            'R0Container',
            'R0CameraContainer',
+           'R0BlockContainer',
            'R1Container',
            'R1CameraContainer',
            'DL0Container',
@@ -54,6 +55,50 @@ class CameraEventType(IntFlag):
     HILLAS = 0x20000  # camera server computed Hillas parametrs
 
 
+class _EventTypeIn:
+    # classes rather than lambdas such that the predicates can be sent to
+    # worker processes, c.f. digicampipe.io.parallel
+
+    def __init__(self, event_types):
+        self.event_types = frozenset(int(t) for t in event_types)
+
+    def __call__(self, event_type):
+        return int(event_type) in self.event_types
+
+
+class _EventTypeFlags:
+
+    def __init__(self, flags):
+        self.flags = [int(flag) for flag in flags]
+
+    def __call__(self, event_type):
+        event_type = int(event_type)
+        return any(event_type & flag == flag for flag in self.flags)
+
+
+def event_type_predicate(event_types):
+    """
+    Predicate on the camera event type of events
+    :param event_types: None, a function of the event type returning True
+    for the events to keep, or a list of event types to keep (the event type
+    must be one of them), c.f. event_type_flags()
+    :return: None if event_types is None, a function of the event type
+    otherwise.
+    """
+    if event_types is None or callable(event_types):
+        return event_types
+    return _EventTypeIn(event_types)
+
+
+def event_type_flags(flags):
+    """
+    :param flags: list of CameraEventType flags
+    :return: predicate keeping the events whose type contains at least one
+    of the flags, c.f. digicampipe.calib.filters.filter_event_types()
+    """
+    return _EventTypeFlags(flags)
+
+
 class InstrumentContainer(Container):
     """Storage of header info that does not change with event. This is a
     temporary hack until the Instrument module and database is fully
@@ -112,6 +157,48 @@ class DL1Container(Container):
     tel = Field(Map(DL1CameraContainer), "map of tel_id to DL1CameraContainer")
 
 
+def _lazy_field(name):
+    """
+    Property giving access to the field `name` of a container. If a callable
+    is stored in the field, it is called on the first access and its result
+    replaces it. Event sources use it to decode data only if it is used.
+    """
+
+    def getter(self):
+        value = getattr(self, name)
+        # unset fields hold their default type, which is callable too
+        if callable(value) and not isinstance(value, type):
+            value = value()
+            setattr(self, name, value)
+        return value
+
+    def setter(self, value):
+        setattr(self, name, value)
+
+    return property(getter, setter)
+
+
+def _public_fields(cls):
+    """
+    Class decorator listing the fields `_name` of a container accessed
+    through a property `name` under the name of the property, e.g. the ones
+    of _lazy_field(). items(), as_dict() and reset() then go through the
+    properties and the lazy values are resolved.
+    """
+
+    def public_name(name):
+        if name.startswith('_') and \
+                isinstance(getattr(cls, name[1:], None), property):
+            return name[1:]
+        return name
+
+    cls.fields = {
+        public_name(name): field for name, field in cls.fields.items()
+    }
+    return cls
+
+
+@_public_fields
 class R0CameraContainer(Container):
     """
     Storage of raw data from a single telescope
@@ -154,8 +241,9 @@ class R0CameraContainer(Container):
     adc_samples = Field(ndarray,
                         "numpy array containing ADC samples"
                         "(n_channels x n_pixels, n_samples)")
-    adc_sums = Field(ndarray, "numpy array containing integrated ADC data"
-                              "(n_channels, x n_pixels)")
+    _adc_sums = Field(ndarray, "numpy array containing integrated ADC data"
+                               "(n_channels, x n_pixels)")
+    adc_sums = _lazy_field('_adc_sums')
     baseline = Field(None, "number of time samples for telescope")
     digicam_baseline = Field(ndarray, 'Baseline computed by DigiCam')
     standard_deviation = Field(ndarray, "number of time samples for telescope")
@@ -174,15 +262,21 @@ class R0CameraContainer(Container):
 
     @camera_event_type.setter
     def camera_event_type(self, value):
-        self._camera_event_type = CameraEventType(value)
+        # unset fields hold their default type
+        if not isinstance(value, type):
+            value = CameraEventType(value)
+        self._camera_event_type = value
 
     array_event_type = Field(int, "array event type")
-    trigger_input_traces = Field(ndarray, "trigger patch trace (n_patches)")
+    _trigger_input_traces = Field(ndarray, "trigger patch trace (n_patches)")
+    trigger_input_traces = _lazy_field('_trigger_input_traces')
     trigger_input_offline = Field(ndarray, "trigger patch trace (n_patches)")
-    trigger_output_patch7 = Field(ndarray, "trigger 7 patch cluster trace \
-                                  (n_clusters)")
-    trigger_output_patch19 = Field(ndarray, "trigger 19 patch cluster trace \
+    _trigger_output_patch7 = Field(ndarray, "trigger 7 patch cluster trace \
                                    (n_clusters)")
+    trigger_output_patch7 = _lazy_field('_trigger_output_patch7')
+    _trigger_output_patch19 = Field(ndarray, "trigger 19 patch cluster trace \
+                                    (n_clusters)")
+    trigger_output_patch19 = _lazy_field('_trigger_output_patch19')
     trigger_input_7 = Field(ndarray, 'trigger input CLUSTER7')
     trigger_input_19 = Field(ndarray, 'trigger input CLUSTER19')
     num_samples = Field(int, "number of time samples for telescope")
@@ -199,6 +293,42 @@ class R0Container(Container):
     tel = Field(Map(R0CameraContainer), "map of tel_id to R0CameraContainer")
 
 
+class R0BlockContainer(Container):
+    """
+    Storage of a block of consecutive raw events from a single telescope.
+    Every array has the events along its first axis (n_events, ...).
+    """
+    tel_id = Field(None, 'telescope id')
+    event_id = Field(None, 'event id number (n_events, )')
+    camera_event_number = Field(None, 'camera event number (n_events, )')
+    camera_event_type = Field(None, 'camera event type (n_events, )')
+    array_event_type = Field(None, 'array event type (n_events, )')
+    local_camera_clock = Field(None, 'camera timestamp (n_events, )')
+    gps_time = Field(None, 'gps timestamp (n_events, )')
+    adc_samples = Field(None, 'ADC samples (n_events, n_pixels, n_samples)')
+    digicam_baseline = Field(None, 'Baseline computed by DigiCam '
+                                   '(n_events, n_pixels)')
+
+    def __len__(self):
+        if self.adc_samples is None:
+            return 0
+        return len(self.adc_samples)
+
+    def select(self, selection):
+        """
+        Select a subset of the events of the block.
+        :param selection: slice, indices or boolean mask applied along the
+        event axis of all the arrays
+        :return: a new R0BlockContainer
+        """
+        block = R0BlockContainer()
+        for key, value in self.items():
+            if isinstance(value, ndarray):
+                value = value[selection]
+            block[key] = value
+        return block
+
+
 class R1CameraContainer(Container):
     """
     Storage of r1 calibrated data from a single telescope
@@ -310,6 +440,9 @@ class CalibrationEventContainer(Container):
     baseline_std = Field(ndarray, 'Baseline std')
     pulse_mask = Field(ndarray, 'mask of adc_samples. True if the adc sample'
                                 'contains a pulse  else False')
+    filtered_samples = Field(ndarray, 'adc_samples correlated with the pulse '
+                                      'template, c.f. '
+                                      'digicampipe.calib.peak.MatchedFilter')
     reconstructed_amplitude = Field(ndarray, 'array of the same shape as '
                                              'adc_samples giving the'
                                              ' reconstructed pulse amplitude'
@@ -318,6 +451,8 @@ class CalibrationEventContainer(Container):
                                           'adc_samples giving the '
                                           'reconstructed charge for each adc '
                                           'sample')
+    pulse_charges = Field(None, 'charges of the pulses of pulse_mask, c.f. '
+                                'digicampipe.calib.charge.integrate_pulses')
     reconstructed_number_of_pe = Field(ndarray, 'estimated number of photon '
                                                 'electrons for each adc sample'
                                        )
@@ -347,6 +482,73 @@ class CalibrationEventContainer(Container):
         plt.legend()
 
 
+class CalibrationEventData:
+    """
+    Array-backed replacement of CalibrationEventContainer for long
+    calibration streams, c.f. calibration_event_stream(preallocate=True).
+
+    The fields are the ones of CalibrationEventContainer, stored in slots
+    instead of being looked up in the fields of a Container. The stages of
+    digicampipe.calib can write their results in place in the buffers given
+    by out() instead of allocating new arrays for every event, c.f.
+    out_buffer(). The buffers are allocated at the first event of the stream
+    and kept as long as the shape and the dtype of the results do not change,
+    such that the arrays of an event are overwritten by the next one.
+    """
+    __slots__ = tuple(CalibrationEventContainer.fields) + ('_buffers', )
+
+    def __init__(self):
+        for name, field in CalibrationEventContainer.fields.items():
+            setattr(self, name, field.default)
+        self._buffers = {}
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def keys(self):
+        return CalibrationEventContainer.fields.keys()
+
+    def items(self):
+        return ((name, getattr(self, name)) for name in self.keys())
+
+    def out(self, name, shape, dtype):
+        """
+        Buffer in which the field `name` can be written in place.
+        :param name: name of the field
+        :param shape: shape of the result
+        :param dtype: dtype of the result
+        :return: the buffer of the previous event if it has the same shape
+        and dtype, a new one otherwise. Its content is undefined.
+        """
+        buffer = self._buffers.get(name)
+        dtype = np.dtype(dtype)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    plot = CalibrationEventContainer.plot
+
+
+def out_buffer(data, name, shape, dtype):
+    """
+    Array in which a calibration stage writes the field `name` of event.data.
+    :param data: event.data, a CalibrationEventContainer or a
+    CalibrationEventData
+    :param name: name of the field
+    :param shape: shape of the result
+    :param dtype: dtype of the result
+    :return: the buffer of the field for CalibrationEventData, c.f.
+    CalibrationEventData.out(), a new array otherwise.
+    """
+    if isinstance(data, CalibrationEventData):
+        return data.out(name, tuple(shape), dtype)
+    return np.empty(shape, dtype=dtype)
+
+
 class CalibrationContainerMeta(Container):
     time = Field(float, 'time of the event')
     event_id = Field(int, 'event id')
@@ -362,10 +564,41 @@ class CalibrationContainer(Container):
     config = Field(list, 'List of the input parameters'
                          ' of the calibration analysis')  # Should use dict?
     pixel_id = Field(ndarray, 'pixel ids')
-    data = CalibrationEventContainer()
+    data = Field(CalibrationEventContainer(),
+                 'calibration data of the event, c.f. CalibrationEventData')
     event_id = Field(int, 'event_id')
     event_type = Field(CameraEventType, 'Event type')
     hillas = Field(HillasParametersContainer, 'Hillas parameters')
     info = CalibrationContainerMeta()
     slow_data = Field(None, "Slow Data Information")
+    slow_data_index = Field(int, 'row of the event in slow_data when it is a '
+                                 'SlowDataTable')
     mc = Field(MCEventContainer(), "Monte-Carlo data")
+
+
+class CalibrationBlockContainer(Container):
+    """
+    Block of consecutive events for the camera calibration pipeline, c.f.
+    digicampipe.io.event_stream.calibration_block_stream(). The fields of
+    data hold the values of the events stacked along their first axis
+    (n_events, ...), such that the stages of digicampipe.calib process the
+    whole block at once.
+    """
+    pixel_id = Field(ndarray, 'pixel ids')
+    data = Field(CalibrationEventContainer(),
+                 'calibration data of the events, (n_events, ...)')
+    event_id = Field(None, 'event ids (n_events, )')
+    event_type = Field(None, 'camera event types (n_events, )')
+
+    def __len__(self):
+        if self.event_id is None:
+            return 0
+        return len(self.event_id)
+
+    def per_event(self, value):
+        """
+        Repeat a value common to all the events of the block along a new
+        first axis, like the values of the fields of data.
+        """
+        value = np.asanyarray(value)
+        return np.repeat(value[np.newaxis], len(self), axis=0)
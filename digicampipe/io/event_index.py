@@ -0,0 +1,123 @@
+"""
+Random access to the events of a run by event id.
+
+An EventIndex maps the event ids of all the ZFITS files of a run to their
+file and row, using the on-disk index of each file (c.f.
+digicampipe.io.index). get_events() then reads only the requested rows of
+the files concerned instead of streaming the run from its start.
+"""
+import numpy as np
+
+from digicampipe.io.index import load_zfits_index, seek_position
+from digicampipe.io.parallel import parallel_file_stream
+from digicampipe.io.zfits import zfits_event_source
+
+__all__ = ['EventIndex', 'get_events']
+
+
+class EventIndex:
+    """
+    Index of the events of a list of ZFITS files, sorted by event id.
+    """
+
+    def __init__(self, files, index_dir=None):
+        """
+        :param files: list of paths of ZFITS files. The index of each file is
+        built the first time it is needed, c.f.
+        digicampipe.io.index.load_zfits_index()
+        :param index_dir: directory of the index files, if None they are
+        stored next to the data files.
+        """
+        if isinstance(files, (str, bytes)):
+            files = [files]
+        self.files = list(files)
+        indexes = [load_zfits_index(file, index_dir) for file in self.files]
+        empty = [np.zeros(0, dtype=np.int64)]
+        event_ids = np.concatenate(
+            [index['event_number'] for index in indexes] + empty
+        )
+        file_ids = np.concatenate([
+            np.full(len(index), i, dtype=np.int64)
+            for i, index in enumerate(indexes)
+        ] + empty)
+        rows = np.concatenate([index['row'] for index in indexes] + empty)
+        order = np.argsort(event_ids, kind='stable')
+        self.event_ids = event_ids[order]
+        self.file_ids = file_ids[order]
+        self.rows = rows[order]
+
+    def __len__(self):
+        return len(self.event_ids)
+
+    def position(self, event_id):
+        """
+        position of an event in the index. If the exact event ID does not
+        exists the closest past event is taken. If the event ID is out of the
+        range of the run it raises an IndexError
+        """
+        return seek_position(self.event_ids, event_id, 'the run')
+
+    def locate(self, event_ids):
+        """
+        Find the files and the rows of events.
+        :param event_ids: list of event ids, all of them must be in the run
+        :return: (paths of the files, rows in the files) of the events
+        """
+        event_ids = np.asarray(event_ids, dtype=np.int64)
+        positions = np.searchsorted(self.event_ids, event_ids)
+        found = positions < len(self.event_ids)
+        found[found] = self.event_ids[positions[found]] == event_ids[found]
+        if not np.all(found):
+            raise IndexError('Cannot find event IDs {} in the run'.format(
+                event_ids[~found][:10].tolist()))
+        return (
+            [self.files[i] for i in self.file_ids[positions]],
+            self.rows[positions],
+        )
+
+
+def get_events(files, event_ids, n_workers=1, index=None, index_dir=None,
+               disable_bar=True, **kwargs):
+    """
+    Read the events with the given ids from a list of ZFITS files, without
+    reading the other events.
+    :param files: list of paths of ZFITS files, c.f. EventIndex
+    :param event_ids: ids of the events to read. They must all be in the
+    files.
+    :param n_workers: number of files read at the same time in separate
+    processes, c.f. digicampipe.io.parallel.parallel_file_stream()
+    :param index: EventIndex of the files. If None it is created.
+    :param index_dir: directory of the index files, c.f. EventIndex
+    :param disable_bar: If set to true, the progress bar is not shown.
+    :param kwargs: parameters for zfits_event_source(), e.g. pixel_id or
+    fields
+    :return: generator of the events sorted by event id. Like for
+    event_stream(), the same container is filled for every event.
+    """
+    if index is None:
+        index = EventIndex(files, index_dir=index_dir)
+    event_ids = np.unique(np.asarray(event_ids, dtype=np.int64))
+    if len(event_ids) == 0:
+        return
+    paths, rows = index.locate(event_ids)
+    # read the files by increasing event id, and their rows in that order
+    filelist = []
+    file_kwargs = []
+    for path, row in zip(paths, rows):
+        if not filelist or filelist[-1] != path:
+            filelist.append(path)
+            file_kwargs.append({'rows': []})
+        file_kwargs[-1]['rows'].append(int(row))
+    if n_workers > 1 and len(filelist) > 1:
+        data_stream = parallel_file_stream(
+            filelist, zfits_event_source, n_workers, disable_bar=disable_bar,
+            file_kwargs=file_kwargs, **kwargs
+        )
+        try:
+            yield from data_stream
+        finally:
+            data_stream.close()
+        return
+    for path, extra_kwargs in zip(filelist, file_kwargs):
+        yield from zfits_event_source(url=path, disable_bar=disable_bar,
+                                      **dict(kwargs, **extra_kwargs))
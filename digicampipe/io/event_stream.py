@@ -4,13 +4,22 @@ from collections import namedtuple
 import numpy as np
 from tqdm import tqdm
 
-from digicampipe.io import zfits, hdf5, simtel
-from digicampipe.io.containers import CalibrationContainer
-from .auxservice import AuxService
+from digicampipe.io import zfits, hdf5, simtel, columnar
+from digicampipe.io.containers import CalibrationBlockContainer, \
+    CalibrationContainer, CalibrationEventData, CameraEventType, \
+    R0BlockContainer, event_type_predicate, out_buffer
+from digicampipe.io.index import load_zfits_index
+from digicampipe.io.parallel import parallel_file_stream
+from .auxservice import AuxService, night_of
+from .slow_data import SlowDataTable
+
+# R0 fields used by calibration_event_stream()
+CALIBRATION_FIELDS = ('adc_samples', 'digicam_baseline', 'gps_time')
 
 
 def event_stream(filelist, source=None, max_events=None, disable_bar=False,
-                 event_id_range=(None, None), **kwargs):
+                 event_id_range=(None, None), n_workers=1, use_index=False,
+                 index_dir=None, event_types=None, **kwargs):
     """Iterable of events in the form of `DataContainer`.
 
     Parameters
@@ -23,10 +32,28 @@ def event_stream(filelist, source=None, max_events=None, disable_bar=False,
             * digicampipe.io.zfits.zfits_event_source
             * digicampipe.io.hdf5.digicamtoy_event_source
             * digicampipe.io.hessio_digicam.hessio_event_source
+            * digicampipe.io.columnar.columnar_event_source
     max_events: max_events to iterate over
     event_id_range: minimum and maximum event id to be returned. Set one of
     them to None to disable that limit.
     disable_bar: If set to true, the progress bar is not shown.
+    n_workers: number of files decoded at the same time in separate
+    processes. The events are merged back by event number, c.f.
+    digicampipe.io.parallel.parallel_file_stream(). ZFITS files are split in
+    chunks of events decoded in parallel, except the ones starting at an
+    event id and, with use_index, the ones whose event types are selected
+    through the index.
+    use_index: If set to true, the on-disk index of ZFITS files is used to
+    skip the files outside of `event_id_range` and to start reading directly
+    at `event_id_range[0]`. The index of a file is built the first time it is
+    needed, c.f. digicampipe.io.index.load_zfits_index()
+    index_dir: directory of the index files, if None they are stored next to
+    the data files.
+    event_types: list of the camera event types to keep or function of the
+    camera event type returning True for the events to keep, c.f.
+    digicampipe.io.containers.event_type_predicate(). For ZFITS files, the
+    rejected events are skipped before their waveforms are copied, and with
+    use_index they are not read at all, c.f. zfits_event_source().
     kwargs: parameters for event_source
         Some event_sources need special parameters to work, c.f. their doc.
     """
@@ -47,6 +74,64 @@ def event_stream(filelist, source=None, max_events=None, disable_bar=False,
     if max_events is None:
         max_events = np.inf
 
+    keep_event_type = event_type_predicate(event_types)
+    if keep_event_type is not None and _is_zfits(filelist, source):
+        kwargs['event_types'] = keep_event_type
+        keep_event_type = None
+
+    file_kwargs = None
+    if use_index and _is_zfits(filelist, source):
+
+        kwargs.update(use_index=True, index_dir=index_dir)
+        if any(event_id_range):
+            filelist, file_kwargs = _select_files_with_index(
+                filelist, event_id_range, index_dir)
+            n_files = len(filelist)
+
+    if n_workers > 1 and n_files > 1:
+
+        if source is None:
+            source = guess_source_from_path(filelist[0])
+        count_events = None
+        if source is zfits.zfits_event_source and \
+                not (use_index and 'event_types' in kwargs):
+            count_events = _count_zfits_events
+        data_stream = parallel_file_stream(filelist, source, n_workers,
+                                           disable_bar=disable_bar,
+                                           file_kwargs=file_kwargs,
+                                           count_events=count_events,
+                                           **kwargs)
+
+    else:
+
+        data_stream = _sequential_file_stream(filelist, source, disable_bar,
+                                              file_kwargs=file_kwargs,
+                                              **kwargs)
+    try:
+        for event in data_stream:
+            tel = list(event.r0.tels_with_data)[0]
+            event_id = event.r0.tel[tel].camera_event_number
+            if event_id_range[0] and event_id <= event_id_range[0]:
+                continue
+            if event_id_range[1] and event_id > event_id_range[1]:
+                return
+            if keep_event_type is not None and \
+                    not keep_event_type(event.r0.tel[tel].camera_event_type):
+                continue
+            if count >= max_events:
+                return
+            count += 1
+            yield event
+    finally:
+        data_stream.close()
+
+
+def _sequential_file_stream(filelist, source, disable_bar, file_kwargs=None,
+                            **kwargs):
+    n_files = len(filelist)
+    if file_kwargs is None:
+        file_kwargs = [{}] * n_files
+
     if n_files == 1:
 
         file_stream = filelist
@@ -55,21 +140,13 @@ def event_stream(filelist, source=None, max_events=None, disable_bar=False,
 
         file_stream = tqdm(filelist, total=n_files, desc='Files', leave=True,
                            disable=disable_bar)
-    for file in file_stream:
+    for file, extra_kwargs in zip(file_stream, file_kwargs):
         if source is None:
             source = guess_source_from_path(file)
-        data_stream = source(url=file, disable_bar=disable_bar, **kwargs)
+        data_stream = source(url=file, disable_bar=disable_bar,
+                             **dict(kwargs, **extra_kwargs))
         try:
             for event in data_stream:
-                tel = list(event.r0.tels_with_data)[0]
-                event_id = event.r0.tel[tel].camera_event_number
-                if event_id_range[0] and event_id <= event_id_range[0]:
-                    continue
-                if event_id_range[1] and event_id > event_id_range[1]:
-                    raise StopIteration
-                if count >= max_events:
-                    raise StopIteration
-                count += 1
                 yield event
         except EOFError as e:
             print('WARNING: unexpected end of file', file, ':', e)
@@ -77,43 +154,315 @@ def event_stream(filelist, source=None, max_events=None, disable_bar=False,
             print('WARNING: system error.', e)
 
 
+def _is_zfits(filelist, source):
+    if source is None:
+        return all(file.endswith('.fits.fz') for file in filelist)
+    return source is zfits.zfits_event_source
+
+
+def _count_zfits_events(url):
+    return zfits.count_number_events([url])
+
+
+def _select_files_with_index(filelist, event_id_range, index_dir):
+    """
+    Use the index of the files to keep only the ones with events in
+    `event_id_range`. For the files containing the lower limit of the range,
+    the event to start with is given.
+    :return: the list of selected files and the list of the additional
+    parameters of the event source for each of them.
+    """
+    lower, upper = event_id_range
+    selected_files = []
+    file_kwargs = []
+    for file in filelist:
+        event_numbers = load_zfits_index(file, index_dir)['event_number']
+        if len(event_numbers) == 0:
+            continue
+        if lower and event_numbers[-1] <= lower:
+            continue
+        if upper and event_numbers[0] > upper:
+            continue
+        extra_kwargs = {}
+        if lower and event_numbers[0] <= lower:
+            first = np.searchsorted(event_numbers, lower, side='right')
+            extra_kwargs['event_id'] = int(event_numbers[first])
+        selected_files.append(file)
+        file_kwargs.append(extra_kwargs)
+    return selected_files, file_kwargs
+
+
 def calibration_event_stream(path,
                              pixel_id=[...],
                              max_events=None,
                              event_id_range=(None, None),
                              disable_bar=False,
+                             preallocate=False,
                              **kwargs):
     """
     Event stream for the calibration of the camera based on the observation
     event_stream()
+    For ZFITS files, the pixel selection is done while decoding and only the
+    fields used for the calibration are read, c.f.
+    digicampipe.io.zfits.zfits_event_source()
+    If preallocate is True, event.data is a CalibrationEventData and the
+    calibration stages write their results in place in its buffers. The
+    arrays of event.data are then overwritten by the next event and must be
+    copied to be kept.
     """
+    if isinstance(path, (str, bytes)):
+        path = [path]
+    push_down = _is_zfits(path, kwargs.get('source'))
+    if push_down:
+        kwargs.update(pixel_id=pixel_id, fields=CALIBRATION_FIELDS)
     container = CalibrationContainer()
+    if preallocate:
+        container.data = CalibrationEventData()
     for event in event_stream(path, max_events=max_events,
                               event_id_range=event_id_range,
                               disable_bar=disable_bar, **kwargs):
-        r0_event = list(event.r0.tel.values())[0]
-        container.pixel_id = np.arange(r0_event.adc_samples.shape[0])[pixel_id]
+        tel_id, r0_event = list(event.r0.tel.items())[0]
+        if push_down:
+            n_pixels = event.inst.num_pixels[tel_id]
+            adc_samples = r0_event.adc_samples
+            digicam_baseline = r0_event.digicam_baseline
+        else:
+            n_pixels = r0_event.adc_samples.shape[0]
+            adc_samples = r0_event.adc_samples[pixel_id]
+            digicam_baseline = r0_event.digicam_baseline[pixel_id]
+        container.pixel_id = np.arange(n_pixels)[pixel_id]
         container.event_type = r0_event.camera_event_type
-        container.data.adc_samples = r0_event.adc_samples[pixel_id]
-        container.data.digicam_baseline = r0_event.digicam_baseline[pixel_id]
+        container.data.adc_samples = adc_samples
+        container.data.digicam_baseline = digicam_baseline
         container.data.local_time = r0_event.local_camera_clock
         container.data.gps_time = r0_event.gps_time
-        container.data.cleaning_mask = \
-            np.ones(container.data.adc_samples.shape[0], dtype=bool)
+        cleaning_mask = out_buffer(container.data, 'cleaning_mask',
+                                   adc_samples.shape[:1], bool)
+        cleaning_mask[:] = True
+        container.data.cleaning_mask = cleaning_mask
         container.event_id = r0_event.camera_event_number
         container.mc = event.mc
         yield container
 
 
+def calibration_block_stream(path,
+                             pixel_id=[...],
+                             block_size=1000,
+                             max_events=None,
+                             event_id_range=(None, None),
+                             disable_bar=False,
+                             preallocate=False,
+                             **kwargs):
+    """
+    Block stream for the calibration of the camera: like
+    calibration_event_stream() but for blocks of block_size consecutive
+    events read by block_stream(). Each block is a CalibrationBlockContainer
+    which the stages of digicampipe.calib process as a whole, the
+    results being the same as for the events.
+    Use unstack_calibration_blocks() to go back to an event stream.
+    If preallocate is True, the data of the blocks is a
+    CalibrationEventData, c.f. calibration_event_stream().
+    """
+    container = CalibrationBlockContainer()
+    if preallocate:
+        container.data = CalibrationEventData()
+    for block in block_stream(path, block_size=block_size,
+                              max_events=max_events,
+                              event_id_range=event_id_range,
+                              disable_bar=disable_bar, **kwargs):
+        n_pixels = block.adc_samples.shape[1]
+        pixel_ids = np.arange(n_pixels)[pixel_id]
+        adc_samples = block.adc_samples
+        digicam_baseline = block.digicam_baseline
+        if not np.array_equal(pixel_ids, np.arange(n_pixels)):
+            adc_samples = adc_samples[:, pixel_ids]
+            digicam_baseline = digicam_baseline[:, pixel_ids]
+        container.pixel_id = pixel_ids
+        container.event_id = block.camera_event_number
+        container.event_type = block.camera_event_type
+        container.data.adc_samples = adc_samples
+        container.data.digicam_baseline = digicam_baseline
+        container.data.local_time = block.local_camera_clock
+        container.data.gps_time = block.gps_time
+        cleaning_mask = out_buffer(container.data, 'cleaning_mask',
+                                   adc_samples.shape[:2], bool)
+        cleaning_mask[:] = True
+        container.data.cleaning_mask = cleaning_mask
+        yield container
+
+
+def unstack_calibration_blocks(blocks):
+    """
+    Iterate over the events of a stream of CalibrationBlockContainer, e.g.
+    to apply the stages of digicampipe.calib which need single events.
+    :param blocks: stream of CalibrationBlockContainer, c.f.
+    calibration_block_stream()
+    :return: generator of CalibrationContainer. The same container is filled
+    for every event and its arrays are views of the ones of the block.
+    """
+    container = CalibrationContainer()
+    for block in blocks:
+        container.pixel_id = block.pixel_id
+        fields = [
+            (name, value) for name, value in block.data.items()
+            if isinstance(value, np.ndarray)
+        ]
+        for i in range(len(block)):
+            container.event_id = block.event_id[i]
+            container.event_type = CameraEventType(block.event_type[i])
+            for name, value in fields:
+                container.data[name] = value[i]
+            yield container
+
+
+def block_stream(filelist, block_size=100, source=None, max_events=None,
+                 disable_bar=False, event_id_range=(None, None), **kwargs):
+    """Iterable of blocks of consecutive events in the form of
+    `R0BlockContainer`.
+
+    Parameters
+    ----------
+    filelist : list-like of paths, or a single path(string).
+    block_size: number of events per block. Blocks can be smaller at the end
+    of a file or when events are rejected by `event_id_range`.
+    source: function-like or None
+        the function to be used for reading the blocks.
+        If not specified it is guessed, c.f. guess_block_source_from_path()
+    max_events: max_events to iterate over
+    event_id_range: minimum and maximum event id to be returned. Set one of
+    them to None to disable that limit.
+    disable_bar: If set to true, the progress bar is not shown.
+    kwargs: parameters for the block source
+    """
+    if isinstance(filelist, (str, bytes)):
+        filelist = [filelist]
+    n_files = len(filelist)
+    count = 0
+
+    for file in filelist:
+
+        if not os.path.exists(file):
+            raise FileNotFoundError('File {} does not exists'.format(file))
+
+    if max_events is None:
+        max_events = np.inf
+
+    if n_files == 1:
+
+        file_stream = filelist
+
+    else:
+
+        file_stream = tqdm(filelist, total=n_files, desc='Files', leave=True,
+                           disable=disable_bar)
+    for file in file_stream:
+        if source is None:
+            source = guess_block_source_from_path(file)
+        blocks = source(url=file, block_size=block_size,
+                        disable_bar=disable_bar, **kwargs)
+        try:
+            for block in blocks:
+                event_id = block.camera_event_number
+                selection = np.ones(len(block), dtype=bool)
+                last_block = False
+                if event_id_range[0]:
+                    selection &= event_id > event_id_range[0]
+                if event_id_range[1]:
+                    above_range = event_id > event_id_range[1]
+                    last_block = np.any(above_range)
+                    selection &= ~above_range
+                selection &= np.cumsum(selection) <= max_events - count
+                last_block |= count + np.sum(selection) >= max_events
+                if not np.all(selection):
+                    block = block.select(selection)
+                count += len(block)
+                if len(block) > 0:
+                    yield block
+                if last_block:
+                    return
+        except EOFError as e:
+            print('WARNING: unexpected end of file', file, ':', e)
+        except SystemError as e:
+            print('WARNING: system error.', e)
+
+
 def guess_source_from_path(path):
     if path.endswith('.fits.fz'):
         return zfits.zfits_event_source
+    elif path.endswith(columnar.EXTENSION):
+        return columnar.columnar_event_source
     elif path.endswith('.h5') or path.endswith('.hdf5'):
         return hdf5.digicamtoy_event_source
     else:
         return simtel.simtel_event_source
 
 
+def guess_block_source_from_path(path):
+    if path.endswith('.fits.fz'):
+        return zfits.zfits_block_source
+    elif path.endswith(columnar.EXTENSION):
+        return columnar.columnar_block_source
+    elif path.endswith('.h5') or path.endswith('.hdf5'):
+        return hdf5.digicamtoy_block_source
+    else:
+        event_source = guess_source_from_path(path)
+
+        def block_source(url, block_size, **kwargs):
+            events = event_source(url=url, **kwargs)
+            return stack_events(events, block_size)
+
+        return block_source
+
+
+def stack_events(events, block_size):
+    """
+    Stack the raw data of consecutive events (DataContainer) into blocks.
+    This allows to use event sources without a native block mode with
+    block_stream().
+    :param events: a stream of DataContainer
+    :param block_size: number of events per block
+    :return: a generator of R0BlockContainer, the container and its arrays
+    are re-used for each block.
+    """
+    block = R0BlockContainer()
+    fields = ['camera_event_number', 'camera_event_type', 'array_event_type',
+              'local_camera_clock', 'gps_time', 'adc_samples',
+              'digicam_baseline']
+    index_in_block = 0
+
+    for event in events:
+        tel_id = list(event.r0.tels_with_data)[0]
+        r0 = event.r0.tel[tel_id]
+
+        if block.adc_samples is None:
+            block.tel_id = tel_id
+            block.event_id = np.zeros(block_size, dtype=np.int64)
+            for field in fields:
+                value = np.asarray(_field_value(r0, field))
+                block[field] = np.zeros((block_size, ) + value.shape,
+                                        dtype=value.dtype)
+
+        block.event_id[index_in_block] = event.r0.event_id
+        for field in fields:
+            block[field][index_in_block] = _field_value(r0, field)
+        index_in_block += 1
+
+        if index_in_block == block_size:
+            yield block
+            index_in_block = 0
+
+    if 0 < index_in_block < block_size:
+        yield block.select(slice(0, index_in_block))
+
+
+def _field_value(container, field):
+    value = container[field]
+    # fields not filled by the event source still hold their default type
+    if value is None or isinstance(value, type):
+        return 0
+    return value
+
+
 def add_slow_data(
         data_stream,
         aux_services=(
@@ -123,10 +472,11 @@ def add_slow_data(
             'SafetyPLC',
             'DriveSystem',
         ),
-        basepath=None
+        basepath=None,
+        cache_dir=None,
 ):
     services = {
-        name: AuxService(name, basepath)
+        name: AuxService(name, basepath, cache_dir=cache_dir)
         for name in aux_services
     }
     SlowDataContainer = namedtuple('SlowDataContainer', aux_services)
@@ -149,10 +499,11 @@ def add_slow_data_calibration(
             'SafetyPLC',
             'DriveSystem',
         ),
-        basepath=None
+        basepath=None,
+        cache_dir=None,
 ):
     services = {
-        name: AuxService(name, basepath)
+        name: AuxService(name, basepath, cache_dir=cache_dir)
         for name in aux_services
     }
     SlowDataContainer = namedtuple('SlowDataContainer', aux_services)
@@ -163,3 +514,49 @@ def add_slow_data_calibration(
         }
         event.slow_data = SlowDataContainer(**services_event)
         yield event
+
+
+def join_slow_data_calibration(
+        data_stream,
+        aux_services=(
+            'DigicamSlowControl',
+            'MasterSST1M',
+            'PDPSlowControl',
+            'SafetyPLC',
+            'DriveSystem',
+        ),
+        basepath=None,
+        quantities=None,
+        cache_dir=None,
+):
+    """
+    Join the quantities derived from the slow control to a calibration
+    event stream. The quantities are computed once per slow control row, c.f.
+    digicampipe.io.slow_data.SlowDataTable. event.slow_data is the table of
+    the night of the event and event.slow_data_index the row of the event in
+    the table, such that event.slow_data.row(event.slow_data_index) gives the
+    quantities at the time of the event.
+    :param data_stream: calibration event stream
+    :param aux_services: names of the services to read
+    :param basepath: directory of the aux files
+    :param quantities: names of the quantities to compute, c.f.
+    digicampipe.io.slow_data.DERIVED_QUANTITIES. If None, all the quantities
+    of the services are computed.
+    :param cache_dir: directory of the on-disk cache of the aux tables, c.f.
+    digicampipe.io.auxservice.AuxService. If None, nothing is cached.
+    """
+    services = {
+        name: AuxService(name, basepath, cache_dir=cache_dir)
+        for name in aux_services
+    }
+    tables = {}
+    for event in data_stream:
+        timestamp = event.data.local_time
+        date = night_of(timestamp)
+        table = tables.get(date)
+        if table is None:
+            table = SlowDataTable(services, date, quantities)
+            tables[date] = table
+        event.slow_data = table
+        event.slow_data_index = table.row_index(timestamp)
+        yield event
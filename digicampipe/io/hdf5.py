@@ -1,14 +1,139 @@
 import h5py
 import numpy as np
 from tqdm import tqdm
-import warnings
 
 from digicampipe.instrument.camera import DigiCam
-from digicampipe.io.containers import DataContainer
+from digicampipe.io.containers import DataContainer, R0BlockContainer
 from digicampipe.io.containers import CameraEventType
 
 
-__all__ = ['digicamtoy_event_source']
+__all__ = ['digicamtoy_event_source', 'digicamtoy_block_source']
+
+
+def _open_dataset(hdf5, url, name, mmap=False):
+    """
+    Get a dataset of the file. Contiguous and uncompressed datasets are
+    memory mapped, the others are returned as h5py datasets.
+    """
+    dataset = hdf5['data'][name]
+    offset = dataset.id.get_offset()
+    if not mmap or dataset.chunks is not None or offset is None:
+        return dataset
+    return np.memmap(url, dtype=dataset.dtype, mode='r', offset=offset,
+                     shape=dataset.shape)
+
+
+def _iter_slabs(dataset, start, stop, slab_size):
+    """
+    Read the events [start, stop) of a dataset by slabs of consecutive
+    events. The slab boundaries are aligned to the HDF5 chunks of the
+    dataset such that every chunk is decompressed only once.
+    :return: generator of (first event, array of the slab)
+    """
+    chunks = getattr(dataset, 'chunks', None)
+    if chunks is not None:
+        chunk_events = chunks[0]
+        slab_size = -(-slab_size // chunk_events) * chunk_events
+    first_event = start
+    while first_event < stop:
+        last_event = min((first_event // slab_size + 1) * slab_size, stop)
+        yield first_event, dataset[first_event:last_event]
+        first_event = last_event
+
+
+def _iter_blocks(slabs, block_size):
+    """
+    Regroup slabs of consecutive events into blocks of block_size events,
+    only the last block can be shorter. A block within a slab is a view of
+    it, a block overlapping two slabs is a copy.
+    :param slabs: generator of (first event, waveforms, baselines), c.f.
+    _DigicamToyFile.iter_slabs()
+    :return: generator of (first event, waveforms, baselines) of the blocks
+    """
+    pieces = []
+    n_pending = 0
+    for first_event, adc_count, baseline in slabs:
+        i = 0
+        while i < len(adc_count):
+            n_events = min(block_size - n_pending, len(adc_count) - i)
+            if baseline.ndim > 1:
+                piece_baseline = baseline[i:i + n_events]
+            else:
+                piece_baseline = baseline
+            pieces.append((first_event + i, adc_count[i:i + n_events],
+                           piece_baseline))
+            n_pending += n_events
+            i += n_events
+            if n_pending == block_size:
+                yield _join_pieces(pieces)
+                pieces = []
+                n_pending = 0
+    if pieces:
+        yield _join_pieces(pieces)
+
+
+def _join_pieces(pieces):
+    first_event, adc_count, baseline = pieces[0]
+    if len(pieces) == 1:
+        return first_event, adc_count, baseline
+    adc_count = np.concatenate([piece[1] for piece in pieces])
+    if baseline.ndim > 1:
+        baseline = np.concatenate([piece[2] for piece in pieces])
+    return first_event, adc_count, baseline
+
+
+def _event_range(n_events, max_events, event_id, url):
+    start = 0
+    if event_id is not None:
+        if not 0 <= event_id < n_events:
+            raise IndexError('Cannot find event ID {} in File {}\n'
+                             'First event ID : 0\n'
+                             'Last event ID : {}'.format(event_id, url,
+                                                         n_events - 1))
+        start = event_id
+    stop = n_events
+    if max_events is not None:
+        stop = min(stop, start + max_events)
+    return start, stop
+
+
+class _DigicamToyFile:
+    """
+    Access to the waveforms and to the baselines of a DigicamToy file
+    """
+
+    def __init__(self, url, mmap=False):
+        self.hdf5 = h5py.File(url, 'r')
+        self.adc_count = _open_dataset(self.hdf5, url, 'adc_count', mmap)
+        self.n_events, self.n_pixels, self.n_samples = self.adc_count.shape
+        self.baseline = None
+        if 'true_baseline' in self.hdf5['data'].keys():
+            self.baseline = _open_dataset(self.hdf5, url, 'true_baseline',
+                                          mmap)
+
+    def iter_slabs(self, start, stop, slab_size):
+        """
+        :return: generator of (first event, waveforms, baselines) of slabs
+        of consecutive events. The baselines are (n_pixels, ) if they are the
+        same for all the events of the file.
+        """
+        if self.baseline is None:
+            constant_baseline = np.zeros(self.n_pixels)
+        elif self.baseline.ndim == 1:
+            constant_baseline = np.array(self.baseline)
+        else:
+            constant_baseline = None
+        for first_event, adc_count in _iter_slabs(self.adc_count, start,
+                                                  stop, slab_size):
+            if constant_baseline is not None:
+                baseline = constant_baseline
+            else:
+                baseline = self.baseline[first_event:
+                                         first_event + len(adc_count)]
+            yield first_event, adc_count, baseline
+
+    def close(self):
+        self.hdf5.close()
 
 
 def digicamtoy_event_source(
@@ -17,7 +142,8 @@ def digicamtoy_event_source(
         max_events=None,
         chunk_size=150,
         event_id=None,
-        disable_bar=False
+        disable_bar=False,
+        mmap=False,
 ):
     """A generator that streams data from an HDF5 data file from DigicamToy
     Parameters
@@ -27,65 +153,114 @@ def digicamtoy_event_source(
     max_events : int, optional
         maximum number of events to read
     camera : utils.Camera() default: utils.DigiCam
-    chunk_size : Number of events to load into the memory at once
-    event_id : TODO
+    chunk_size : Number of events to load into the memory at once. It is
+    rounded up to a multiple of the HDF5 chunks of the file.
+    event_id : int
+        Event id to start at. The event ids of DigicamToy files are the index
+        of the events in the file. If the event ID is out of the range of the
+        file it will raise an IndexError
     disable_bar: If set to true, the progress bar is not shown.
+    mmap: If set to true, contiguous and uncompressed datasets are memory
+    mapped instead of being read. The waveforms and baselines are then
+    read-only arrays, which stages modifying them in place (e.g.
+    digicampipe.calib.filters.set_pixels_to_zero()) cannot use.
     """
-
-    if event_id is not None:
-
-        warnings.warn('The event id search is not implemented for this'
-                      ' type of file')
-
     data = DataContainer()
-    hdf5 = h5py.File(url, 'r')
-
-    full_data_set = hdf5['data']['adc_count']
-    n_events, n_pixels, n_samples = full_data_set.shape
-
-    if 'true_baseline' in hdf5['data'].keys():
-
-        baseline = np.array(hdf5['data']['true_baseline'])
-    else:
-
-        baseline = np.zeros(n_pixels)
-
-    if max_events is None:
-        max_events = n_events
-
-    max_events = min(max_events, n_events)
-    for event_id in tqdm(range(max_events), desc='Events',
-                         disable=disable_bar):
-
-        data.r0.event_id = event_id
-        data.r0.tels_with_data = [1, ]
-
-        for tel_id in data.r0.tels_with_data:
+    file = _DigicamToyFile(url, mmap=mmap)
+    try:
+        start, stop = _event_range(file.n_events, max_events, event_id, url)
+        tel_id = 1
+        data.r0.tels_with_data = [tel_id, ]
+        data.inst.num_channels[tel_id] = 1
+        data.inst.num_pixels[tel_id] = file.n_pixels
+        data.inst.geom[tel_id] = camera.geometry
+        data.inst.cluster_matrix_7[tel_id] = camera.cluster_7_matrix
+        data.inst.cluster_matrix_19[tel_id] = camera.cluster_19_matrix
+        data.inst.patch_matrix[tel_id] = camera.patch_matrix
+        data.inst.num_samples[tel_id] = file.n_samples
+        r0 = data.r0.tel[tel_id]
+        r0.camera_event_type = CameraEventType.INTERNAL
+        r0.array_event_type = CameraEventType.UNKNOWN
 
-            if event_id == 0:
-                data.inst.num_channels[tel_id] = 1
-                data.inst.num_pixels[tel_id] = n_pixels
-                data.inst.geom[tel_id] = camera.geometry
-                data.inst.cluster_matrix_7[tel_id] = camera.cluster_7_matrix
-                data.inst.cluster_matrix_19[tel_id] = camera.cluster_19_matrix
-                data.inst.patch_matrix[tel_id] = camera.patch_matrix
-                data.inst.num_samples[tel_id] = n_samples
-                data.r0.tel[tel_id].digicam_baseline = baseline
-                data.r0.tel[tel_id].camera_event_type = \
-                    CameraEventType.INTERNAL
-                data.r0.tel[tel_id].array_event_type = CameraEventType.UNKNOWN
+        with tqdm(total=stop - start, desc='Events',
+                  disable=disable_bar) as bar:
+            for first_event, adc_count, baseline in file.iter_slabs(
+                    start, stop, chunk_size):
+                for index_in_chunk in range(len(adc_count)):
+                    event_id = first_event + index_in_chunk
+                    data.r0.event_id = event_id
+                    r0.camera_event_number = event_id
+                    r0.local_camera_clock = event_id
+                    r0.gps_time = event_id
+                    r0.adc_samples = adc_count[index_in_chunk]
+                    if baseline.ndim == 1:
+                        r0.digicam_baseline = baseline
+                    else:
+                        r0.digicam_baseline = baseline[index_in_chunk]
+                    bar.update(1)
+                    yield data
+    finally:
+        file.close()
 
-            if (event_id % chunk_size) == 0:
-                index_in_chunk = 0
-                chunk_start = (event_id // chunk_size) * chunk_size
-                chunk_end = chunk_start + chunk_size
-                chunk_end = min(chunk_end, n_events)
-                adc_count = full_data_set[chunk_start:chunk_end]
 
-            data.r0.tel[tel_id].camera_event_number = event_id
-            data.r0.tel[tel_id].local_camera_clock = event_id
-            data.r0.tel[tel_id].gps_time = event_id
-            data.r0.tel[tel_id].adc_samples = adc_count[index_in_chunk]
-            index_in_chunk += 1
+def digicamtoy_block_source(
+        url,
+        block_size=150,
+        max_events=None,
+        event_id=None,
+        disable_bar=False,
+        mmap=False,
+):
+    """A generator that streams blocks of consecutive events from an HDF5
+    data file from DigicamToy.
+    Parameters
+    ----------
+    url : str
+        path to file to open
+    block_size : int
+        number of events per block. The last block might be smaller. The
+        file is read by slabs aligned to its HDF5 chunks.
+    max_events : int, optional
+        maximum number of events to read
+    event_id : int
+        Event id to start at, c.f. digicamtoy_event_source()
+    disable_bar: If set to true, the progress bar is not shown.
+    mmap: If set to true, contiguous and uncompressed datasets are memory
+    mapped instead of being read. The waveforms and baselines are then
+    read-only arrays, which stages modifying them in place (e.g.
+    digicampipe.calib.filters.set_pixels_to_zero()) cannot use.
 
-        yield data
+    Returns
+    -------
+    A generator of `R0BlockContainer`.
+    """
+    file = _DigicamToyFile(url, mmap=mmap)
+    try:
+        start, stop = _event_range(file.n_events, max_events, event_id, url)
+        with tqdm(total=stop - start, desc='Events',
+                  disable=disable_bar) as bar:
+            slabs = file.iter_slabs(start, stop, block_size)
+            for first_event, adc_samples, baseline in _iter_blocks(
+                    slabs, block_size):
+                n_events = len(adc_samples)
+                event_ids = np.arange(first_event, first_event + n_events)
+                block = R0BlockContainer()
+                block.tel_id = 1
+                block.event_id = event_ids
+                block.camera_event_number = event_ids
+                block.local_camera_clock = event_ids
+                block.gps_time = event_ids
+                block.camera_event_type = np.full(
+                    n_events, CameraEventType.INTERNAL, dtype=np.int64)
+                block.array_event_type = np.full(
+                    n_events, CameraEventType.UNKNOWN, dtype=np.int64)
+                block.adc_samples = adc_samples
+                if baseline.ndim == 1:
+                    block.digicam_baseline = np.broadcast_to(
+                        baseline, (n_events, file.n_pixels))
+                else:
+                    block.digicam_baseline = baseline
+                bar.update(n_events)
+                yield block
+    finally:
+        file.close()
@@ -16,13 +16,13 @@ from ctapipe.instrument import TelescopeDescription, SubarrayDescription
 
 from digicampipe.instrument.camera import DigiCam
 from digicampipe.io.containers import DataContainer
+from digicampipe.io.index import load_simtel_index
 
 
 logger = logging.getLogger(__name__)
 
 try:
     from pyhessio import open_hessio
-    from pyhessio import HessioError
     from pyhessio import HessioTelescopeIndexError
     from pyhessio import HessioGeneralError
 except ImportError as err:
@@ -36,11 +36,13 @@ __all__ = [
 ]
 
 
-def hessio_get_list_event_ids(url, max_events=None):
+def hessio_get_list_event_ids(url, max_events=None, index_dir=None):
     """
     Faster method to get a list of all the event ids in the hessio file.
     This list can also be used to find out the number of events that exist
-    in the file.
+    in the file. The event ids are read from the index of the file, which is
+    built by scanning the object headers the first time it is needed, c.f.
+    digicampipe.io.index.load_simtel_index()
 
     Parameters
     ----------
@@ -48,6 +50,8 @@ def hessio_get_list_event_ids(url, max_events=None):
         path to file to open
     max_events : int, optional
         maximum number of events to read
+    index_dir : str, optional
+        directory of the index files
 
     Returns
     -------
@@ -55,23 +59,8 @@ def hessio_get_list_event_ids(url, max_events=None):
         A list with all the event ids that are in the file.
 
     """
-    logger.warning("This method is slow. Need to find faster method.")
-    try:
-        with open_hessio(url) as pyhessio_file:
-            Provenance().add_input_file(url, role='r0.sub.evt')
-            counter = 0
-            event_id_list = []
-            eventstream = pyhessio_file.move_to_next_event()
-            for event_id in eventstream:
-                event_id_list.append(event_id)
-                counter += 1
-                if max_events and counter >= max_events:
-                    pyhessio_file.close_file()
-                    break
-            return event_id_list
-    except HessioError:
-        raise RuntimeError("hessio_event_source failed to open '{}'"
-                           .format(url))
+    index, _ = load_simtel_index(url, index_dir)
+    return index['event_id'][:max_events].tolist()
 
 
 def hessio_event_source(url, camera=DigiCam, max_events=None,
@@ -247,7 +236,10 @@ def hessio_event_source(url, camera=DigiCam, max_events=None,
             yield data
             counter += 1
 
-            if max_events and counter >= max_events:
+            # only the requested event is returned, there is no need to read
+            # the rest of the file
+            if requested_event is not None or \
+                    (max_events and counter >= max_events):
                 pyhessio_file.close_file()
                 return
 
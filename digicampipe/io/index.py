@@ -0,0 +1,233 @@
+"""
+On-disk index of the events of ZFITS and EventIO (simtel) files.
+
+The index of a ZFITS file gives for each event its row in the file, its
+event number, its local camera clock and its event type. The index of an
+EventIO file gives for each array event the offsets of the objects needed to
+read it. An index is built in one pass over the file the first time it is
+needed and saved as a sidecar "<file>.index.npz" next to the file. If the
+directory of the file is not writable, it is saved in a cache directory
+instead. An index is rebuilt whenever the size or the modification time of
+its file changes.
+"""
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['load_zfits_index', 'build_zfits_index', 'seek_row',
+           'load_simtel_index', 'build_simtel_index', 'seek_position']
+
+INDEX_DTYPE = np.dtype([
+    ('event_number', np.int64),
+    ('row', np.int64),
+    ('local_camera_clock', np.int64),
+    ('event_type', np.int64),
+])
+SIMTEL_INDEX_DTYPE = np.dtype([
+    ('event_id', np.int64),
+    ('array_event_id', np.int64),
+    ('shower_offset', np.int64),
+    ('mc_event_offset', np.int64),
+    ('array_event_offset', np.int64),
+])
+# EventIO types of the objects holding the MC shower, the MC event, the
+# array event and the monitoring data (camera monitoring, laser calibration
+# and pixel monitoring) that an array event depends on.
+MC_SHOWER_TYPE = 2020
+MC_EVENT_TYPE = 2021
+ARRAY_EVENT_TYPE = 2010
+MONITORING_TYPES = (2022, 2023, 2033)
+INDEX_SUFFIX = '.index.npz'
+DEFAULT_INDEX_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'digicampipe', 'index'
+)
+
+
+def build_zfits_index(url):
+    """
+    Read all the events of a ZFITS file to build its index.
+    :param url: path to the ZFITS file
+    :return: structured array of dtype INDEX_DTYPE sorted by event number
+    """
+    from protozfits import File
+
+    with File(url) as file:
+        index = np.zeros(len(file.Events), dtype=INDEX_DTYPE)
+        for row, event in enumerate(file.Events):
+            index[row] = (
+                event.eventNumber,
+                row,
+                np.int64(event.local_time_sec * 1E9) +
+                np.int64(event.local_time_nanosec),
+                event.event_type,
+            )
+    return np.sort(index, order='event_number', kind='stable')
+
+
+def load_zfits_index(url, index_dir=None):
+    """
+    Get the index of a ZFITS file. The index is loaded from its sidecar
+    file if it exists and is up to date, otherwise it is built and saved.
+    :param url: path to the ZFITS file
+    :param index_dir: directory where the index is stored. If None, the
+    index is stored next to the file or in DEFAULT_INDEX_DIR if the
+    directory of the file is not writable.
+    :return: structured array of dtype INDEX_DTYPE sorted by event number
+    """
+    arrays = _load_or_build(
+        url, lambda url: {'index': build_zfits_index(url)}, index_dir
+    )
+    return arrays['index']
+
+
+def build_simtel_index(url):
+    """
+    Scan the object headers of an EventIO file, without parsing the
+    objects, to build its index.
+    :param url: path to the EventIO file
+    :return: structured array of dtype SIMTEL_INDEX_DTYPE with one entry per
+    array event in the order of the file and the array of the offsets of the
+    monitoring objects.
+    """
+    from eventio import EventIOFile
+
+    events = []
+    monitoring_offsets = []
+    shower_offset = -1
+    mc_event_offset = -1
+    mc_event_id = -1
+    with EventIOFile(url) as file:
+        for eventio_object in file:
+            header = eventio_object.header
+            offset = header.content_address - header.header_size
+            if header.type == MC_SHOWER_TYPE:
+                shower_offset = offset
+            elif header.type == MC_EVENT_TYPE:
+                mc_event_offset = offset
+                mc_event_id = header.id
+            elif header.type == ARRAY_EVENT_TYPE and mc_event_offset >= 0:
+                events.append((mc_event_id, header.id, shower_offset,
+                               mc_event_offset, offset))
+            elif header.type in MONITORING_TYPES:
+                monitoring_offsets.append(offset)
+    return (np.array(events, dtype=SIMTEL_INDEX_DTYPE),
+            np.array(monitoring_offsets, dtype=np.int64))
+
+
+def load_simtel_index(url, index_dir=None):
+    """
+    Get the index of an EventIO file, c.f. load_zfits_index()
+    :param url: path to the EventIO file
+    :param index_dir: directory where the index is stored, c.f.
+    load_zfits_index()
+    :return: the index of the array events and the offsets of the monitoring
+    objects, c.f. build_simtel_index()
+    """
+
+    def build(url):
+        index, monitoring_offsets = build_simtel_index(url)
+        return {'index': index, 'monitoring_offsets': monitoring_offsets}
+
+    arrays = _load_or_build(url, build, index_dir)
+    return arrays['index'], arrays['monitoring_offsets']
+
+
+def seek_position(event_ids, event_id, url=''):
+    """
+    Find the position of the event `event_id` in a sorted array of event
+    IDs. If the exact event ID does not exists the closest past event is
+    taken. If the event ID is out of the range of the array it raises an
+    IndexError
+    """
+    first_event_id = event_ids[0] if len(event_ids) > 0 else None
+    last_event_id = event_ids[-1] if len(event_ids) > 0 else None
+    if len(event_ids) == 0 or not first_event_id <= event_id <= last_event_id:
+        raise IndexError('Cannot find event ID {} in File {}\n'
+                         'First event ID : {}\n'
+                         'Last event ID : {}'.format(event_id, url,
+                                                     first_event_id,
+                                                     last_event_id))
+    return int(np.searchsorted(event_ids, event_id, side='right') - 1)
+
+
+def seek_row(index, event_id, url=''):
+    """
+    Find the row of the event `event_id` in the index of a ZFITS file, c.f.
+    seek_position()
+    """
+    position = seek_position(index['event_number'], event_id, url)
+    return int(index['row'][position])
+
+
+def _load_or_build(url, build, index_dir):
+    stat = os.stat(url)
+    candidates = _index_paths(url, index_dir)
+    for path in candidates:
+        arrays = _read_index(path, stat)
+        if arrays is not None:
+            return arrays
+
+    arrays = build(url)
+    for path in candidates:
+        try:
+            _write_index(path, arrays, stat)
+            logger.info('index of %s saved in %s', url, path)
+            break
+        except OSError:
+            continue
+    else:
+        logger.warning('could not save the index of %s', url)
+    return arrays
+
+
+def _index_paths(url, index_dir):
+    if index_dir is not None:
+        return [_cached_index_path(url, index_dir)]
+    return [url + INDEX_SUFFIX, _cached_index_path(url, DEFAULT_INDEX_DIR)]
+
+
+def _cached_index_path(url, index_dir):
+    # files with the same name can come from different directories
+    path = os.path.abspath(url)
+    digest = hashlib.sha1(path.encode()).hexdigest()[:16]
+    name = os.path.basename(path) + '.' + digest + INDEX_SUFFIX
+    return os.path.join(index_dir, name)
+
+
+def _read_index(path, stat):
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as content:
+            if int(content['file_size']) != stat.st_size or \
+                    int(content['file_mtime_ns']) != stat.st_mtime_ns:
+                logger.info('index %s is out of date', path)
+                return None
+            return {
+                name: content[name] for name in content.files
+                if name not in ('file_size', 'file_mtime_ns')
+            }
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning('could not read the index %s: %s', path, e)
+        return None
+
+
+def _write_index(path, arrays, stat):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # write to a temporary file first such that an interrupted write does not
+    # leave a broken index behind
+    temporary_path = path + '.{}.tmp'.format(os.getpid())
+    try:
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, file_size=stat.st_size,
+                     file_mtime_ns=stat.st_mtime_ns, **arrays)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
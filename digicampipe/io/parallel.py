@@ -0,0 +1,201 @@
+"""
+Decode several files at the same time in worker processes and merge their
+events back into a single stream ordered by event number.
+"""
+import heapq
+import multiprocessing
+import pickle
+import warnings
+from itertools import islice
+
+from tqdm import tqdm
+
+from digicampipe.io.containers import DataContainer
+
+__all__ = ['parallel_file_stream']
+
+# DataContainer fields sent by the workers for every event. The instrument
+# information does not change within a file and is sent only once.
+EVENT_FIELDS = ('r0', 'r1', 'dl0', 'mc', 'mcheader', 'trig', 'count')
+
+
+def _read_file(source, url, queue, kwargs):
+    # The event sources fill the same containers for every event while the
+    # queue pickles its items later, in a feeder thread. The events are then
+    # pickled here, before the next one overwrites them.
+    try:
+        first_event = True
+        for event in source(url=url, disable_bar=True, **kwargs):
+            if first_event:
+                queue.put(('inst', pickle.dumps(event.inst)))
+                first_event = False
+            fields = {name: event[name] for name in EVENT_FIELDS}
+            queue.put(('event', pickle.dumps(fields)))
+    except (EOFError, SystemError) as e:
+        queue.put(('warning', 'error while reading {}: {}'.format(url, e)))
+    except Exception as e:
+        queue.put(('error', e))
+    queue.put(('end', None))
+
+
+class _FileReader:
+    """
+    Run the event source of one file, or of a chunk of it, in a worker
+    process and re-build the events it sends in a DataContainer owned by the
+    main process.
+    """
+
+    def __init__(self, source, url, queue_size, kwargs):
+        context = multiprocessing.get_context()
+        self.url = url
+        self.queue = context.Queue(maxsize=queue_size)
+        self.process = context.Process(
+            target=_read_file, args=(source, url, self.queue, kwargs),
+            daemon=True,
+        )
+        self.process.start()
+        self.data = DataContainer()
+
+    def next(self):
+        """
+        Fill self.data with the next event of the file.
+        :return: False when the file is exhausted, True otherwise
+        """
+        while True:
+            kind, value = self.queue.get()
+            if kind == 'inst':
+                self.data.inst = pickle.loads(value)
+            elif kind == 'event':
+                for name, field in pickle.loads(value).items():
+                    self.data[name] = field
+                return True
+            elif kind == 'warning':
+                warnings.warn(value)
+            elif kind == 'error':
+                self.close()
+                raise value
+            else:
+                self.process.join()
+                return False
+
+    def key(self):
+        tel = list(self.data.r0.tels_with_data)[0]
+        r0 = self.data.r0.tel[tel]
+        local_clock = r0.local_camera_clock
+        if isinstance(local_clock, type):
+            local_clock = 0
+        return r0.camera_event_number, local_clock
+
+    def close(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.queue.close()
+        self.queue.join_thread()
+
+
+def _split_files(filelist, file_kwargs, chunk_size, count_events):
+    """
+    Split the files in chunks of at most `chunk_size` rows, given with the
+    `rows` parameter of the event source. The files with explicit rows are
+    split along them, the other ones only if `count_events` is given and
+    no `event_id` to start at is.
+    :return: list of (url, kwargs, last), last being True for the last
+    chunk of each file
+    """
+    tasks = []
+    for url, extra_kwargs in zip(filelist, file_kwargs):
+        rows = extra_kwargs.get('rows')
+        if rows is None and count_events is not None and \
+                extra_kwargs.get('event_id') is None:
+            rows = range(count_events(url))
+        if rows is None:
+            tasks.append((url, extra_kwargs, True))
+            continue
+        starts = range(0, max(len(rows), 1), chunk_size)
+        for start in starts:
+            chunk = list(rows[start:start + chunk_size])
+            tasks.append((url, dict(extra_kwargs, rows=chunk),
+                          start == starts[-1]))
+    return tasks
+
+
+def parallel_file_stream(filelist, source, n_workers, queue_size=500,
+                         disable_bar=False, file_kwargs=None,
+                         count_events=None, **kwargs):
+    """
+    Stream the events of several files decoded in parallel. Up to `n_workers`
+    files are read at the same time, each in its own process, and their
+    events are merged by (camera_event_number, local_camera_clock). The
+    files are expected to be ordered in time, as the files of a run are.
+
+    Each worker buffers at most `queue_size` decoded events. As the files of
+    a run are merged one after the other, the workers of the later files
+    wait once their buffer is full. To decode ahead, the files are split in
+    chunks of `queue_size` events, read by different workers through the
+    `rows` parameter of the event source: a worker decodes its whole chunk
+    without waiting and at most `n_workers` chunks are held in memory.
+
+    :param filelist: list of paths
+    :param source: function-like, the event source of the files
+    :param n_workers: number of files, or chunks, decoded at the same time
+    :param queue_size: maximum number of decoded events waiting per worker,
+    and number of events per chunk.
+    :param disable_bar: If set to true, the progress bar is not shown.
+    :param file_kwargs: list of additional parameters of the event source,
+    one dictionary per file. If None, all the files are read with `kwargs`.
+    The files with `rows` are split in chunks.
+    :param count_events: function returning the number of events of a file.
+    If given, the files are split in chunks and `source` must accept
+    `rows`, c.f. digicampipe.io.zfits.zfits_event_source(). If None, only
+    the files given with `rows` are split, the others are decoded serially.
+    :param kwargs: parameters for the event source
+    :return: a generator of DataContainer. Each yielded container is valid
+    until the next iteration.
+    """
+    if file_kwargs is None:
+        file_kwargs = [{}] * len(filelist)
+    tasks = iter(_split_files(filelist, file_kwargs, queue_size,
+                              count_events))
+    heap = []
+    readers = []
+    bar = tqdm(total=len(filelist), desc='Files', leave=True,
+               disable=disable_bar)
+    n_started = 0
+
+    def start(url, extra_kwargs, last):
+        nonlocal n_started
+        reader = _FileReader(source, url, queue_size,
+                             dict(kwargs, **extra_kwargs))
+        reader.order = n_started
+        reader.last = last
+        n_started += 1
+        readers.append(reader)
+        return reader
+
+    def advance(reader):
+        # push the next event of the reader in the heap, when its chunk is
+        # exhausted the next one is started
+        while reader is not None:
+            if reader.next():
+                heapq.heappush(heap, (reader.key(), reader.order, reader))
+                return
+            reader.close()
+            readers.remove(reader)
+            if reader.last:
+                bar.update(1)
+            task = next(tasks, None)
+            reader = None if task is None else start(*task)
+
+    try:
+        for reader in [start(*task) for task in islice(tasks, n_workers)]:
+            advance(reader)
+
+        while heap:
+            _, _, reader = heapq.heappop(heap)
+            yield reader.data
+            advance(reader)
+    finally:
+        for reader in readers:
+            reader.close()
+        bar.close()
@@ -0,0 +1,103 @@
+"""
+Read ahead of the consumer of an iterable in a background thread.
+"""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Prefetcher']
+
+_END = object()
+
+
+class _ProducerError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Prefetcher:
+    """
+    Iterate over `iterable` in a producer thread that runs at most `depth`
+    items ahead of the consumer.
+
+    The time the producer waits because the queue is full and the time the
+    consumer waits because the queue is empty are accumulated in
+    `producer_stall` and `consumer_stall` (in seconds) and logged when the
+    iteration ends. A consumer that stalls means the producer is too slow
+    and a bigger queue will not help, a producer that stalls means the queue
+    can be made smaller.
+    """
+
+    def __init__(self, iterable, depth=10):
+        if depth < 1:
+            raise ValueError('depth must be at least 1, got {}'.format(depth))
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=depth)
+        self.producer_stall = 0.
+        self.consumer_stall = 0.
+        self.n_items = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._produce, args=(iterable, ), daemon=True
+        )
+        self._thread.start()
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(_ProducerError(e))
+            return
+        self._put(_END)
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                self.producer_stall += time.perf_counter() - start
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self.queue.get()
+                self.consumer_stall += time.perf_counter() - start
+                if item is _END:
+                    return
+                if isinstance(item, _ProducerError):
+                    raise item.exception
+                self.n_items += 1
+                yield item
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop the producer thread and log the stall times. It is safe to call
+        it several times.
+        """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        logger.info(
+            'Prefetched %d items with depth %d: producer stalled %.3f s, '
+            'consumer stalled %.3f s', self.n_items, self.depth,
+            self.producer_stall, self.consumer_stall
+        )
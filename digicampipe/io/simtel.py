@@ -5,16 +5,20 @@ Components to read simtel data.
 This requires the eventio python library to be installed
 """
 import logging
+from functools import partial
+
 import numpy as np
 from tqdm import tqdm
 
 from astropy import units as u
 from astropy.coordinates import Angle
 from astropy.time import Time
+import eventio
 from eventio.simtel.simtelfile import SimTelFile
 from ctapipe.io.simteleventsource import SimTelEventSource
 
 from digicampipe.io.containers import DataContainer
+from digicampipe.io.index import load_simtel_index, seek_position
 
 
 logger = logging.getLogger(__name__)
@@ -24,10 +28,15 @@ __all__ = [
     'simtel_event_source',
 ]
 
+# versions of eventio whose SimTelFile internals are used to seek events,
+# c.f. _seek_simtel_file(). Keep in sync with setup.py
+EVENTIO_VERSIONS = '>=2.1,<2.2'
+
 
 def simtel_event_source(url, camera=None, max_events=None,
                         allowed_tels=None, requested_event=None,
-                        use_event_id=False, event_id=None, disable_bar=False):
+                        use_event_id=False, event_id=None, disable_bar=False,
+                        index_dir=None):
     """A generator that streams data from an EventIO/HESSIO MC data file
     (e.g. a standard CTA data file.)
 
@@ -43,16 +52,21 @@ def simtel_event_source(url, camera=None, max_events=None,
         would be 1 telescope per file (whereas in current monte-carlo,
         they are all interleaved into one file)
     requested_event : int
-        Seek to a paricular event index
+        Seek to a paricular event index, only that event is returned.
     use_event_id : bool
         If True ,'requested_event' now seeks for a particular event id instead
         of index
-    disable_bar : Unused, for compatibility with other readers
+    event_id: int
+        Event id to start at. If the exact event ID does not exists
+        it will return the closest past event. If the event ID is out of the
+        range of the file it will raise an IndexError
+    disable_bar : If set to true, the progress bar is not shown.
+    index_dir: str, optional
+        directory of the index files. To seek events, the file is indexed
+        the first time it is needed, c.f.
+        digicampipe.io.index.load_simtel_index()
     """
 
-    if event_id is not None:
-        raise ValueError('Event id feature not implemented yet! \n'
-                         'Use event_id=None')
     if not SimTelEventSource.is_compatible(url):
         raise ValueError(url, 'is not a valid simtel file')
     data = DataContainer()
@@ -68,27 +82,33 @@ def simtel_event_source(url, camera=None, max_events=None,
             telescope_descriptions,
             file.header
         )
+        run_id = file.header['run']
+        data.inst.subarray = subarray_info
+        data.r0.run_id = run_id
+        data.r1.run_id = run_id
+        data.dl0.run_id = run_id
+        _fill_mc_header(data.mcheader, file)
+        telescope_constants = {}
+        # containers of the telescopes without data in the current event,
+        # they are put back in the maps when their telescope has data again
+        unused_containers = {}
+        if requested_event is not None or event_id is not None:
+            index, monitoring_offsets = load_simtel_index(url, index_dir)
+            if requested_event is None:
+                position = seek_position(index['event_id'], event_id, url)
+            else:
+                position = _requested_position(index, requested_event,
+                                               use_event_id, url)
+                max_events = 1
+            _seek_simtel_file(file, index[position], monitoring_offsets)
         counter = 0
         for array_event in tqdm(file, disable=disable_bar):
-            # Seek to requested event
-            if requested_event is not None:
-                current = counter
-                if use_event_id:
-                    current = event_id
-                if not current == requested_event:
-                    counter += 1
-                    continue
-            run_id = file.header['run']
             event_id = array_event['event_id']
             tels_with_data = set(array_event['telescope_events'].keys())
-            data.inst.subarray = subarray_info
-            data.r0.run_id = run_id
             data.r0.event_id = event_id
             data.r0.tels_with_data = tels_with_data
-            data.r1.run_id = run_id
             data.r1.event_id = event_id
             data.r1.tels_with_data = tels_with_data
-            data.dl0.run_id = run_id
             data.dl0.event_id = event_id
             data.dl0.tels_with_data = tels_with_data
             # handle telescope filtering by taking the intersection of
@@ -119,79 +139,157 @@ def simtel_event_source(url, camera=None, max_events=None,
             data.mc.x_max = mc_shower['xmax'] * u.g / (u.cm ** 2)
             data.mc.shower_primary_id = mc_shower['primary_id']
 
-            # mc run header data
-            data.mcheader.run_array_direction = Angle(
-                file.header['direction'] * u.rad
-            )
-            mc_run_head = file.mc_run_headers[-1]
-            data.mcheader.corsika_version = mc_run_head['shower_prog_vers']
-            data.mcheader.simtel_version = mc_run_head['detector_prog_vers']
-            data.mcheader.energy_range_min = mc_run_head['E_range'][0] * u.TeV
-            data.mcheader.energy_range_max = mc_run_head['E_range'][1] * u.TeV
-            data.mcheader.prod_site_B_total = mc_run_head['B_total'] * u.uT
-            data.mcheader.prod_site_B_declination = Angle(
-                mc_run_head['B_declination'] * u.rad)
-            data.mcheader.prod_site_B_inclination = Angle(
-                mc_run_head['B_inclination'] * u.rad)
-            data.mcheader.prod_site_alt = mc_run_head['obsheight'] * u.m
-            data.mcheader.spectral_index = mc_run_head['spectral_index']
-
-            # this should be done in a nicer way to not re-allocate the
-            # data each time (right now it's just deleted and garbage
-            # collected)
-            data.r0.tel.clear()
-            data.r1.tel.clear()
-            data.dl0.tel.clear()
-            data.dl1.tel.clear()
-            data.mc.tel.clear()  # clear the previous telescopes
-
             telescope_events = array_event['telescope_events']
             tracking_positions = array_event['tracking_positions']
+            for name, tel_map in (('r0', data.r0.tel), ('r1', data.r1.tel),
+                                  ('dl0', data.dl0.tel), ('dl1', data.dl1.tel),
+                                  ('mc', data.mc.tel)):
+                _reuse_tel_containers(
+                    tel_map, telescope_events.keys(),
+                    unused_containers.setdefault(name, {})
+                )
             for tel_id, telescope_event in telescope_events.items():
-                telescope_description = telescope_descriptions[tel_id]
+                if tel_id not in telescope_constants:
+                    telescope_constants[tel_id] = _telescope_constants(
+                        telescope_descriptions[tel_id])
+                constants = telescope_constants[tel_id]
+                r0 = data.r0.tel[tel_id]
+                mc = data.mc.tel[tel_id]
                 camera_monitorings = array_event['camera_monitorings'][tel_id]
                 pedestal = camera_monitorings['pedestal']
                 laser_calib = array_event['laser_calibrations'][tel_id]
-                data.mc.tel[tel_id].dc_to_pe = laser_calib['calib']
-                data.mc.tel[tel_id].pedestal = pedestal
+                mc.dc_to_pe = laser_calib['calib']
+                mc.pedestal = pedestal
                 adc_samples = telescope_event.get('adc_samples')
-                n_pixel = adc_samples.shape[-2]
                 if adc_samples is None:
                     adc_samples = telescope_event['adc_sums'][:, :, np.newaxis]
-                data.r0.tel[tel_id].adc_samples = adc_samples
-                data.r0.tel[tel_id].num_samples = adc_samples.shape[-1]
-                # We should not calculate stuff in an event source
-                # if this is not needed, we calculate it for nothing
-                data.r0.tel[tel_id].adc_sums = adc_samples.sum(axis=-1)
+                # only computed if it is used
+                r0.adc_sums = partial(np.sum, adc_samples, axis=-1)
+                n_pixel = adc_samples.shape[-2]
+                r0.adc_samples = adc_samples
+                r0.num_samples = adc_samples.shape[-1]
                 baseline = pedestal / adc_samples.shape[1]
-                data.r0.tel[tel_id].digicam_baseline = np.squeeze(baseline)
-                data.r0.tel[tel_id].camera_event_number = event_id
-
-                pixel_settings = telescope_description['pixel_settings']
-                data.mc.tel[tel_id].reference_pulse_shape = pixel_settings[
-                    'refshape'].astype('float64')
-                data.mc.tel[tel_id].meta['refstep'] = float(
-                    pixel_settings['ref_step'])
-                data.mc.tel[tel_id].time_slice = float(
-                    pixel_settings['time_slice'])
-
-                data.mc.tel[tel_id].photo_electron_image = array_event.get(
+                r0.digicam_baseline = np.squeeze(baseline)
+                r0.camera_event_number = event_id
+
+                # the reference pulse shape is shared by all the events
+                mc.reference_pulse_shape = constants['reference_pulse_shape']
+                mc.meta['refstep'] = constants['refstep']
+                mc.time_slice = constants['time_slice']
+
+                mc.photo_electron_image = array_event.get(
                     'photoelectrons', {}
                 ).get(tel_id)
-                if data.mc.tel[tel_id].photo_electron_image is None:
-                    data.mc.tel[tel_id].photo_electron_image = np.zeros(
-                        (n_pixel,), dtype='i2')
+                if mc.photo_electron_image is None:
+                    mc.photo_electron_image = np.zeros((n_pixel,), dtype='i2')
 
                 tracking_position = tracking_positions[tel_id]
-                data.mc.tel[tel_id].azimuth_raw = tracking_position[
-                    'azimuth_raw']
-                data.mc.tel[tel_id].altitude_raw = tracking_position[
-                    'altitude_raw']
-                data.mc.tel[tel_id].azimuth_cor = tracking_position.get(
-                    'azimuth_cor', 0)
-                data.mc.tel[tel_id].altitude_cor = tracking_position.get(
-                    'altitude_cor', 0)
+                mc.azimuth_raw = tracking_position['azimuth_raw']
+                mc.altitude_raw = tracking_position['altitude_raw']
+                mc.azimuth_cor = tracking_position.get('azimuth_cor', 0)
+                mc.altitude_cor = tracking_position.get('altitude_cor', 0)
             yield data
             counter += 1
             if max_events and counter >= max_events:
                 return
+
+
+def _requested_position(index, requested_event, use_event_id, url):
+    if not use_event_id:
+        if not 0 <= requested_event < len(index):
+            raise IndexError('Cannot find event {} in File {} with {} '
+                             'events'.format(requested_event, url,
+                                             len(index)))
+        return requested_event
+    positions = np.flatnonzero(index['event_id'] == requested_event)
+    if len(positions) == 0:
+        raise IndexError('Cannot find event ID {} in File {}'.format(
+            requested_event, url))
+    return positions[0]
+
+
+def _seek_simtel_file(file, entry, monitoring_offsets):
+    """
+    Move an opened SimTelFile to the array event of an index entry, c.f.
+    digicampipe.io.index.build_simtel_index(). Only the shower of the event
+    and the monitoring objects written before it are parsed on the way.
+    Compressed files can only be read forward, the objects are hence read in
+    the order of the file.
+    eventio has no public API to move a SimTelFile, its reading state is
+    set directly. c.f. _check_simtel_file_seekable()
+    """
+    _check_simtel_file_seekable(file)
+    eventio_file = file._file
+    mc_event_offset = entry['mc_event_offset']
+    offsets = set(monitoring_offsets[monitoring_offsets < mc_event_offset])
+    offsets.add(entry['shower_offset'])
+    for offset in sorted(offsets):
+        eventio_file._next_header_pos = int(offset)
+        eventio_file.next = None
+        file._parse_next_object()
+    eventio_file._next_header_pos = int(mc_event_offset)
+    eventio_file.next = None
+    file.current_event = None
+
+
+def _check_simtel_file_seekable(file):
+    """
+    Check that the internal state of SimTelFile set by _seek_simtel_file()
+    exists in the installed eventio version. It raises a NotImplementedError
+    otherwise.
+    """
+    eventio_file = getattr(file, '_file', None)
+    if not (hasattr(eventio_file, '_next_header_pos') and
+            hasattr(eventio_file, 'next') and
+            hasattr(file, '_parse_next_object') and
+            hasattr(file, 'current_event')):
+        raise NotImplementedError(
+            'Seeking events requires eventio {}, found version {}'.format(
+                EVENTIO_VERSIONS, eventio.__version__))
+
+
+def _fill_mc_header(mcheader, file):
+    mcheader.run_array_direction = Angle(
+        file.header['direction'] * u.rad
+    )
+    mc_run_head = file.mc_run_headers[-1]
+    mcheader.corsika_version = mc_run_head['shower_prog_vers']
+    mcheader.simtel_version = mc_run_head['detector_prog_vers']
+    mcheader.energy_range_min = mc_run_head['E_range'][0] * u.TeV
+    mcheader.energy_range_max = mc_run_head['E_range'][1] * u.TeV
+    mcheader.prod_site_B_total = mc_run_head['B_total'] * u.uT
+    mcheader.prod_site_B_declination = Angle(
+        mc_run_head['B_declination'] * u.rad)
+    mcheader.prod_site_B_inclination = Angle(
+        mc_run_head['B_inclination'] * u.rad)
+    mcheader.prod_site_alt = mc_run_head['obsheight'] * u.m
+    mcheader.spectral_index = mc_run_head['spectral_index']
+
+
+def _telescope_constants(telescope_description):
+    pixel_settings = telescope_description['pixel_settings']
+    return {
+        'reference_pulse_shape':
+            pixel_settings['refshape'].astype('float64'),
+        'refstep': float(pixel_settings['ref_step']),
+        'time_slice': float(pixel_settings['time_slice']),
+    }
+
+
+def _reuse_tel_containers(tel_map, tel_ids, unused_containers):
+    """
+    Keep in `tel_map` only the telescopes in `tel_ids`. The containers of
+    the other telescopes are moved to `unused_containers` and are put back
+    when their telescope is in `tel_ids` again, such that no container is
+    allocated once every telescope has been seen. The containers of
+    `tel_ids` are reset, such that no field keeps the value of a previous
+    event.
+    """
+    for tel_id in list(tel_map.keys()):
+        if tel_id not in tel_ids:
+            unused_containers[tel_id] = tel_map.pop(tel_id)
+    for tel_id in tel_ids:
+        if tel_id not in tel_map and tel_id in unused_containers:
+            tel_map[tel_id] = unused_containers.pop(tel_id)
+        if tel_id in tel_map:
+            tel_map[tel_id].reset()
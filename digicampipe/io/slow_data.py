@@ -0,0 +1,163 @@
+"""
+Slow control quantities derived once per slow control row.
+
+The slow control services are written about once per second while events
+arrive at kHz rates. Instead of attaching the rows of all the services to
+each event and deriving the same quantities for every event, the quantities
+are derived for all the rows of a night at once and joined on a common time
+grid: the union of the timestamps of the services. An event then only needs
+the index of the last grid row before it, c.f.
+digicampipe.io.event_stream.join_slow_data_calibration()
+"""
+from collections import namedtuple
+
+import numpy as np
+
+__all__ = ['SlowDataTable', 'DERIVED_QUANTITIES']
+
+TEMPERATURE_RANGE = (0, 60)
+
+
+def _mean_temperature(columns):
+    temperatures = np.hstack([np.asarray(column, dtype=np.float64)
+                              for column in columns])
+    valid = np.logical_and(temperatures > TEMPERATURE_RANGE[0],
+                           temperatures < TEMPERATURE_RANGE[1])
+    n_valid = np.sum(valid, axis=-1)
+    total = np.sum(np.where(valid, temperatures, 0), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / n_valid
+
+
+def _all_on(columns):
+    return np.all(np.hstack([np.asarray(column, dtype=bool)
+                             for column in columns]), axis=-1)
+
+
+def _bit(column, bit):
+    return ((np.asarray(column) & 1 << bit) >> bit).astype(bool)
+
+
+# name of the quantity: (service, dtype, function of the table of the
+# service returning one value per row of the table)
+DERIVED_QUANTITIES = {
+    'az': ('DriveSystem', np.float64,
+           lambda table: table['current_position_az']),
+    'el': ('DriveSystem', np.float64,
+           lambda table: table['current_position_el']),
+    'is_on_source': ('DriveSystem', bool,
+                     lambda table: table['is_on_source'].astype(bool)),
+    'is_tracking': ('DriveSystem', bool,
+                    lambda table: table['is_tracking'].astype(bool)),
+    'digicam_temperature': (
+        'DigicamSlowControl', np.float64,
+        lambda table: _mean_temperature(
+            [table['Crate{}_T'.format(i)] for i in (1, 2, 3)]
+        )
+    ),
+    'pdp_temperature': (
+        'PDPSlowControl', np.float64,
+        lambda table: _mean_temperature(
+            [table['Sector{}_T'.format(i)] for i in (1, 2, 3)]
+        )
+    ),
+    'all_hv_on': (
+        'PDPSlowControl', bool,
+        lambda table: _all_on(
+            [table['Sector{}_HV'.format(i)] for i in (1, 2, 3)]
+        )
+    ),
+    'all_ghv_on': (
+        'PDPSlowControl', bool,
+        lambda table: _all_on(
+            [table['Sector{}_GHV'.format(i)] for i in (1, 2, 3)]
+        )
+    ),
+    'target_ra': ('MasterSST1M', np.float64,
+                  lambda table: table['target_radec'][:, 0]),
+    'target_dec': ('MasterSST1M', np.float64,
+                   lambda table: table['target_radec'][:, 1]),
+    # bit 8 of the camera status is about the pointing LEDs being on, bit 9
+    # about them blinking
+    'pointing_leds_on': ('SafetyPLC', bool,
+                         lambda table: _bit(table['SPLC_CAM_Status'], 8)),
+    'pointing_leds_blink': ('SafetyPLC', bool,
+                            lambda table: _bit(table['SPLC_CAM_Status'], 9)),
+}
+
+
+class SlowDataTable:
+    """
+    Quantities derived from the slow control services during a night, joined
+    on the union of the timestamps of the services.
+    """
+
+    def __init__(self, services, date, quantities=None):
+        """
+        :param services: dictionary of the AuxService to use by name
+        :param date: date of the night, c.f. auxservice.night_of()
+        :param quantities: names of the DERIVED_QUANTITIES to compute. If
+        None, all the quantities whose service is in `services` are computed.
+        """
+        if quantities is None:
+            quantities = [name for name, (service, _, _)
+                          in DERIVED_QUANTITIES.items() if service in services]
+        self.quantities = list(quantities)
+        needed = sorted({DERIVED_QUANTITIES[name][0]
+                         for name in self.quantities})
+        tables = {name: services[name].at_date(date) for name in needed}
+        # the grid rows are the times at which any service changes
+        self.timestamp = np.unique(np.concatenate(
+            [tables[name].timestamp for name in needed]
+        ))
+        dtype = [(name, DERIVED_QUANTITIES[name][1])
+                 for name in self.quantities]
+        self.data = np.zeros(len(self.timestamp), dtype=dtype)
+        for service in needed:
+            table = tables[service]
+            # c.f. AuxTable.row_index(), the rows of the service at the grid
+            # times include the rows written at the grid times
+            rows = np.searchsorted(table.timestamp, self.timestamp,
+                                   side='right') - 1
+            for name in self.quantities:
+                if DERIVED_QUANTITIES[name][0] != service:
+                    continue
+                values = np.asarray(DERIVED_QUANTITIES[name][2](table.data))
+                self.data[name] = values[rows]
+        self.namedtuple_klass = namedtuple('SlowDataRow', self.quantities)
+        self._rows = {}
+        self._last_index = -1
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def row_index(self, event_timestamp_in_ns):
+        """
+        index of the last grid row before the event timestamp. The index is
+        -1 (the last row) for events before the first row, like for
+        AuxService.at(). Consecutive events are most of the time on the same
+        row, so the row of the previous call is tried first.
+        """
+        event_timestamp_in_ms = event_timestamp_in_ns / 1e6
+        index = self._last_index
+        timestamp = self.timestamp
+        if 0 <= index < len(timestamp) and \
+                timestamp[index] < event_timestamp_in_ms and \
+                (index == len(timestamp) - 1 or
+                 event_timestamp_in_ms <= timestamp[index + 1]):
+            return index
+        index = int(np.searchsorted(timestamp, event_timestamp_in_ms)) - 1
+        self._last_index = index
+        return index
+
+    def row(self, index):
+        """
+        derived quantities of a grid row as a namedtuple of python scalars.
+        The namedtuples are built once per row.
+        """
+        index = int(index) % len(self.timestamp)
+        row = self._rows.get(index)
+        if row is None:
+            row = self.namedtuple_klass(*self.data[index].item())
+            self._rows[index] = row
+        return row
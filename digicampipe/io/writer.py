@@ -0,0 +1,189 @@
+"""
+Buffered columnar writer of containers.
+
+The values of the fields of flat containers (e.g. PipelineOutputContainer or
+DataQualityContainer) are buffered into typed numpy arrays, one row per
+container, and the buffer is appended to the output file each time it is
+full. The memory used does not depend on the number of containers written
+and the rows written before a crash are kept in the file.
+"""
+import numbers
+import os
+
+import astropy.units as u
+import fitsio
+import h5py
+import numpy as np
+
+__all__ = ['ContainerWriter']
+
+FORMATS = ('fits', 'hdf5')
+
+
+class ContainerWriter:
+    """
+    Write flat containers as rows of a table in a FITS or HDF5 file.
+
+    The columns are the fields of the first container added. Their types and
+    shapes are deduced from its values, quantities are stored as their values
+    in the unit of the first container. Fields left to their default type
+    are stored as NaN (floats), 0 (integers) or False (booleans).
+
+    The FITS table is written with fitsio, the HDF5 table as one dataset per
+    column in the group "data" with h5py.
+    """
+
+    def __init__(self, filename, format=None, chunk_size=10000,
+                 overwrite=True):
+        """
+        :param filename: path of the output file
+        :param format: "fits" or "hdf5". If None, it is guessed from the
+        extension of filename (".h5" and ".hdf5" for HDF5, FITS otherwise).
+        :param chunk_size: number of rows buffered before being written
+        :param overwrite: if False, raise an IOError if the file exists.
+        """
+        if format is None:
+            format = 'hdf5' if filename.endswith(('.h5', '.hdf5')) else 'fits'
+        if format not in FORMATS:
+            raise ValueError('format must be one of {}, got {}'.format(
+                FORMATS, format))
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1, got {}'.format(
+                chunk_size))
+        if not overwrite and os.path.exists(filename):
+            raise IOError('{} already exists'.format(filename))
+        self.filename = filename
+        self.format = format
+        self.chunk_size = chunk_size
+        self.n_rows = 0
+        self._columns = None
+        self._units = None
+        self._buffer = None
+        self._n_buffered = 0
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self._columns is not None:
+            self.close()
+
+    def add_container(self, container):
+        """
+        Buffer the values of the fields of a container as a new row.
+        """
+        if self._columns is None:
+            self._setup(container)
+        row = self._buffer[self._n_buffered]
+        for name in self._columns:
+            row[name] = self._value(name, container[name])
+        self._n_buffered += 1
+        if self._n_buffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered rows to the file.
+        """
+        if self._n_buffered == 0:
+            return
+        chunk = self._buffer[:self._n_buffered]
+        if self.format == 'fits':
+            self._write_fits(chunk)
+        else:
+            self._write_hdf5(chunk)
+        self.n_rows += self._n_buffered
+        self._n_buffered = 0
+
+    def close(self):
+        """
+        Write the remaining rows and close the file. Like
+        ctapipe.io.serializer.Serializer, it raises a ValueError if no
+        container was added, in which case no file is created.
+        """
+        if self._columns is None:
+            raise ValueError('no container was added, {} is not '
+                             'created'.format(self.filename))
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _setup(self, container):
+        self._columns = []
+        self._units = {}
+        dtype = []
+        for name, value in container.items():
+            value, unit = _strip_unit(_fill_default(value))
+            value = np.asarray(value)
+            if value.dtype.kind in 'OUSV':
+                # only numerical values can be stored in columns
+                continue
+            if value.dtype.kind in 'iu':
+                value = value.astype(np.int64)
+            elif value.dtype.kind == 'f':
+                value = value.astype(np.float64)
+            self._columns.append(name)
+            self._units[name] = unit
+            dtype.append((name, value.dtype, value.shape))
+        self._buffer = np.zeros(self.chunk_size, dtype=dtype)
+
+    def _value(self, name, value):
+        value = _fill_default(value)
+        unit = self._units[name]
+        if isinstance(value, u.Quantity):
+            return value.to_value(unit) if unit is not None else value.value
+        return value
+
+    def _write_fits(self, chunk):
+        if self._file is None:
+            self._file = fitsio.FITS(self.filename, 'rw', clobber=True)
+            units = [
+                '' if self._units[name] is None else self._units[name]
+                .to_string('fits') for name in self._columns
+            ]
+            self._file.write(chunk, units=units)
+        else:
+            self._file[-1].append(chunk)
+        # make the rows written so far readable if the process crashes
+        self._file.reopen()
+
+    def _write_hdf5(self, chunk):
+        if self._file is None:
+            self._file = h5py.File(self.filename, 'w')
+            group = self._file.create_group('data')
+            for name in self._columns:
+                field = self._buffer.dtype[name]
+                shape = field.shape
+                dataset = group.create_dataset(
+                    name, shape=(0, ) + shape, maxshape=(None, ) + shape,
+                    chunks=(self.chunk_size, ) + shape, dtype=field.base,
+                )
+                if self._units[name] is not None:
+                    dataset.attrs['unit'] = self._units[name].to_string()
+        group = self._file['data']
+        for name in self._columns:
+            dataset = group[name]
+            dataset.resize(self.n_rows + len(chunk), axis=0)
+            dataset[self.n_rows:] = chunk[name]
+        self._file.flush()
+
+
+def _fill_default(value):
+    # fields never filled keep the type given as default
+    if isinstance(value, type):
+        if issubclass(value, (bool, np.bool_)):
+            return False
+        if issubclass(value, numbers.Integral):
+            return 0
+        return np.nan
+    if value is None:
+        return np.nan
+    return value
+
+
+def _strip_unit(value):
+    if isinstance(value, u.Quantity):
+        return value.value, value.unit
+    return value, None
@@ -5,17 +5,34 @@ This requires the protozfits python library to be installed
 """
 import logging
 import warnings
+from contextlib import ExitStack
+from functools import partial
 
 import numpy as np
 from protozfits import File
 from tqdm import tqdm
 
 from digicampipe.instrument import camera
-from digicampipe.io.containers import DataContainer
+from digicampipe.io.containers import DataContainer, R0BlockContainer, \
+    event_type_predicate
+from digicampipe.io.index import load_zfits_index, seek_row
+from digicampipe.io.prefetch import Prefetcher
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['zfits_event_source']
+__all__ = ['zfits_event_source', 'zfits_block_source']
+
+# R0 fields that zfits_event_source() can be asked to fill. The event number,
+# the local clock and the event types are always filled.
+R0_FIELDS = (
+    'adc_samples',
+    'digicam_baseline',
+    'pixel_flags',
+    'gps_time',
+    'trigger_input_traces',
+    'trigger_output_patch7',
+    'trigger_output_patch19',
+)
 
 
 def _binary_search(file, item):
@@ -38,13 +55,57 @@ def _binary_search(file, item):
     return mid_point
 
 
+def _seek_event_id(file, event_id, url, use_index=False, index_dir=None):
+    """
+    Find the index of the event `event_id` in an opened ZFITS file. If the
+    exact event ID does not exists the closest past event is taken. If the
+    event ID is out of the range of the file it raises an IndexError.
+    If use_index is True, the on-disk index of the file is used instead of
+    reading events, c.f. digicampipe.io.index.load_zfits_index()
+    """
+    if use_index:
+        return seek_row(load_zfits_index(url, index_dir), event_id, url)
+    n_events_in_file = len(file.Events)
+    index_of_event = _binary_search(file, event_id)
+
+    first_event_id = file.Events[0].eventNumber
+    last_event_id = file.Events[n_events_in_file - 1].eventNumber
+    if not first_event_id <= event_id <= last_event_id:
+        raise IndexError('Cannot find event ID {} in File {}\n'
+                         'First event ID : {}\n'
+                         'Last event ID : {}'.format(event_id, url,
+                                                     first_event_id,
+                                                     last_event_id))
+    return index_of_event
+
+
+def _rows_of_event_types(index, keep_event_type, first_row=0):
+    """
+    :return: the rows, in the order of the file, from first_row on of the
+    events whose type is kept.
+    """
+    event_types = np.unique(index['event_type'])
+    kept_types = [event_type for event_type in event_types
+                  if keep_event_type(event_type)]
+    rows = index['row'][np.isin(index['event_type'], kept_types)]
+    rows = np.sort(rows)
+    return rows[rows >= first_row]
+
+
 def zfits_event_source(
         url,
         camera=camera.DigiCam,
         max_events=None,
         allowed_tels=None,
         event_id=None,
-        disable_bar=False
+        disable_bar=False,
+        prefetch=0,
+        use_index=False,
+        index_dir=None,
+        pixel_id=None,
+        fields=None,
+        rows=None,
+        event_types=None,
 ):
     """A generator that streams data from an ZFITs data file
     Parameters
@@ -64,32 +125,78 @@ def zfits_event_source(
         it will return the closest past event. If the event ID is out of the
         range of the file it will raise an IndexError
     disable_bar: If set to true, the progress bar is not shown.
+    prefetch: int
+        Number of events decoded ahead by a background thread. If 0, the
+        events are decoded when they are requested. The stall times of the
+        thread are logged, c.f. digicampipe.io.prefetch.Prefetcher
+    use_index: bool
+        If True, `event_id` is looked up in the on-disk index of the file,
+        which is built the first time it is needed. c.f.
+        digicampipe.io.index.load_zfits_index()
+    index_dir: str, optional
+        directory of the index files, c.f.
+        digicampipe.io.index.load_zfits_index()
+    pixel_id: array-like, optional
+        pixels to read. If given, the per pixel fields only contain the
+        selected pixels, in the given order, and the samples of the other
+        pixels are never copied. If None, all the pixels are read.
+    fields: list[str], optional
+        R0 fields to fill among R0_FIELDS, the others are not filled. If
+        None, all of them are filled.
+    rows: list[int], optional
+        rows of the file to read, in the given order. If given, `event_id`
+        is ignored and only these events are read, c.f.
+        digicampipe.io.event_index.get_events()
+    event_types: list[int] or function, optional
+        event types to keep, c.f.
+        digicampipe.io.containers.event_type_predicate(). Only the kept
+        events are counted in max_events. If use_index is True, the rejected
+        events are not read from the file. Otherwise their protobuf message is
+        still parsed, but their waveforms, baselines and trigger traces are
+        not copied.
     """
+    keep_event_type = event_type_predicate(event_types)
+    if fields is None:
+        fields = R0_FIELDS
+    unknown_fields = set(fields) - set(R0_FIELDS)
+    if unknown_fields:
+        raise ValueError('Unknown fields {}, possible fields are {}'.format(
+            sorted(unknown_fields), R0_FIELDS))
     data = DataContainer()
 
-    with File(url) as file:
+    with File(url) as file, ExitStack() as stack:
         loaded_telescopes = []
 
         n_events_in_file = len(file.Events)
         events = file.Events
         index_of_event = 0
 
-        if event_id is not None:
+        if rows is not None:
 
-            index_of_event = _binary_search(file, event_id)
+            n_events_in_file = len(rows)
+            events = (file.Events[int(row)] for row in rows)
 
-            first_event_id = file.Events[0].eventNumber
-            last_event_id = file.Events[n_events_in_file - 1].eventNumber
-            if not first_event_id <= event_id <= last_event_id:
-                raise IndexError('Cannot find event ID {} in File {}\n'
-                                 'First event ID : {}\n'
-                                 'Last event ID : {}'.format(event_id, url,
-                                                             first_event_id,
-                                                             last_event_id))
+        elif event_id is not None:
 
+            index_of_event = _seek_event_id(file, event_id, url,
+                                            use_index, index_dir)
             events = events[max(index_of_event, 0):]
 
+        if keep_event_type is not None and use_index and rows is None:
+
+            rows = _rows_of_event_types(load_zfits_index(url, index_dir),
+                                        keep_event_type,
+                                        max(index_of_event, 0))
+            events = (file.Events[int(row)] for row in rows)
+
+        if prefetch:
+
+            events = stack.enter_context(Prefetcher(events, depth=prefetch))
+
         n_steps = n_events_in_file if max_events is None else max_events
+        # only the kept events are counted, whether the rejected ones are
+        # skipped through the index or here
+        n_kept_events = 0
 
         for event_counter, event in tqdm(
                 enumerate(events),
@@ -99,10 +206,15 @@ def zfits_event_source(
                 disable=disable_bar,
                 total=n_steps
         ):
-            if max_events is not None and event_counter > max_events:
+            if max_events is not None and n_kept_events > max_events:
                 break
 
-            data.r0.event_id = event_counter
+            if keep_event_type is not None and \
+                    not keep_event_type(event.event_type):
+                continue
+
+            data.r0.event_id = n_kept_events
+            n_kept_events += 1
             data.r0.tels_with_data = [event.telescopeID, ]
 
             # remove forbidden telescopes
@@ -122,17 +234,13 @@ def zfits_event_source(
                 n_pixels = len(pixel_ids)
                 if _sort_ids is None:
                     _sort_ids = np.argsort(pixel_ids)
+                    if pixel_id is not None:
+                        _sort_ids = _sort_ids[pixel_id]
                 samples = event.hiGain.waveforms.samples.reshape(n_pixels, -1)
 
-                try:
-                    unsorted_baseline = event.hiGain.waveforms.baselines
-                except AttributeError:
-                    warnings.warn((
-                        "Could not read `hiGain.waveforms.baselines`"
-                        "for event:{}\n"
-                        "of file:{}\n".format(event_counter, url)
-                    ))
-                    return np.ones(n_pixels) * np.nan
+                if 'digicam_baseline' in fields:
+                    unsorted_baseline = _read_baselines(event, n_pixels,
+                                                        event_counter, url)
 
                 if tel_id not in loaded_telescopes:
                     data.inst.num_channels[tel_id] = event.num_gains
@@ -147,52 +255,185 @@ def zfits_event_source(
                     loaded_telescopes.append(tel_id)
                 r0 = data.r0.tel[tel_id]
                 r0.camera_event_number = event.eventNumber
-                r0.pixel_flags = event.pixels_flags[_sort_ids]
                 r0.local_camera_clock = (
                     np.int64(event.local_time_sec * 1E9) +
                     np.int64(event.local_time_nanosec)
                 )
-                r0.gps_time = (
-                    np.int64(event.trig.timeSec * 1E9) +
-                    np.int64(event.trig.timeNanoSec)
-                )
                 r0.camera_event_type = event.event_type
                 r0.array_event_type = event.eventType
-                r0.adc_samples = samples[_sort_ids]
-
-                if len(event.trigger_input_traces) > 0:
-                    r0.trigger_input_traces = _prepare_trigger_input(
-                        event.trigger_input_traces
+                if 'pixel_flags' in fields:
+                    r0.pixel_flags = event.pixels_flags[_sort_ids]
+                if 'gps_time' in fields:
+                    r0.gps_time = (
+                        np.int64(event.trig.timeSec * 1E9) +
+                        np.int64(event.trig.timeNanoSec)
+                    )
+                if 'adc_samples' in fields:
+                    r0.adc_samples = samples[_sort_ids]
+
+                # the trigger traces are only decoded if they are accessed
+                n_samples = data.inst.num_samples[tel_id]
+                if 'trigger_input_traces' in fields:
+                    r0.trigger_input_traces = partial(
+                        _decode_trigger, _prepare_trigger_input,
+                        event.trigger_input_traces, n_samples,
+                        'trigger_input_traces'
+                    )
+                if 'trigger_output_patch7' in fields:
+                    r0.trigger_output_patch7 = partial(
+                        _decode_trigger, _prepare_trigger_output,
+                        event.trigger_output_patch7, n_samples,
+                        'trigger_output_patch7'
                     )
-                else:
-                    warnings.warn(
-                        'trigger_input_traces does not exist: --> nan')
-                    r0.trigger_input_traces = np.zeros(
-                        (432, data.inst.num_samples[tel_id])) * np.nan
-
-                if len(event.trigger_output_patch7) > 0:
-                    r0.trigger_output_patch7 = _prepare_trigger_output(
-                        event.trigger_output_patch7)
-                else:
-                    warnings.warn(
-                        'trigger_output_patch7 does not exist: --> nan')
-                    r0.trigger_output_patch7 = np.zeros(
-                        (432, data.inst.num_samples[tel_id])) * np.nan
-
-                if len(event.trigger_output_patch19) > 0:
-                    r0.trigger_output_patch19 = _prepare_trigger_output(
-                        event.trigger_output_patch19)
-                else:
-                    warnings.warn(
-                        'trigger_output_patch19 does not exist: --> nan')
-                    r0.trigger_output_patch19 = np.zeros(
-                        (432, data.inst.num_samples[tel_id])) * np.nan
-
-                r0.digicam_baseline = unsorted_baseline[_sort_ids] / 16
+                if 'trigger_output_patch19' in fields:
+                    r0.trigger_output_patch19 = partial(
+                        _decode_trigger, _prepare_trigger_output,
+                        event.trigger_output_patch19, n_samples,
+                        'trigger_output_patch19'
+                    )
+
+                if 'digicam_baseline' in fields:
+                    r0.digicam_baseline = unsorted_baseline[_sort_ids] / 16
 
             yield data
 
 
+def zfits_block_source(
+        url,
+        block_size=100,
+        max_events=None,
+        event_id=None,
+        disable_bar=False,
+        prefetch=0,
+        use_index=False,
+        index_dir=None
+):
+    """A generator that streams blocks of consecutive events from a ZFITs
+    data file. The events are decoded into contiguous arrays allocated once
+    per file, such that the calibration can be done on the whole block at
+    once.
+    Parameters
+    ----------
+    url : str
+        path to file to open
+    block_size : int
+        number of events per block. The last block of the file might be
+        smaller.
+    max_events : int, optional
+        maximum number of events to read
+    event_id: int
+        Event id to start at. If the exact event ID does not exists
+        it will return the closest past event. If the event ID is out of the
+        range of the file it will raise an IndexError
+    disable_bar: If set to true, the progress bar is not shown.
+    prefetch: int
+        Number of events decoded ahead by a background thread, c.f.
+        zfits_event_source()
+    use_index: bool
+        If True, `event_id` is looked up in the on-disk index of the file,
+        c.f. zfits_event_source()
+    index_dir: str, optional
+        directory of the index files, c.f. zfits_event_source()
+
+    Returns
+    -------
+    A generator of `R0BlockContainer`. The container and its arrays are
+    re-used for each block, copy them if they have to outlive the iteration.
+    """
+    block = R0BlockContainer()
+
+    with File(url) as file, ExitStack() as stack:
+
+        n_events_in_file = len(file.Events)
+        events = file.Events
+        index_of_event = 0
+
+        if event_id is not None:
+
+            index_of_event = _seek_event_id(file, event_id, url,
+                                            use_index, index_dir)
+            events = events[max(index_of_event, 0):]
+
+        if prefetch:
+
+            events = stack.enter_context(Prefetcher(events, depth=prefetch))
+
+        n_steps = n_events_in_file if max_events is None else max_events
+        index_in_block = 0
+
+        for event_counter, event in tqdm(
+                enumerate(events),
+                desc='Events',
+                leave=True,
+                initial=index_of_event,
+                disable=disable_bar,
+                total=n_steps
+        ):
+            if max_events is not None and event_counter >= max_events:
+                break
+
+            pixel_ids = event.hiGain.waveforms.pixelsIndices
+            n_pixels = len(pixel_ids)
+            sort_ids = np.argsort(pixel_ids)
+            samples = event.hiGain.waveforms.samples.reshape(n_pixels, -1)
+
+            if block.adc_samples is None:
+                n_samples = samples.shape[-1]
+                block.tel_id = event.telescopeID
+                block.event_id = np.zeros(block_size, dtype=np.int64)
+                block.camera_event_number = np.zeros(block_size,
+                                                     dtype=np.int64)
+                block.camera_event_type = np.zeros(block_size, dtype=np.int64)
+                block.array_event_type = np.zeros(block_size, dtype=np.int64)
+                block.local_camera_clock = np.zeros(block_size,
+                                                    dtype=np.int64)
+                block.gps_time = np.zeros(block_size, dtype=np.int64)
+                block.adc_samples = np.zeros(
+                    (block_size, n_pixels, n_samples), dtype=samples.dtype)
+                block.digicam_baseline = np.zeros((block_size, n_pixels))
+
+            i = index_in_block
+            block.event_id[i] = event_counter
+            block.camera_event_number[i] = event.eventNumber
+            block.camera_event_type[i] = event.event_type
+            block.array_event_type[i] = event.eventType
+            block.local_camera_clock[i] = (
+                np.int64(event.local_time_sec * 1E9) +
+                np.int64(event.local_time_nanosec)
+            )
+            block.gps_time[i] = (
+                np.int64(event.trig.timeSec * 1E9) +
+                np.int64(event.trig.timeNanoSec)
+            )
+            np.take(samples, sort_ids, axis=0, out=block.adc_samples[i])
+            block.digicam_baseline[i] = _read_baselines(
+                event, n_pixels, event_counter, url)[sort_ids] / 16
+            index_in_block += 1
+
+            if index_in_block == block_size:
+                yield block
+                index_in_block = 0
+
+        if 0 < index_in_block < block_size:
+            yield block.select(slice(0, index_in_block))
+
+
+def _read_baselines(event, n_pixels, event_counter, url):
+    """
+    :return: the baselines computed by the camera, unsorted, or NaN if the
+    event does not have them
+    """
+    try:
+        return event.hiGain.waveforms.baselines
+    except AttributeError:
+        warnings.warn((
+            "Could not read `hiGain.waveforms.baselines`"
+            "for event:{}\n"
+            "of file:{}\n".format(event_counter, url)
+        ))
+        return np.ones(n_pixels) * np.nan
+
+
 def count_number_events(file_list):
     return sum(
         len(File(filename).Events)
@@ -267,6 +508,13 @@ PATCH_ID_OUTPUT = [
 PATCH_ID_OUTPUT_SORT_IDS = np.argsort(PATCH_ID_OUTPUT)
 
 
+def _decode_trigger(prepare, traces, n_samples, name):
+    if len(traces) > 0:
+        return prepare(traces)
+    warnings.warn('{} does not exist: --> nan'.format(name))
+    return np.zeros((432, n_samples)) * np.nan
+
+
 def _prepare_trigger_input(_a):
     A, B = 3, 192
     cut = 144
@@ -2,21 +2,32 @@
 """
 concatenate the input fits files to one output.
 Useful to merge the output of several runs (f.e. hillas.fits from pipeline.py)
+The rows are copied chunk by chunk, such that the memory used does not depend
+on the number of input files.
 
 Usage:
-  digicam-concatenate <OUTPUT> <INPUTS>...
+  digicam-concatenate [options] <OUTPUT> <INPUTS>...
 
 Options:
   -h --help                   Show this screen.
+  --chunk_size=N              Number of rows read at once from the inputs.
+                              [Default: 100000]
+  --n_workers=N               Number of threads reading the inputs in
+                              parallel. [Default: 1]
 """
 
-from astropy.table import Table, vstack
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from docopt import docopt
 from glob import glob
+import fitsio
 import os
 import re
 import numpy as np
 
+from digicampipe.utils.docopt import convert_int
+
+
 def tryint(s):
     try:
         return int(s)
@@ -31,48 +42,164 @@ def alphanum_key(s):
     return [tryint(c) for c in re.split('([0-9]+)', s)]
 
 
-def entry(inputs, output):
+def _read_rows(input, start, stop, columns=None):
+    with fitsio.FITS(input) as file:
+        return file[1].read(columns=columns, rows=np.arange(start, stop))
+
+
+def _chunk_ranges(n_rows, chunk_size):
+    return [(start, min(start + chunk_size, n_rows))
+            for start in range(0, n_rows, chunk_size)]
+
+
+def _iter_chunks(tasks, n_workers, columns=None):
+    """
+    Read the chunks (input, start, stop) of tasks in order. With several
+    workers, up to 2 * n_workers chunks are read ahead in parallel.
+    """
+    if n_workers <= 1:
+        for input, start, stop in tasks:
+            yield _read_rows(input, start, stop, columns)
+        return
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for input, start, stop in tasks:
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+            pending.append(
+                executor.submit(_read_rows, input, start, stop, columns)
+            )
+        while pending:
+            yield pending.popleft().result()
+
+
+def _is_boolean(values):
+    return bool(np.all(np.logical_or(values == 0, values == 1)))
+
+
+def get_schema(inputs, chunk_size=100000, n_workers=1):
+    """
+    Check that the first extension of all inputs have the same columns and
+    find the type of each column in the output. Columns containing only 0
+    and 1 in all the inputs are stored as booleans. Only the columns which
+    are not already booleans are read.
+    :return: list of (name, dtype, shape) of the output columns, dictionary
+    of the units of the columns and number of rows of each input.
+    """
+    names = None
+    dtypes = {}
+    units = {}
+    n_rows = []
+    for input in inputs:
+        with fitsio.FITS(input) as file:
+            hdu = file[1]
+            dtype = hdu.get_rec_dtype()[0]
+            header = hdu.read_header()
+            n_rows.append(hdu.get_nrows())
+        if names is None:
+            names = list(dtype.names)
+            for i, name in enumerate(names):
+                unit = header.get('TUNIT{}'.format(i + 1), '').strip()
+                units[name] = unit if unit else None
+        elif set(dtype.names) != set(names):
+            raise ValueError(
+                'columns of {} differ from the ones of {}: {}'.format(
+                    input, inputs[0], sorted(set(dtype.names) ^ set(names))
+                ))
+        for name in names:
+            field = dtype[name]
+            if name in dtypes:
+                if field.shape != dtypes[name].shape:
+                    raise ValueError('column {} of {} has shape {} instead '
+                                     'of {}'.format(name, input, field.shape,
+                                                    dtypes[name].shape))
+                base = np.result_type(field.base, dtypes[name].base)
+                dtypes[name] = np.dtype((base, field.shape))
+            else:
+                dtypes[name] = field
+
+    not_boolean = [name for name in names if dtypes[name].base != bool]
+    boolean = {name: True for name in not_boolean}
+    tasks = [
+        (input, start, stop)
+        for input, n in zip(inputs, n_rows)
+        for start, stop in _chunk_ranges(n, chunk_size)
+    ]
+    if not_boolean:
+        for chunk in _iter_chunks(tasks, n_workers, not_boolean):
+            for name in not_boolean:
+                if boolean[name]:
+                    boolean[name] = _is_boolean(chunk[name])
+    columns = []
+    for name in names:
+        dtype = dtypes[name]
+        if boolean.get(name, False):
+            dtype = np.dtype((bool, dtype.shape))
+        columns.append((name, dtype.base.newbyteorder('='), dtype.shape))
+    return columns, units, n_rows
+
+
+def concatenate(inputs, output, chunk_size=100000, n_workers=1):
+    """
+    concatenate the first extension of the input fits files into the output
+    fits file.
+    :param inputs: list of input paths, missing files are skipped.
+    :param output: output path, overwritten if it exists.
+    :param chunk_size: number of rows read at once from the inputs
+    :param n_workers: number of threads reading the inputs.
+    :return: number of rows written
+    """
     if len(inputs) < 1:
         raise AttributeError('digicam-concatenate must take 1 output and at '
                              'least 1 input file as arguments')
-    tables = []
+    existing_inputs = []
     for input in inputs:
         if os.path.isfile(input):
-            tables.append(Table.read(input))
+            existing_inputs.append(input)
         else:
             print('WARNING:', input, 'does not exist, skipping it.')
-    columns_type = {}
-    for table in tables:
-        for column_idx in range(len(table.columns)):
-            column = table.columns[column_idx]
-            type = column.dtype
-            if np.all(np.logical_or(column == 0, column==1)):
-                type = bool
-            if column.name in columns_type.keys():
-                columns_type[column.name] = np.result_type(
-                    type,
-                    columns_type[column.name]
-                )
-            else:
-                columns_type[column.name] = type
-    tables_stackable = []
-    for table in tables:
-        columns_converted = []
-        for key, val in columns_type.items():
-            columns_converted.append(table.columns[key].astype(val))
-        tables_stackable.append(Table(columns_converted))
-    result = vstack(tables_stackable)
+    if len(existing_inputs) == 0:
+        raise AttributeError('none of the input files exists')
+    columns, units, n_rows = get_schema(existing_inputs, chunk_size,
+                                        n_workers)
+    dtype = [(name, base, shape) for name, base, shape in columns]
     if os.path.isfile(output):
         print('WARNING:', output, 'existed, overwriting it.')
         os.remove(output)
-    result.write(output)
+    tasks = [
+        (input, start, stop)
+        for input, n in zip(existing_inputs, n_rows)
+        for start, stop in _chunk_ranges(n, chunk_size)
+    ]
+    n_written = 0
+    with fitsio.FITS(output, 'rw', clobber=True) as file:
+        for chunk in _iter_chunks(tasks, n_workers):
+            rows = np.empty(len(chunk), dtype=dtype)
+            for name, _, _ in columns:
+                rows[name] = chunk[name]
+            if n_written == 0:
+                file.write(rows, units=[units[name] or ''
+                                        for name, _, _ in columns])
+            else:
+                file[-1].append(rows)
+            n_written += len(rows)
+        if n_written == 0:
+            file.write(np.empty(0, dtype=dtype),
+                       units=[units[name] or '' for name, _, _ in columns])
+    return n_written
 
 
-if __name__ == '__main__':
+def entry():
     args = docopt(__doc__)
     inputs = args['<INPUTS>']
     if len(inputs) == 1:
         inputs = glob(inputs[0])
         inputs.sort(key=alphanum_key)
     output = args['<OUTPUT>']
-    entry(inputs, output)
+    chunk_size = convert_int(args['--chunk_size'])
+    n_workers = convert_int(args['--n_workers'])
+    concatenate(inputs, output, chunk_size=chunk_size, n_workers=n_workers)
+
+
+if __name__ == '__main__':
+    entry()
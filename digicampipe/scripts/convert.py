@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Transcode raw data files (zfits, simtel or digicamtoy) into the columnar R0
+format. The converted files (with extension ".r0.h5") can be given instead of
+the raw files to any script, they are read without decoding.
+
+Usage:
+  digicam-convert [options] [--] <INPUT>...
+
+Options:
+  -h --help                   Show this screen.
+  --max_events=N              Maximum number of events to convert per file.
+                              [Default: none]
+  -o DIR --output_dir=DIR     Directory where the converted files are written.
+                              [Default: .]
+  --block_size=N              Number of events per stored block.
+                              [Default: 1000]
+  --compression=STR           Compression of the waveforms: "gzip", "lzf" or
+                              "none". Only uncompressed files are memory
+                              mapped when read.
+                              [Default: none]
+  --disable_bar               If used, the progress bar is not show while
+                              reading files.
+"""
+import os
+
+from docopt import docopt
+
+from digicampipe.io.columnar import write_columnar, columnar_path
+from digicampipe.io.event_stream import block_stream
+from digicampipe.utils.docopt import convert_int, convert_text
+
+
+def convert(files, output_dir='.', max_events=None, block_size=1000,
+            compression=None, disable_bar=False):
+    """
+    Convert each of the files into a columnar file in output_dir.
+    :return: list of the paths of the converted files
+    """
+    output_files = []
+    for file in files:
+        output_file = os.path.join(output_dir, columnar_path(file))
+        blocks = block_stream(file, block_size=block_size,
+                              max_events=max_events, disable_bar=disable_bar)
+        n_events = write_columnar(blocks, output_file,
+                                  compression=compression,
+                                  disable_bar=disable_bar)
+        print('{} events of {} written in {}'.format(n_events, file,
+                                                     output_file))
+        output_files.append(output_file)
+    return output_files
+
+
+def entry():
+    args = docopt(__doc__)
+    files = args['<INPUT>']
+    max_events = convert_int(args['--max_events'])
+    output_dir = args['--output_dir']
+    block_size = int(args['--block_size'])
+    compression = convert_text(args['--compression'])
+    disable_bar = args['--disable_bar']
+    convert(files, output_dir=output_dir, max_events=max_events,
+            block_size=block_size, compression=compression,
+            disable_bar=disable_bar)
+
+
+if __name__ == '__main__':
+    entry()
@@ -20,6 +20,11 @@ Options:
                                 If set to "search", It will try to determine it
                                 from the input files.
                                 [Default: search]
+  --aux_cache_dir=DIR           Directory of the on-disk cache of the
+                                auxiliary tables, c.f.
+                                digicampipe.io.auxcache. If set to "none", the
+                                auxiliary files are read at every run.
+                                [Default: none]
   --load                        If not present, the INPUT zfits files will be
                                 analyzed and output fits and histo files will
                                 be created. If present, that analysis is
@@ -55,7 +60,6 @@ import yaml
 from astropy.table import Table
 from ctapipe.core import Field
 from ctapipe.io.containers import Container
-from ctapipe.io.serializer import Serializer
 from docopt import docopt
 from histogram.histogram import Histogram1D
 from numpy import ndarray
@@ -70,6 +74,7 @@ from digicampipe.calib.cleaning import compute_3d_cleaning
 from digicampipe.instrument.camera import DigiCam
 from digicampipe.io.event_stream import calibration_event_stream, \
     add_slow_data_calibration
+from digicampipe.io.writer import ContainerWriter
 from digicampipe.utils.pulse_template import NormalizedPulseTemplate
 from digicampipe.utils.docopt import convert_text
 
@@ -91,7 +96,8 @@ def data_quality(
         nsb_plot_filename, parameters_filename, template_filename,
         aux_basepath, threshold_sample_pe=20.,
         bias_resistance=1e4 * u.Ohm, cell_capacitance=5e-14 * u.Farad,
-        disable_bar=False, aux_services=('DriveSystem',)
+        disable_bar=False, aux_services=('DriveSystem',),
+        aux_cache_dir=None,
 
 ):
     input_dir = np.unique([os.path.dirname(file) for file in files])
@@ -118,7 +124,8 @@ def data_quality(
     if not load_files:
         events = calibration_event_stream(files, disable_bar=disable_bar)
         events = add_slow_data_calibration(
-            events, basepath=aux_basepath, aux_services=aux_services
+            events, basepath=aux_basepath, aux_services=aux_services,
+            cache_dir=aux_cache_dir,
         )
         events = fill_digicam_baseline(events)
         events = fill_dark_baseline(events, dark_baseline)
@@ -142,7 +149,7 @@ def data_quality(
         az = 0
         el = 0
         container = DataQualityContainer()
-        file = Serializer(fits_filename, mode='w', format='fits')
+        file = ContainerWriter(fits_filename, format='fits')
         baseline_histo = Histogram1D(
             data_shape=(n_pixels,),
             bin_edges=np.arange(4096)
@@ -264,11 +271,13 @@ def entry():
     threshold_sample_pe = float(args['--threshold_sample_pe'])
     disable_bar = args['--disable_bar']
     aux_basepath = args['--aux_basepath']
+    aux_cache_dir = convert_text(args['--aux_cache_dir'])
     data_quality(
         files, dark_filename, time_step, fits_filename, load_files,
         histo_filename, rate_plot_filename, baseline_plot_filename,
         nsb_plot_filename, parameters_filename, template_filename,
-        aux_basepath, threshold_sample_pe, disable_bar=disable_bar
+        aux_basepath, threshold_sample_pe, disable_bar=disable_bar,
+        aux_cache_dir=aux_cache_dir,
     )
 
 
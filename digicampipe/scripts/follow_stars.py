@@ -11,6 +11,11 @@ Options:
                                 If set to "search", It will try to determine it
                                 from the input files.
                                 [Default: search]
+  --aux_cache_dir=DIR           Directory of the on-disk cache of the
+                                auxiliary tables, c.f.
+                                digicampipe.io.auxcache. If set to "none", the
+                                auxiliary files are read at every run.
+                                [Default: none]
   --dark_hist=LIST              Histogram of ADC samples during dark run.
                                 Output of raw.py on dark data.
   --output=FILE                 Fits file containing the baselines. Set to none
@@ -65,7 +70,8 @@ def nsb_rate(
         output=None, plot="show", plot_nsb_range=None, norm="log",
         plot_baselines=False, disable_bar=False, max_events=None, n_skip=10,
         stars=True,
-        bias_resistance=1e4 * u.Ohm, cell_capacitance=5e-14 * u.Farad
+        bias_resistance=1e4 * u.Ohm, cell_capacitance=5e-14 * u.Farad,
+        aux_cache_dir=None,
 ):
     files = np.atleast_1d(files)
 
@@ -89,7 +95,8 @@ def nsb_rate(
                                           disable_bar=disable_bar)
         events = add_slow_data_calibration(
             events, basepath=aux_basepath,
-            aux_services=('DriveSystem', )
+            aux_services=('DriveSystem', ),
+            cache_dir=aux_cache_dir,
         )
         data = {
             "baseline": [],
@@ -280,6 +287,7 @@ def entry():
                 "Please use --aux_basepath=PATH"
             )
         print('expecting aux files in', aux_basepath)
+    aux_cache_dir = convert_text(args['--aux_cache_dir'])
     dark_histo_file = convert_text(args['--dark_hist'])
     param_file = convert_text(args['--parameters'])
     if param_file is None:
@@ -312,7 +320,8 @@ def entry():
         files, aux_basepath, dark_histo_file, param_file, template_filename,
         output=output, norm=norm, plot_baselines=plot_baselines,
         plot=plot, bias_resistance=bias_resistance, max_events=max_events,
-        stars=True, cell_capacitance=cell_capacitance
+        stars=True, cell_capacitance=cell_capacitance,
+        aux_cache_dir=aux_cache_dir,
     )
 
 
@@ -227,7 +227,11 @@ def get_burst(
     if video_prefix is not None:
         for i, burst_idxs in enumerate(bursts):
             begin_idx, end_idx = burst_idxs
-            events = calibration_event_stream(files, disable_bar=disable_bar)
+            # the index of the files allows to start reading at the burst
+            events = calibration_event_stream(
+                files, disable_bar=disable_bar, use_index=True,
+                event_id_range=(event_ids[begin_idx], event_ids[end_idx])
+            )
             events = fill_digicam_baseline(events)
             if video_prefix != "show":
                 video = video_prefix + "_" + str(i) + ".mp4"
@@ -203,7 +203,7 @@ def compute(files, pixel_id, max_events, pulse_indices, integral_width,
         events = subtract_baseline(events)
         # events = find_pulse_with_max(events)
         events = fill_pulse_indices(events, pulse_indices)
-        events = compute_charge(events, integral_width, shift)
+        events = compute_charge(events, integral_width, shift, compact=True)
         events = compute_amplitude(events)
 
         charge_histo = Histogram1D(
@@ -218,7 +218,7 @@ def compute(files, pixel_id, max_events, pulse_indices, integral_width,
 
         for event in events:
 
-            charge_histo.fill(event.data.reconstructed_charge)
+            charge_histo.fill(event.data.pulse_charges.per_pixel(n_pixels))
             amplitude_histo.fill(event.data.reconstructed_amplitude)
 
         if save:
@@ -289,12 +289,13 @@ def entry():
             events = subtract_baseline(events)
             # events = find_pulse_with_max(events)
             events = fill_pulse_indices(events, pulse_indices)
-            events = compute_charge(events, integral_width, shift)
-            events = compute_amplitude(events)
+            events = compute_charge(events, integral_width, shift,
+                                    compact=True)
 
             for event in events:
-                charge_histo.fill(event.data.reconstructed_charge,
-                                  indices=i)
+                charge_histo.fill(
+                    event.data.pulse_charges.per_pixel(n_pixels), indices=i
+                )
 
         charge_histo.save(charge_histo_filename, )
 
@@ -14,6 +14,11 @@ Options:
                                 from the path of the first input file. If set
                                 to "none", no auxiliary data will be added.
                                 [Default: search]
+  --aux_cache_dir=DIR           Directory of the on-disk cache of the
+                                auxiliary tables, c.f.
+                                digicampipe.io.auxcache. If set to "none", the
+                                auxiliary files are read at every run.
+                                [Default: none]
   --max_events=N                Maximum number of events to analyze
   -o FILE --output=FILE         file where to store the results.
                                 [Default: ./hillas.fits]
@@ -51,6 +56,9 @@ Options:
                                 [default: 1].
   --apply_corr_factor           If used, correction factors corresponding
                                 to the window non-uniformity are applied.
+  --block_size=N                If set, the events are calibrated by blocks of
+                                N events up to the number of p.e. instead of
+                                one by one.
 """
 import os
 import sys
@@ -59,7 +67,6 @@ import numpy as np
 import yaml
 from ctapipe.core import Field
 from ctapipe.io.containers import HillasParametersContainer
-from ctapipe.io.serializer import Serializer
 from ctapipe.visualization import CameraDisplay
 from ctapipe.image.cleaning import number_of_islands
 from docopt import docopt
@@ -71,7 +78,9 @@ from digicampipe.calib import baseline, peak, charge, cleaning, image, tagging
 from digicampipe.calib import filters
 from digicampipe.instrument.camera import DigiCam
 from digicampipe.io.event_stream import calibration_event_stream, \
-    add_slow_data_calibration
+    calibration_block_stream, join_slow_data_calibration, \
+    unstack_calibration_blocks
+from digicampipe.io.writer import ContainerWriter
 from digicampipe.utils.docopt import convert_int, convert_list_int, \
     convert_text, convert_float
 from digicampipe.utils.pulse_template import NormalizedPulseTemplate
@@ -169,7 +178,8 @@ def main_pipeline(
         picture_threshold, boundary_threshold, template_filename,
         saturation_threshold, threshold_pulse, nevent_plot=12,
         event_plot_filename=None, bad_pixels=None, disable_bar=False,
-        wdw_number=1, apply_corr_factor=False,
+        wdw_number=1, apply_corr_factor=False, block_size=None,
+        aux_cache_dir=None,
 ):
     # get configuration
     with open(parameters_filename) as file:
@@ -194,20 +204,22 @@ def main_pipeline(
     dark_baseline = dark_histo.mean()
 
     # define pipeline
-    events = calibration_event_stream(files, max_events=max_events,
-                                      disable_bar=disable_bar)
-    if aux_basepath is not None:
-        events = add_slow_data_calibration(
-            events, basepath=aux_basepath,
-            aux_services=('DriveSystem', 'DigicamSlowControl', 'MasterSST1M',
-                          'SafetyPLC', 'PDPSlowControl')
-        )
+    if block_size is None:
+        events = calibration_event_stream(files, max_events=max_events,
+                                          disable_bar=disable_bar,
+                                          preallocate=True)
+    else:
+        events = calibration_block_stream(files, block_size=block_size,
+                                          max_events=max_events,
+                                          disable_bar=disable_bar,
+                                          preallocate=True)
     events = baseline.fill_dark_baseline(events, dark_baseline)
     events = baseline.fill_digicam_baseline(events)
     events = tagging.tag_burst_from_moving_average_baseline(events)
     events = baseline.compute_baseline_shift(events)
     events = baseline.subtract_baseline(events)
-    events = filters.filter_clocked_trigger(events)
+    if block_size is None:
+        events = filters.filter_clocked_trigger(events)
     events = baseline.compute_nsb_rate(events, gain_amplitude,
                                        pulse_area, crosstalk,
                                        bias_resistance, cell_capacitance)
@@ -226,6 +238,16 @@ def main_pipeline(
     events = charge.apply_wdw_transmittance_correction_factor(
         events, wdw_number, apply_corr_factor
     )
+    if block_size is not None:
+        events = unstack_calibration_blocks(events)
+        events = filters.filter_clocked_trigger(events)
+    if aux_basepath is not None:
+        events = join_slow_data_calibration(
+            events, basepath=aux_basepath,
+            aux_services=('DriveSystem', 'DigicamSlowControl', 'MasterSST1M',
+                          'SafetyPLC', 'PDPSlowControl'),
+            cache_dir=aux_cache_dir,
+        )
     events = charge.interpolate_bad_pixels(events, geom, bad_pixels)
     events = cleaning.compute_tailcuts_clean(
         events, geom=geom, overwrite=True,
@@ -245,7 +267,7 @@ def main_pipeline(
         threshold_time=2.1 * u.ns, threshold_size=0.005 * u.mm
     )
     # create pipeline output file
-    output_file = Serializer(hillas_filename, mode='w', format='fits')
+    output_file = ContainerWriter(hillas_filename, format='fits')
     data_to_store = PipelineOutputContainer()
     for event in events:
         if debug:
@@ -281,55 +303,9 @@ def main_pipeline(
         )
         data_to_store.number_of_island = num_islands
         if aux_basepath is not None:
-            data_to_store.az = event.slow_data.DriveSystem.current_position_az
-            data_to_store.el = event.slow_data.DriveSystem.current_position_el
-            temp_crate1 = event.slow_data.DigicamSlowControl.Crate1_T
-            temp_crate2 = event.slow_data.DigicamSlowControl.Crate2_T
-            temp_crate3 = event.slow_data.DigicamSlowControl.Crate3_T
-            temp_digicam = np.array(
-                np.hstack([temp_crate1, temp_crate2, temp_crate3])
-            )
-            temp_digicam_mean = np.mean(
-                temp_digicam[np.logical_and(temp_digicam > 0,
-                                            temp_digicam < 60)]
-            )
-            data_to_store.digicam_temperature = temp_digicam_mean
-            temp_sector1 = event.slow_data.PDPSlowControl.Sector1_T
-            temp_sector2 = event.slow_data.PDPSlowControl.Sector2_T
-            temp_sector3 = event.slow_data.PDPSlowControl.Sector3_T
-            temp_pdp = np.array(
-                np.hstack([temp_sector1, temp_sector2, temp_sector3])
-            )
-            temp_pdp_mean = np.mean(
-                temp_pdp[np.logical_and(temp_pdp > 0, temp_pdp < 60)]
-            )
-            data_to_store.pdp_temperature = temp_pdp_mean
-            target_radec = event.slow_data.MasterSST1M.target_radec
-            data_to_store.target_ra = target_radec[0]
-            data_to_store.target_dec = target_radec[1]
-            status_leds = event.slow_data.SafetyPLC.SPLC_CAM_Status
-            # bit 8 of status_LEDs is about on/off, bit 9 about blinking
-            data_to_store.pointing_leds_on = bool((status_leds & 1 << 8) >> 8)
-            pointing_leds_blink = bool((status_leds & 1 << 9) >> 9)
-            data_to_store.pointing_leds_blink = pointing_leds_blink
-            hv_sector1 = event.slow_data.PDPSlowControl.Sector1_HV
-            hv_sector2 = event.slow_data.PDPSlowControl.Sector2_HV
-            hv_sector3 = event.slow_data.PDPSlowControl.Sector3_HV
-            hv_pdp = np.array(
-                np.hstack([hv_sector1, hv_sector2, hv_sector3]), dtype=bool
-            )
-            data_to_store.all_hv_on = np.all(hv_pdp)
-            ghv_sector1 = event.slow_data.PDPSlowControl.Sector1_GHV
-            ghv_sector2 = event.slow_data.PDPSlowControl.Sector2_GHV
-            ghv_sector3 = event.slow_data.PDPSlowControl.Sector3_GHV
-            ghv_pdp = np.array(
-                np.hstack([ghv_sector1, ghv_sector2, ghv_sector3]), dtype=bool
-            )
-            data_to_store.all_ghv_on = np.all(ghv_pdp)
-            is_on_source = bool(event.slow_data.DriveSystem.is_on_source)
-            data_to_store.is_on_source = is_on_source
-            is_tracking = bool(event.slow_data.DriveSystem.is_tracking)
-            data_to_store.is_tracking = is_tracking
+            slow_data = event.slow_data.row(event.slow_data_index)
+            for key, val in zip(slow_data._fields, slow_data):
+                data_to_store[key] = val
         for key, val in event.hillas.items():
             data_to_store[key] = val
         output_file.add_container(data_to_store)
@@ -344,6 +320,7 @@ def entry():
     args = docopt(__doc__)
     files = args['<INPUT>']
     aux_basepath = convert_text(args['--aux_basepath'])
+    aux_cache_dir = convert_text(args['--aux_cache_dir'])
     max_events = convert_int(args['--max_events'])
     dark_filename = args['--dark']
     output = convert_text(args['--output'])
@@ -365,6 +342,7 @@ def entry():
     threshold_pulse = convert_float(args['--threshold_pulse'])
     wdw_number = convert_int(args['--wdw_number'])
     apply_corr_factor = args['--apply_corr_factor']
+    block_size = convert_int(args['--block_size'])
     if aux_basepath is not None and aux_basepath.lower() == "search":
         input_dir = np.unique([os.path.dirname(file) for file in files])
         if len(input_dir) > 1:
@@ -402,6 +380,8 @@ def entry():
         event_plot_filename=event_plot_filename,
         wdw_number=wdw_number,
         apply_corr_factor=apply_corr_factor,
+        block_size=block_size,
+        aux_cache_dir=aux_cache_dir,
     )
 
 
@@ -33,17 +33,17 @@ from digicampipe.calib import filters
 from digicampipe.calib import trigger, baseline
 from digicampipe.calib.trigger import compute_bias_curve
 from digicampipe.io.event_stream import event_stream
-from digicampipe.io.containers import CameraEventType
+from digicampipe.io.containers import CameraEventType, event_type_flags
 
 
 def compute(files, output_filename, thresholds, n_samples=1024):
 
     thresholds = thresholds.astype(float)
 
-    data_stream = event_stream(files)
+    data_stream = event_stream(
+        files, event_types=event_type_flags([CameraEventType.INTERNAL])
+    )
     # data_stream = trigger.fill_event_type(data_stream, flag=8)
-    data_stream = filters.filter_event_types(data_stream,
-                                             flags=CameraEventType.INTERNAL)
     data_stream = baseline.fill_baseline_r0(data_stream, n_bins=n_samples)
     data_stream = filters.filter_missing_baseline(data_stream)
     data_stream = trigger.fill_trigger_patch(data_stream)
@@ -51,7 +51,7 @@ def compute(files, filename, max_events=None, pixel_id=None, event_types=None,
         n_pixels = len(pixel_id)
         events = calibration_event_stream(
             files, pixel_id=pixel_id, max_events=max_events,
-            disable_bar=disable_bar)
+            disable_bar=disable_bar, event_types=event_types or None)
         if baseline_subtracted:
             bin_edges = np.arange(-100, 4095, 1)
         else:
@@ -62,8 +62,6 @@ def compute(files, filename, max_events=None, pixel_id=None, event_types=None,
         )
 
         for event in events:
-            if event_types and event.event_type not in event_types:
-                continue
             samples = event.data.adc_samples
             if baseline_subtracted:
                 samples = samples - event.data.digicam_baseline[:, None]
@@ -84,7 +82,7 @@ def compute_baseline_histogram(files, filename, max_events=None, pixel_id=None,
         n_pixels = len(pixel_id)
         events = calibration_event_stream(
             files, pixel_id=pixel_id, max_events=max_events,
-            disable_bar=disable_bar
+            disable_bar=disable_bar, event_types=event_types or None
         )
         baseline_histo = Histogram1D(
             data_shape=(n_pixels,),
@@ -92,8 +90,6 @@ def compute_baseline_histogram(files, filename, max_events=None, pixel_id=None,
         )
 
         for event in events:
-            if event_types and event.event_type not in event_types:
-                continue
             baseline_histo.fill(event.data.digicam_baseline.reshape(-1, 1))
         baseline_histo.save(filename)
 
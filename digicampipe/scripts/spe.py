@@ -126,7 +126,7 @@ def compute_max_histo(files, histo_filename, pixel_id, max_events,
         events = fill_baseline(events, baseline)
         events = subtract_baseline(events)
         events = find_pulse_with_max(events)
-        events = compute_charge(events, integral_width, shift)
+        events = compute_charge(events, integral_width, shift, compact=True)
         max_histo = Histogram1D(
             data_shape=(n_pixels,),
             bin_edges=np.arange(-4095 * integral_width,
@@ -134,7 +134,7 @@ def compute_max_histo(files, histo_filename, pixel_id, max_events,
         )
 
         for event in events:
-            max_histo.fill(event.data.reconstructed_charge)
+            max_histo.fill(event.data.pulse_charges.per_pixel(n_pixels))
 
         max_histo.save(histo_filename)
 
@@ -172,7 +172,7 @@ def compute_spe(files, histo_filename, pixel_id, baseline, max_events,
         #                             threshold_sigma=2)
 
         events = compute_charge(events, integral_width=integral_width,
-                                shift=shift)
+                                shift=shift, compact=True)
         # events = compute_amplitude(events)
         # events = fit_template(events)
 
@@ -184,7 +184,7 @@ def compute_spe(files, histo_filename, pixel_id, baseline, max_events,
         )
 
         for event in events:
-            spe_histo.fill(event.data.reconstructed_charge)
+            spe_histo.fill(event.data.pulse_charges.per_pixel(n_pixels))
 
         spe_histo.save(histo_filename)
 
@@ -26,18 +26,19 @@ import numpy as np
 from ctapipe.visualization import CameraDisplay
 from docopt import docopt
 
-from digicampipe.calib.filters import filter_event_types
 from digicampipe.instrument.camera import DigiCam
 from digicampipe.instrument.geometry import compute_patch_matrix
+from digicampipe.io.containers import event_type_flags
 from digicampipe.io.event_stream import event_stream
 from digicampipe.utils.docopt import convert_text, convert_list_int
 
 
 def trigger_uniformity(files, plot="show", event_types=None,
                        disable_bar=False):
-    events = event_stream(files, disable_bar=disable_bar)
     if event_types is not None:
-        events = filter_event_types(events, flags=event_types)
+        event_types = event_type_flags(event_types)
+    events = event_stream(files, disable_bar=disable_bar,
+                          event_types=event_types)
     # patxh matrix is a bool of size n_patch x n_pixel
     patch_matrix = compute_patch_matrix(camera=DigiCam)
     n_patch, n_pixel = patch_matrix.shape
@@ -9,21 +9,35 @@ Options:
   --event_id=N      Event id to start
                     [Default: None]
 '''
+import numpy as np
 from docopt import docopt
 
 from digicampipe.io import event_stream
+from digicampipe.io.event_index import EventIndex, get_events
 from digicampipe.visualization import EventViewer
 
 
 def entry():
     args = docopt(__doc__)
 
+    files = args['<INPUT>']
     event_id = args['--event_id']
     event_id = int(event_id) if event_id != 'None' else None
-    data_stream = event_stream.event_stream(args['<INPUT>'],
-                                            event_id=event_id-1)
-    for _, i in zip(data_stream, range(int(args['--start']))):
-        pass
+    start = int(args['--start'])
+    if all(file.endswith('.fits.fz') for file in files):
+        # jump directly to the first event to show
+        index = EventIndex(files)
+        first = 0
+        if event_id is not None:
+            first = np.searchsorted(index.event_ids, event_id)
+        data_stream = get_events(files, index.event_ids[first + start:],
+                                 index=index)
+    else:
+        if event_id is not None:
+            event_id = event_id - 1
+        data_stream = event_stream.event_stream(files, event_id=event_id)
+        for _, i in zip(data_stream, range(start)):
+            pass
     display = EventViewer(data_stream)
     display.draw()
 
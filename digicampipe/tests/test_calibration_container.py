@@ -2,6 +2,7 @@ import os
 
 import pkg_resources
 
+from digicampipe.io.containers import CalibrationEventData
 from digicampipe.io.event_stream import calibration_event_stream, event_stream
 
 example_file_path = pkg_resources.resource_filename(
@@ -47,3 +48,25 @@ def test_event_type_enum_behavior():
     for event in calibration_event_stream(example_file_path):
         assert event.event_type in [event.event_type.PATCH7,
                                     event.event_type.INTERNAL]
+
+
+def test_calibration_event_stream_preallocate():
+    max_events = 10
+    values = [
+        (event.data.adc_samples.copy(), event.data.cleaning_mask.copy())
+        for event in calibration_event_stream(example_file_path,
+                                              max_events=max_events)
+    ]
+    stream = calibration_event_stream(example_file_path,
+                                      max_events=max_events,
+                                      preallocate=True)
+    cleaning_mask = None
+    for i, event in enumerate(stream):
+        assert isinstance(event.data, CalibrationEventData)
+        assert (event.data.adc_samples == values[i][0]).all()
+        assert (event.data.cleaning_mask == values[i][1]).all()
+        if cleaning_mask is not None:
+            # the buffer of the first event is re-used
+            assert event.data.cleaning_mask is cleaning_mask
+        cleaning_mask = event.data.cleaning_mask
+    assert i == max_events - 1
@@ -1,7 +1,14 @@
+import astropy.units as u
 import numpy as np
-
-from digicampipe.io.containers import CalibrationContainer
-from digicampipe.calib.charge import compute_dynamic_charge
+import pytest
+from scipy.ndimage import convolve1d
+
+from digicampipe.io.containers import CalibrationContainer, \
+    CalibrationBlockContainer
+from digicampipe.calib.charge import compute_dynamic_charge, \
+    fit_template, integrate_pulses, interpolate_bad_pixels, \
+    _dynamic_charge_window, _integrate_dynamic_window, PULSE_TEMPLATE
+from digicampipe.instrument.camera import DigiCam
 from digicampipe.calib.peak import find_pulse_with_max
 
 
@@ -45,3 +52,148 @@ def test_dynamic_charge():
         assert event.data.saturated
 
 
+def test_dynamic_charge_block():
+    adc_samples = np.array([
+        event.data.adc_samples.copy() for event in _make_dummy_stream()
+    ])
+    block = CalibrationBlockContainer()
+    block.event_id = np.arange(len(adc_samples))
+    block.data.adc_samples = adc_samples
+    blocks = find_pulse_with_max([block])
+    blocks = compute_dynamic_charge(blocks, integral_width=5,
+                                    threshold_pulse=0.1,
+                                    saturation_threshold=3000)
+    block = list(blocks)[0]
+
+    events = find_pulse_with_max(_make_dummy_stream())
+    events = compute_dynamic_charge(events, integral_width=5,
+                                    threshold_pulse=0.1,
+                                    saturation_threshold=3000)
+    for i, event in enumerate(events):
+        assert np.all(block.data.pulse_mask[i] == event.data.pulse_mask)
+        assert np.all(block.data.reconstructed_charge[i] ==
+                      event.data.reconstructed_charge)
+        assert np.all(block.data.reconstructed_amplitude[i] ==
+                      event.data.reconstructed_amplitude)
+        assert block.data.saturated[i] == event.data.saturated
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.uint16])
+@pytest.mark.parametrize('pulse_tail', [False, True])
+def test_integrate_dynamic_window(dtype, pulse_tail):
+    random = np.random.RandomState(0)
+    n_pulses, n_samples = 500, 50
+    adc_samples = random.normal(100, 50, size=(n_pulses, n_samples))
+    for pulse in range(0, n_pulses, 2):
+        start = random.randint(0, n_samples)
+        adc_samples[pulse, start:start + random.randint(1, 30)] += 5000
+    adc_samples = np.clip(adc_samples, 0, None).astype(dtype)
+    pulse_mask = adc_samples == np.max(adc_samples, axis=-1)[:, None]
+    saturated_pulse = np.max(adc_samples, axis=-1) > 3000
+    threshold_pulse = np.full(n_pulses, 300.)
+    window = _dynamic_charge_window(adc_samples, pulse_mask,
+                                    saturated_pulse, threshold_pulse[:, None],
+                                    integral_width=7, pulse_tail=pulse_tail)
+    expected = np.sum(adc_samples * window, axis=-1)
+    charge = np.zeros(n_pulses, dtype=expected.dtype)
+    _integrate_dynamic_window(adc_samples, pulse_mask, saturated_pulse,
+                              threshold_pulse, 3.5, pulse_tail,
+                              adc_samples.dtype.type(0), charge)
+    assert np.any(saturated_pulse) and not np.all(saturated_pulse)
+    # same results bit for bit
+    assert charge.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize('integral_width', [1, 4, 7])
+@pytest.mark.parametrize('shift', [-2, 0, 3])
+def test_integrate_pulses(integral_width, shift):
+    random = np.random.RandomState(0)
+    n_events, n_pixels, n_samples = 3, 20, 50
+    adc_samples = random.normal(0, 30, size=(n_events, n_pixels, n_samples))
+    pulse_mask = random.uniform(size=adc_samples.shape) < 0.1
+    pulse_mask[..., 0] = True
+    pulse_mask[..., -1] = True
+    pulse_charges = integrate_pulses(adc_samples, pulse_mask,
+                                     integral_width, shift)
+    convolved_signal = convolve1d(adc_samples, np.ones(integral_width),
+                                  axis=-1)
+    event, pixel, sample = np.nonzero(pulse_mask)
+    expected = convolved_signal[event, pixel, (sample + shift) % n_samples]
+    assert np.all(pulse_charges.pixel == pixel)
+    assert np.all(pulse_charges.sample == sample)
+    assert np.allclose(pulse_charges.charge, expected)
+
+    charges = pulse_charges.per_pixel(n_pixels)
+    n_pulses = np.sum(pulse_mask, axis=(0, 2))
+    assert charges.shape == (n_pixels, np.max(n_pulses))
+    assert np.all(np.sum(np.isfinite(charges), axis=-1) == n_pulses)
+    assert np.allclose(np.nansum(charges, axis=-1),
+                       np.bincount(pixel, weights=expected))
+
+
+def test_fit_template():
+    random = np.random.RandomState(0)
+    n_samples = 50
+    rise_time = 12
+    amplitude = random.uniform(10, 100, size=(2, 3, 1))
+    t_0 = random.uniform(40, 120, size=(2, 3, 1))
+    time = np.arange(n_samples) * 4
+    event = CalibrationBlockContainer()
+    event.data.adc_samples = amplitude * PULSE_TEMPLATE(time - t_0) + \
+        random.normal(5, 0.1, size=(2, 3, n_samples))
+    sample = np.round((t_0 + rise_time) / 4).astype(int)
+    event.data.pulse_mask = np.arange(n_samples) == sample
+
+    event = next(fit_template([event], rise_time=rise_time))
+    pulse_mask = event.data.pulse_mask
+    amplitudes = event.data.reconstructed_amplitude
+    times = event.data.reconstructed_time
+    assert np.all(np.isnan(amplitudes[~pulse_mask]))
+    assert np.all(np.isnan(times[~pulse_mask]))
+    assert np.allclose(amplitudes[pulse_mask], amplitude.ravel(), rtol=0.02)
+    assert np.allclose(times[pulse_mask], t_0.ravel(), atol=0.5)
+
+
+def test_interpolate_bad_pixels():
+    geom = DigiCam.geometry
+    n_pixels = len(geom.neighbors)
+    bad_pixels = [0, 10, 11, 500]
+
+    def stream():
+        event = CalibrationContainer()
+        for i in range(4):
+            random = np.random.RandomState(i)
+            event.data.reconstructed_number_of_pe = random.uniform(
+                1, 2, size=n_pixels)
+            event.data.reconstructed_number_of_pe[[12, 13 + i]] = np.nan
+            event.data.baseline_shift = random.uniform(1, 2, size=n_pixels)
+            event.data.baseline_shift[[20, 30 * i]] = 0
+            event.data.nsb_rate = random.uniform(1, 2, size=n_pixels) * u.GHz
+            yield event
+
+    for event, expected in zip(
+            interpolate_bad_pixels(stream(), geom, bad_pixels, cache_size=2),
+            stream()):
+        values = [
+            event.data.reconstructed_number_of_pe,
+            event.data.baseline_shift,
+            event.data.nsb_rate.to(u.GHz).value,
+        ]
+        expected_values = [
+            expected.data.reconstructed_number_of_pe,
+            expected.data.baseline_shift,
+            expected.data.nsb_rate.to(u.GHz).value,
+        ]
+        bad = np.zeros(n_pixels, dtype=bool)
+        bad[bad_pixels] = True
+        bad |= ~np.isfinite(expected_values[0]) | (expected_values[1] <= 0)
+        for pixel in range(n_pixels):
+            neighbors = [n for n in geom.neighbors[pixel] if not bad[n]]
+            for value, expected_value in zip(values, expected_values):
+                if not bad[pixel]:
+                    assert value[pixel] == expected_value[pixel]
+                elif len(neighbors) > 0:
+                    assert np.isclose(value[pixel],
+                                      np.mean(expected_value[neighbors]))
+                else:
+                    assert value[pixel] == 0
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pkg_resources
+
+from digicampipe.io.columnar import columnar_event_source, \
+    columnar_block_source
+from digicampipe.io.event_stream import event_stream
+from digicampipe.scripts.convert import convert
+
+example_file_path = pkg_resources.resource_filename(
+    'digicampipe',
+    os.path.join(
+        'tests',
+        'resources',
+        'example_100_evts.000.fits.fz'
+    )
+)
+
+EVENTS_IN_EXAMPLE_FILE = 100
+
+
+def test_convert_zfits(tmpdir):
+    for compression in [None, 'lzf']:
+        output_dir = str(tmpdir.mkdir(str(compression)))
+        columnar_file, = convert([example_file_path], output_dir=output_dir,
+                                 block_size=30, compression=compression,
+                                 disable_bar=True)
+        events = event_stream(example_file_path, disable_bar=True)
+        n_events = 0
+
+        for event, columnar_event in zip(events, event_stream(columnar_file)):
+            r0 = event.r0.tel[1]
+            columnar_r0 = columnar_event.r0.tel[1]
+
+            assert columnar_event.r0.event_id == event.r0.event_id
+            assert columnar_r0.camera_event_number == r0.camera_event_number
+            assert columnar_r0.local_camera_clock == r0.local_camera_clock
+            assert columnar_r0.gps_time == r0.gps_time
+            assert columnar_r0.camera_event_type == r0.camera_event_type
+            np.testing.assert_array_equal(columnar_r0.adc_samples,
+                                          r0.adc_samples)
+            np.testing.assert_array_equal(columnar_r0.digicam_baseline,
+                                          r0.digicam_baseline)
+            n_events += 1
+
+        assert n_events == EVENTS_IN_EXAMPLE_FILE
+
+
+def test_columnar_block_source(tmpdir):
+    columnar_file, = convert([example_file_path], output_dir=str(tmpdir),
+                             block_size=30, disable_bar=True)
+    blocks = list(columnar_block_source(columnar_file, block_size=20))
+
+    assert [len(block) for block in blocks] == [20, 10] * 3 + [10]
+    # the blocks are read-only views of the memory mapped file
+    assert not blocks[0].adc_samples.flags.owndata
+    assert not blocks[0].adc_samples.flags.writeable
+
+    events = columnar_event_source(columnar_file, max_events=10,
+                                   event_id=blocks[1].camera_event_number[0])
+    event_ids = [event.r0.tel[1].camera_event_number for event in events]
+
+    np.testing.assert_array_equal(event_ids, blocks[1].camera_event_number)
@@ -0,0 +1,44 @@
+import fitsio
+import numpy as np
+import pytest
+from astropy.table import Table, vstack
+
+from digicampipe.scripts.concatenate import concatenate
+
+
+def _write_input(path, n_rows, seed):
+    random = np.random.RandomState(seed)
+    data = np.zeros(n_rows, dtype=[('x', '>f8'), ('flag', '>i8'),
+                                   ('burst', '?'), ('v', '>f4', (3, ))])
+    data['x'] = random.normal(size=n_rows)
+    data['flag'] = random.randint(0, 2, size=n_rows)
+    data['burst'] = random.randint(0, 2, size=n_rows)
+    data['v'] = random.normal(size=(n_rows, 3))
+    fitsio.write(path, data, clobber=True, units=['mm', '', '', 'deg'])
+    return path
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_concatenate(tmpdir, n_workers):
+    inputs = [
+        _write_input(str(tmpdir.join('hillas_{}.fits'.format(i))), n_rows, i)
+        for i, n_rows in enumerate([7, 0, 13, 5])
+    ]
+    output = str(tmpdir.join('hillas.fits'))
+    n_rows = concatenate(inputs + [str(tmpdir.join('missing.fits'))], output,
+                         chunk_size=4, n_workers=n_workers)
+    assert n_rows == 25
+    result = Table.read(output)
+    expected = vstack([Table.read(path) for path in inputs])
+    assert result['flag'].dtype == bool
+    assert result['x'].unit == 'mm'
+    for name in expected.colnames:
+        assert np.all(np.asarray(result[name]) == np.asarray(expected[name]))
+
+
+def test_concatenate_schema_mismatch(tmpdir):
+    first = _write_input(str(tmpdir.join('first.fits')), 3, 0)
+    second = str(tmpdir.join('second.fits'))
+    fitsio.write(second, np.zeros(3, dtype=[('x', '>f8')]))
+    with pytest.raises(ValueError):
+        concatenate([first, second], str(tmpdir.join('output.fits')))
@@ -1,9 +1,11 @@
 import os
 import numpy as np
 import pkg_resources
+import pytest
 
 from digicampipe.io.event_stream import event_stream
-from digicampipe.io.hdf5 import digicamtoy_event_source
+from digicampipe.io.hdf5 import digicamtoy_event_source, \
+    digicamtoy_block_source
 
 example_file_path = pkg_resources.resource_filename(
     'digicampipe',
@@ -15,6 +17,17 @@ example_file_path = pkg_resources.resource_filename(
     )
 )
 
+# 10 events stored in HDF5 chunks of 3 events
+example_file_path_3 = pkg_resources.resource_filename(
+    'digicampipe',
+    os.path.join(
+        'tests',
+        'resources',
+        'digicamtoy',
+        'events_digicamtoy_nsb_3_pe_10.hdf5'
+    )
+)
+
 example_file_path_2 = pkg_resources.resource_filename(
     'digicampipe',
     os.path.join(
@@ -72,3 +85,54 @@ def test_baseline():
 
             baseline = event.r0.tel[tel_id].digicam_baseline
             np.testing.assert_array_equal(baseline, EXPECTED_BASELINE)
+
+
+def test_event_id():
+    event_id = 5
+    event_ids = [
+        event.r0.event_id
+        for event in digicamtoy_event_source(example_file_path,
+                                             event_id=event_id)
+    ]
+
+    assert event_ids[0] == event_id
+
+
+def test_block_source():
+    events = digicamtoy_event_source(example_file_path_2, chunk_size=7)
+    n_events = 0
+
+    for block in digicamtoy_block_source(example_file_path_2, block_size=4):
+
+        assert len(block) <= 4
+
+        for i in range(len(block)):
+            r0 = next(events).r0.tel[block.tel_id]
+
+            assert block.camera_event_number[i] == r0.camera_event_number
+            np.testing.assert_array_equal(block.adc_samples[i],
+                                          r0.adc_samples)
+            np.testing.assert_array_equal(block.digicam_baseline[i],
+                                          r0.digicam_baseline)
+        n_events += len(block)
+
+    assert n_events > 0
+
+
+@pytest.mark.parametrize('event_id, block_sizes', [
+    (None, [4, 4, 2]),
+    (1, [4, 4, 1]),
+])
+def test_block_source_block_sizes(event_id, block_sizes):
+    events = digicamtoy_event_source(example_file_path_3, event_id=event_id)
+    blocks = digicamtoy_block_source(example_file_path_3, block_size=4,
+                                     event_id=event_id)
+    sizes = []
+    for block in blocks:
+        sizes.append(len(block))
+        for i in range(len(block)):
+            r0 = next(events).r0.tel[block.tel_id]
+            assert block.camera_event_number[i] == r0.camera_event_number
+            np.testing.assert_array_equal(block.adc_samples[i],
+                                          r0.adc_samples)
+    assert sizes == block_sizes
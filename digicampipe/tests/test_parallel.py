@@ -0,0 +1,64 @@
+import multiprocessing
+
+import pytest
+
+from digicampipe.io.containers import DataContainer
+from digicampipe.io.parallel import parallel_file_stream
+
+N_EVENTS_PER_FILE = 20
+
+
+def _source(url, disable_bar=True, rows=None):
+    # events of file i have the event numbers i * 1000 + j, such that the
+    # files are ordered in time like the ones of a run. Like the event
+    # sources of digicampipe, the same container is filled for every event.
+    data = DataContainer()
+    data.r0.tels_with_data = [1]
+    if rows is None:
+        rows = range(N_EVENTS_PER_FILE)
+    for row in rows:
+        r0 = data.r0.tel[1]
+        r0.camera_event_number = int(url.split('_')[-1]) * 1000 + row
+        r0.local_camera_clock = row
+        yield data
+
+
+def _count_events(url):
+    return N_EVENTS_PER_FILE
+
+
+@pytest.mark.parametrize('count_events', [None, _count_events])
+def test_parallel_file_stream(count_events):
+    n_files = 3
+    filelist = ['file_{}'.format(i) for i in range(n_files)]
+    # more events per file than the workers can buffer
+    events = parallel_file_stream(filelist, _source, n_workers=2,
+                                  queue_size=3, disable_bar=True,
+                                  count_events=count_events)
+    event_ids = [event.r0.tel[1].camera_event_number for event in events]
+
+    assert event_ids == [i * 1000 + j for i in range(n_files)
+                         for j in range(N_EVENTS_PER_FILE)]
+    assert multiprocessing.active_children() == []
+
+
+def test_parallel_file_stream_rows():
+    filelist = ['file_1', 'file_2']
+    file_kwargs = [{'rows': [2, 5, 7]}, {'rows': list(range(10))}]
+    events = parallel_file_stream(filelist, _source, n_workers=2,
+                                  queue_size=4, disable_bar=True,
+                                  file_kwargs=file_kwargs)
+    event_ids = [event.r0.tel[1].camera_event_number for event in events]
+
+    assert event_ids == [1002, 1005, 1007] + list(range(2000, 2010))
+
+
+def test_parallel_file_stream_close():
+    filelist = ['file_{}'.format(i) for i in range(3)]
+    events = parallel_file_stream(filelist, _source, n_workers=3,
+                                  queue_size=2, disable_bar=True)
+    event = next(events)
+
+    assert event.r0.tel[1].camera_event_number == 0
+    events.close()
+    assert multiprocessing.active_children() == []
@@ -0,0 +1,65 @@
+import numpy as np
+import peakutils
+import pytest
+
+from digicampipe.calib.peak import find_peaks_mask, find_pulse_correlate, \
+    MatchedFilter, TEMPLATE_FILENAME
+from digicampipe.io.containers import CalibrationContainer
+from digicampipe.utils.pulse_template import NormalizedPulseTemplate
+
+
+@pytest.mark.parametrize('threshold', [0, 0.3, 0.8])
+@pytest.mark.parametrize('min_distance', [1, 3, 20])
+def test_find_peaks_mask(threshold, min_distance):
+    random = np.random.RandomState(0)
+    adc_samples = random.normal(0, 10, size=(3, 20, 50))
+    adc_samples[0, 0] = 0
+    pulse_mask = find_peaks_mask(adc_samples, threshold, min_distance)
+    assert pulse_mask.shape == adc_samples.shape
+    for waveform, mask in zip(adc_samples.reshape(-1, 50),
+                              pulse_mask.reshape(-1, 50)):
+        expected = peakutils.indexes(waveform, threshold, min_distance)
+        assert np.all(np.nonzero(mask)[0] == expected)
+
+
+def test_find_peaks_mask_threshold_abs():
+    adc_samples = np.array([[0, 5, 0, 2, 0, 12, 0, 3, 4, 0]], dtype=np.uint16)
+    out = np.ones(adc_samples.shape, dtype=bool)
+    pulse_mask = find_peaks_mask(adc_samples, 3, 2, threshold_abs=True,
+                                 out=out)
+    assert pulse_mask is out
+    assert np.all(np.nonzero(pulse_mask[0])[0] == [1, 5, 8])
+
+
+@pytest.mark.parametrize('n_samples', [20, 50])
+def test_matched_filter(n_samples):
+    pulse_template = NormalizedPulseTemplate.load(TEMPLATE_FILENAME)
+    matched_filter = MatchedFilter(pulse_template)
+    template = matched_filter.template
+    random = np.random.RandomState(0)
+    adc_samples = random.normal(0, 1, size=(2, 5, n_samples))
+    adc_samples[1, 2, 10 - matched_filter.peak_index:][:len(template)] += \
+        100 * template
+    filtered = matched_filter(adc_samples)
+    assert filtered.shape == adc_samples.shape
+    assert np.argmax(filtered[1, 2]) == 10
+    for waveform, result in zip(adc_samples.reshape(-1, n_samples),
+                                filtered.reshape(-1, n_samples)):
+        expected = np.correlate(waveform, template, mode='full')
+        start = len(template) - 1 - matched_filter.peak_index
+        assert np.allclose(result, expected[start:start + n_samples])
+
+
+def test_find_pulse_correlate_normalize():
+    random = np.random.RandomState(0)
+    adc_samples = random.normal(0, 1, size=(5, 50))
+    adc_samples[:, 20:24] += 10
+    pulse_masks = []
+    for scale, offset in [(1, 0), (10, 300)]:
+        event = CalibrationContainer()
+        event.data.adc_samples = scale * adc_samples + offset
+        event = next(find_pulse_correlate([event], threshold=2))
+        pulse_masks.append(event.data.pulse_mask.copy())
+    # the threshold is in units of the standard deviation of the waveforms
+    np.testing.assert_array_equal(pulse_masks[0], pulse_masks[1])
+    assert np.all(np.sum(pulse_masks[0], axis=-1) >= 1)
@@ -118,6 +118,45 @@ def test_pipeline():
         assert np.all((data.y[good_data] < 550) & (data.y[good_data] > -550))
 
 
+def test_pipeline_block_size():
+    # the calibration by blocks of events gives the same results
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        dark_filename = os.path.join(tmpdirname, 'dark.pk')
+        compute_raw(
+            files=[dark100_file_path],
+            max_events=None,
+            pixel_id=convert_pixel_args(None),
+            filename=dark_filename,
+            disable_bar=True
+        )
+        tables = []
+        for block_size in [None, 30]:
+            hillas_filename = os.path.join(
+                tmpdirname, 'hillas_{}.fits'.format(block_size)
+            )
+            main_pipeline(
+                files=[science100_file_path],
+                aux_basepath=None,
+                max_events=None,
+                dark_filename=dark_filename,
+                integral_width=7,
+                debug=False,
+                hillas_filename=hillas_filename,
+                template_filename=template_filename,
+                parameters_filename=calibration_filename,
+                picture_threshold=30,
+                boundary_threshold=15,
+                saturation_threshold=3000,
+                threshold_pulse=0.1,
+                disable_bar=True,
+                block_size=block_size,
+            )
+            tables.append(fits.open(hillas_filename)[1].data)
+        assert len(tables[0]) == len(tables[1]) > 0
+        for col in tables[0].columns.names:
+            np.testing.assert_array_equal(tables[0][col], tables[1][col])
+
+
 def test_pipeline_plot():
     with tempfile.TemporaryDirectory() as tmpdirname:
         dark_filename = os.path.join(tmpdirname, 'dark.pk')
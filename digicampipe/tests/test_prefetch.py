@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+from digicampipe.io.prefetch import Prefetcher
+
+
+def _slow_range(n, delay=0.001):
+    for i in range(n):
+        time.sleep(delay)
+        yield i
+
+
+def test_prefetch_order():
+    n_items = 100
+    prefetcher = Prefetcher(_slow_range(n_items), depth=5)
+
+    assert list(prefetcher) == list(range(n_items))
+    assert prefetcher.n_items == n_items
+    assert prefetcher.consumer_stall > 0
+
+
+def test_prefetch_early_stop():
+    prefetcher = Prefetcher(range(1000), depth=2)
+
+    for i in prefetcher:
+        if i == 10:
+            break
+    prefetcher.close()
+
+    assert not prefetcher._thread.is_alive()
+
+
+def test_prefetch_raises_producer_error():
+    def failing():
+        yield 0
+        raise IOError('cannot read')
+
+    with pytest.raises(IOError):
+        for _ in Prefetcher(failing(), depth=2):
+            pass
@@ -1,8 +1,11 @@
 import os
+import numpy as np
 from astropy import units as u
 import pkg_resources
+from eventio.simtel.simtelfile import SimTelFile
 
-from digicampipe.io.simtel import simtel_event_source
+from digicampipe.io.simtel import simtel_event_source, \
+    _check_simtel_file_seekable
 from digicampipe.io.event_stream import event_stream, calibration_event_stream
 
 example_file_path = pkg_resources.resource_filename(
@@ -25,6 +28,15 @@ example_file_path_1 = pkg_resources.resource_filename(
     )
 )
 
+example_file_path_2 = pkg_resources.resource_filename(
+    'digicampipe',
+    os.path.join(
+        'tests',
+        'resources',
+        'simtel',
+        'simtel_test_file.simtel.gz'
+    )
+)
 
 EVENT_ID = 102
 EVENTS_IN_EXAMPLE_FILE = 1
@@ -82,6 +94,60 @@ def test_calibration_event_stream():
     assert energy == ENERGY
 
 
+def test_containers_reused():
+    containers = {}
+    for event in simtel_event_source(example_file_path_2):
+        for tel_id, r0 in event.r0.tel.items():
+
+            assert containers.setdefault(tel_id, r0) is r0
+            np.testing.assert_array_equal(r0.adc_sums,
+                                          r0.adc_samples.sum(axis=-1))
+
+
+def test_containers_reset():
+    # fields the source does not fill do not keep the value given to them
+    # for a previous event
+    n_events = 0
+    for event in simtel_event_source(example_file_path_2):
+        for tel_id in event.r0.tels_with_data:
+            assert event.r0.tel[tel_id].dark_baseline is np.ndarray
+            assert event.dl1.tel[tel_id].cleaning_mask is np.ndarray
+            event.r0.tel[tel_id].dark_baseline = np.zeros(3)
+            event.dl1.tel[tel_id].cleaning_mask = np.zeros(3, dtype=bool)
+        n_events += 1
+    assert n_events > 1
+
+
+def test_seek_event(tmpdir):
+    index_dir = str(tmpdir)
+    event_ids = [event.r0.event_id
+                 for event in simtel_event_source(example_file_path_2)]
+    event_id = event_ids[4]
+
+    events = simtel_event_source(example_file_path_2, event_id=event_id,
+                                 index_dir=index_dir)
+
+    assert [event.r0.event_id for event in events] == event_ids[4:]
+
+    events = simtel_event_source(example_file_path_2, requested_event=2,
+                                 index_dir=index_dir)
+
+    assert [event.r0.event_id for event in events] == [event_ids[2]]
+
+    events = simtel_event_source(example_file_path_2,
+                                 requested_event=event_id,
+                                 use_event_id=True, index_dir=index_dir)
+
+    assert [event.r0.event_id for event in events] == [event_id]
+
+
+def test_eventio_seek_support():
+    # seeking relies on internals of eventio, this fails if the installed
+    # version does not have them anymore
+    with SimTelFile(example_file_path_2) as file:
+        _check_simtel_file_seekable(file)
+
+
 if __name__ == '__main__':
     test_event_id()
     test_event_stream()
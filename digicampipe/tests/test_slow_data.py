@@ -1,10 +1,13 @@
 import os
+import tempfile
 import warnings
 import numpy as np
 from pkg_resources import resource_filename
 
+from digicampipe.io.auxservice import AuxService, night_of
 from digicampipe.io.event_stream import event_stream, add_slow_data, \
-    calibration_event_stream, add_slow_data_calibration
+    calibration_event_stream, add_slow_data_calibration, \
+    join_slow_data_calibration
 
 warnings.simplefilter("ignore")
 
@@ -20,7 +23,7 @@ example_file_path = resource_filename(
 aux_basepath = resource_filename('digicampipe', 'tests/resources/')
 
 
-def test_add_slow_data():
+def test_add_slow_data(tmpdir):
     data_stream = event_stream(example_file_path, max_events=100)
     data_stream = add_slow_data(
         data_stream, basepath=aux_basepath,
@@ -30,7 +33,8 @@ def test_add_slow_data():
             'PDPSlowControl',
             'SafetyPLC',
             'DriveSystem',
-        )
+        ),
+        cache_dir=str(tmpdir),
     )
     ts_digicam = []
     ts_master = []
@@ -59,9 +63,10 @@ def test_add_slow_data():
     assert ((ts_data - ts_drive) <= 1.1).all()
 
 
-def test_add_slow_data_calibration():
+def test_add_slow_data_calibration(tmpdir):
     data_stream = calibration_event_stream(example_file_path, max_events=100)
-    data_stream = add_slow_data_calibration(data_stream, basepath=aux_basepath)
+    data_stream = add_slow_data_calibration(data_stream, basepath=aux_basepath,
+                                            cache_dir=str(tmpdir))
     ts_slow = []
     ts_data = []
     for event in data_stream:
@@ -73,6 +78,62 @@ def test_add_slow_data_calibration():
     assert (diff <= 1.1).all()
 
 
+def test_aux_service_at_many(tmpdir):
+    service = AuxService('DriveSystem', aux_basepath, cache_dir=str(tmpdir))
+    timestamps = [
+        event.data.local_time
+        for event in calibration_event_stream(example_file_path,
+                                              max_events=100)
+    ]
+    rows = service.at_many(timestamps)
+    assert len(rows.timestamp) == len(timestamps)
+    for i, timestamp in enumerate(timestamps):
+        row = service.at(timestamp)
+        for name in row._fields:
+            assert np.all(getattr(rows, name)[i] == getattr(row, name))
+
+
+def test_aux_service_cache(tmpdir):
+    cache_dir = str(tmpdir)
+    timestamps = [
+        event.data.local_time
+        for event in calibration_event_stream(example_file_path,
+                                              max_events=100)
+    ]
+    not_cached = AuxService('DigicamSlowControl', aux_basepath,
+                            cache_dir=None).at_many(timestamps)
+    for _ in range(2):
+        service = AuxService('DigicamSlowControl', aux_basepath,
+                             cache_dir=cache_dir)
+        cached = service.at_many(timestamps)
+        for name in not_cached._fields:
+            assert np.all(getattr(cached, name) == getattr(not_cached, name))
+    assert len(tmpdir.listdir(fil=lambda path: path.ext == '.npy')) == 1
+    aux_table = service.at_date(night_of(timestamps[0]))
+    assert isinstance(aux_table.data, np.memmap)
+
+
+def test_join_slow_data_calibration(tmpdir):
+    aux_services = ('DriveSystem', 'SafetyPLC')
+    events = calibration_event_stream(example_file_path, max_events=100)
+    events = add_slow_data_calibration(events, basepath=aux_basepath,
+                                       aux_services=aux_services,
+                                       cache_dir=str(tmpdir))
+    joined_events = calibration_event_stream(example_file_path,
+                                             max_events=100)
+    joined_events = join_slow_data_calibration(joined_events,
+                                               basepath=aux_basepath,
+                                               aux_services=aux_services,
+                                               cache_dir=str(tmpdir))
+    for event, joined_event in zip(events, joined_events):
+        row = joined_event.slow_data.row(joined_event.slow_data_index)
+        drive = event.slow_data.DriveSystem
+        assert row.az == drive.current_position_az
+        assert row.is_tracking == bool(drive.is_tracking)
+        status = event.slow_data.SafetyPLC.SPLC_CAM_Status
+        assert row.pointing_leds_blink == bool((status & 1 << 9) >> 9)
+
+
 if __name__ == '__main__':
-    test_add_slow_data_calibration()
-    test_add_slow_data()
+    test_add_slow_data_calibration(tempfile.mkdtemp())
+    test_add_slow_data(tempfile.mkdtemp())
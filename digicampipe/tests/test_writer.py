@@ -0,0 +1,57 @@
+import astropy.units as u
+import h5py
+import numpy as np
+import pytest
+from astropy.table import Table
+from ctapipe.core import Container, Field
+
+from digicampipe.io.writer import ContainerWriter
+
+
+class ExampleContainer(Container):
+    event_id = Field(int, 'event id')
+    length = Field(float, 'length')
+    flag = Field(bool, 'flag')
+    values = Field(np.ndarray, 'values')
+    az = Field(float, 'never filled')
+
+
+def _fill(container, i):
+    container.event_id = i
+    container.length = i * u.mm if i > 0 else 0 * u.m
+    container.flag = bool(i % 2)
+    container.values = np.arange(3) + i
+
+
+@pytest.mark.parametrize('extension', ['fits', 'h5'])
+def test_container_writer(tmpdir, extension):
+    filename = str(tmpdir.join('output.' + extension))
+    container = ExampleContainer()
+    n_rows = 25
+    with ContainerWriter(filename, chunk_size=10) as writer:
+        for i in range(n_rows):
+            _fill(container, i)
+            writer.add_container(container)
+            assert writer.n_rows == (i + 1) // 10 * 10
+    assert writer.n_rows == n_rows
+
+    if extension == 'fits':
+        data = Table.read(filename)
+        assert data['length'].unit == u.m
+    else:
+        with h5py.File(filename, 'r') as file:
+            data = {name: file['data'][name][()] for name in file['data']}
+    assert np.all(data['event_id'] == np.arange(n_rows))
+    assert np.allclose(data['length'], np.arange(n_rows) * 1e-3)
+    assert np.all(data['flag'] == np.arange(n_rows) % 2)
+    assert np.all(data['values'] ==
+                  np.arange(3)[None, :] + np.arange(n_rows)[:, None])
+    assert np.all(np.isnan(np.asarray(data['az'])))
+
+
+def test_container_writer_empty(tmpdir):
+    filename = str(tmpdir.join('output.fits'))
+    writer = ContainerWriter(filename)
+    with pytest.raises(ValueError):
+        writer.close()
+    assert not tmpdir.join('output.fits').exists()
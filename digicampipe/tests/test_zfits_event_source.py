@@ -1,10 +1,17 @@
 import os
+from types import SimpleNamespace
 
+import numpy as np
 import pkg_resources
+import pytest
 
-from digicampipe.io.event_stream import event_stream
+from digicampipe.io.event_stream import event_stream, block_stream, \
+    calibration_event_stream
+from digicampipe.io.event_index import EventIndex, get_events
+from digicampipe.io.index import load_zfits_index
 from digicampipe.io.zfits import count_number_events
-from digicampipe.io.zfits import zfits_event_source
+from digicampipe.io.zfits import zfits_event_source, zfits_block_source, \
+    _read_baselines
 
 example_file_path = pkg_resources.resource_filename(
     'digicampipe',
@@ -57,5 +64,224 @@ def test_event_id():
     assert number == event_id
 
 
+def test_block_source():
+    block_size = 30
+    events = zfits_event_source(example_file_path)
+    n_events = 0
+
+    for block in zfits_block_source(example_file_path,
+                                    block_size=block_size):
+
+        assert len(block) <= block_size
+
+        for i in range(len(block)):
+            r0 = next(events).r0.tel[block.tel_id]
+
+            assert block.camera_event_number[i] == r0.camera_event_number
+            assert block.local_camera_clock[i] == r0.local_camera_clock
+            assert block.camera_event_type[i] == r0.camera_event_type
+            np.testing.assert_array_equal(block.adc_samples[i],
+                                          r0.adc_samples)
+            np.testing.assert_array_equal(block.digicam_baseline[i],
+                                          r0.digicam_baseline)
+        n_events += len(block)
+
+    assert n_events == EVENTS_IN_EXAMPLE_FILE
+
+
+def test_read_missing_baselines():
+    event = SimpleNamespace(hiGain=SimpleNamespace(
+        waveforms=SimpleNamespace(samples=np.zeros(3))))
+    with pytest.warns(UserWarning):
+        baselines = _read_baselines(event, 3, 0, 'file.fits.fz')
+    assert baselines.shape == (3, )
+    assert np.all(np.isnan(baselines))
+
+
+def test_block_stream_event_id_range():
+    event_id_range = (FIRST_EVENT_ID + 10, LAST_EVENT_ID - 10)
+    max_events = 50
+    event_ids = []
+
+    for block in block_stream(example_file_path, block_size=7,
+                              event_id_range=event_id_range,
+                              max_events=max_events):
+        event_ids.extend(block.camera_event_number)
+
+    assert len(event_ids) == max_events
+    assert event_ids[0] == event_id_range[0] + 1
+
+
+def test_event_stream_parallel():
+    n_files = 3
+    files = [example_file_path] * n_files
+    event_ids = [
+        event.r0.tel[1].camera_event_number
+        for event in event_stream(files, n_workers=n_files)
+    ]
+
+    assert len(event_ids) == n_files * EVENTS_IN_EXAMPLE_FILE
+    assert event_ids == sorted(event_ids)
+
+    max_events = 10
+    events = event_stream(files, n_workers=2, max_events=max_events,
+                          event_id_range=(FIRST_EVENT_ID, None))
+    event_ids = [event.r0.tel[1].camera_event_number for event in events]
+
+    assert len(event_ids) == max_events
+    assert min(event_ids) > FIRST_EVENT_ID
+
+
+def test_index(tmpdir):
+    index_dir = str(tmpdir)
+    index = load_zfits_index(example_file_path, index_dir=index_dir)
+
+    assert len(index) == EVENTS_IN_EXAMPLE_FILE
+    assert index['event_number'][0] == FIRST_EVENT_ID
+    assert index['event_number'][-1] == LAST_EVENT_ID
+    assert len(tmpdir.listdir()) == 1
+
+    event_id_range = (FIRST_EVENT_ID + 10, LAST_EVENT_ID - 10)
+    expected_ids = [
+        event.r0.tel[1].camera_event_number
+        for event in event_stream(example_file_path,
+                                  event_id_range=event_id_range)
+    ]
+    event_ids = [
+        event.r0.tel[1].camera_event_number
+        for event in event_stream(example_file_path,
+                                  event_id_range=event_id_range,
+                                  use_index=True, index_dir=index_dir)
+    ]
+
+    assert event_ids == expected_ids
+
+    event_id = LAST_EVENT_ID - 3
+    data = next(zfits_event_source(example_file_path, event_id=event_id,
+                                   use_index=True, index_dir=index_dir))
+
+    assert data.r0.tel[1].camera_event_number == event_id
+
+
+def test_get_events(tmpdir):
+    index_dir = str(tmpdir)
+    index = EventIndex([example_file_path], index_dir=index_dir)
+
+    assert len(index) == EVENTS_IN_EXAMPLE_FILE
+    assert index.position(FIRST_EVENT_ID + 3) == 3
+
+    event_ids = [LAST_EVENT_ID - 2, FIRST_EVENT_ID + 5, FIRST_EVENT_ID + 50]
+    expected = {
+        event.r0.tel[1].camera_event_number:
+            event.r0.tel[1].adc_samples.copy()
+        for event in event_stream(example_file_path)
+        if event.r0.tel[1].camera_event_number in event_ids
+    }
+    n_events = 0
+    for event in get_events([example_file_path], event_ids, index=index):
+        r0 = event.r0.tel[1]
+        assert r0.camera_event_number == sorted(event_ids)[n_events]
+        np.testing.assert_array_equal(
+            r0.adc_samples, expected[r0.camera_event_number])
+        n_events += 1
+    assert n_events == len(event_ids)
+
+    with pytest.raises(IndexError):
+        list(get_events([example_file_path], [LAST_EVENT_ID + 1],
+                        index=index))
+
+
+def test_lazy_trigger_traces():
+    for data in zfits_event_source(example_file_path, max_events=2):
+        r0 = data.r0.tel[1]
+        n_samples = r0.adc_samples.shape[-1]
+
+        assert callable(r0._trigger_input_traces)
+        assert r0.trigger_input_traces.shape == (432, n_samples)
+        assert isinstance(r0._trigger_input_traces, np.ndarray)
+        assert r0.trigger_output_patch7.shape == (432, n_samples)
+        assert r0.trigger_output_patch19.shape == (432, n_samples)
+
+
+def test_lazy_fields_items():
+    data = next(zfits_event_source(example_file_path, max_events=1))
+    r0 = data.r0.tel[1]
+    fields = r0.as_dict()
+
+    assert not any(name.startswith('_') for name in fields)
+    assert isinstance(fields['trigger_input_traces'], np.ndarray)
+    assert isinstance(fields['trigger_output_patch7'], np.ndarray)
+    assert fields['camera_event_type'] == r0.camera_event_type
+    assert not any(callable(value) and not isinstance(value, type)
+                   for value in fields.values())
+
+
+def test_pixel_selection():
+    pixel_id = [12, 3, 1000]
+    events = zfits_event_source(example_file_path, max_events=10)
+    selected_events = calibration_event_stream(example_file_path,
+                                               pixel_id=pixel_id,
+                                               max_events=10)
+
+    for event, selected_event in zip(events, selected_events):
+        r0 = event.r0.tel[1]
+
+        np.testing.assert_array_equal(selected_event.pixel_id, pixel_id)
+        np.testing.assert_array_equal(selected_event.data.adc_samples,
+                                      r0.adc_samples[pixel_id])
+        np.testing.assert_array_equal(selected_event.data.digicam_baseline,
+                                      r0.digicam_baseline[pixel_id])
+        assert selected_event.data.gps_time == r0.gps_time
+
+
+def test_event_types(tmpdir):
+    index_dir = str(tmpdir)
+    all_events = [
+        (event.r0.tel[1].camera_event_number,
+         event.r0.tel[1].camera_event_type)
+        for event in event_stream(example_file_path)
+    ]
+    event_types = [all_events[0][1]]
+    expected_ids = [
+        event_id for event_id, event_type in all_events
+        if event_type in event_types
+    ]
+    for use_index in [False, True]:
+        event_ids = [
+            event.r0.tel[1].camera_event_number
+            for event in event_stream(example_file_path,
+                                      event_types=event_types,
+                                      use_index=use_index,
+                                      index_dir=index_dir)
+        ]
+        assert event_ids == expected_ids
+
+    event_ids = [
+        event.r0.tel[1].camera_event_number
+        for event in event_stream(example_file_path,
+                                  event_types=lambda event_type: False)
+    ]
+    assert event_ids == []
+
+
+def test_event_types_max_events(tmpdir):
+    index_dir = str(tmpdir)
+    event_types = [next(event_stream(example_file_path))
+                   .r0.tel[1].camera_event_type]
+    results = []
+    for use_index in [False, True]:
+        events = zfits_event_source(example_file_path, max_events=5,
+                                    event_types=event_types,
+                                    use_index=use_index, index_dir=index_dir)
+        results.append([
+            (data.r0.event_id, data.r0.tel[1].camera_event_number)
+            for data in events
+        ])
+    # the rejected events are counted in neither of the paths
+    assert results[0] == results[1]
+    assert [event_id for event_id, _ in results[0]] == \
+        list(range(len(results[0])))
+
+
 if __name__ == '__main__':
     test_event_id()
@@ -45,6 +45,7 @@ setup(
     description='A package for DigiCam pipeline',
     install_requires=[
         'ctapipe>=0.6.0',
+        'eventio>=2.1,<2.2',
         'numpy',
         'matplotlib',
         'scipy',